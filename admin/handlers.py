@@ -1,19 +1,68 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
+    MessageHandler,
+    ApplicationHandlerStop,
     Application,
+    filters,
 )
 
+from config import KEEPWARM_ACTIVE_HOURS, KEEPWARM_DAILY_BUDGET_USD, MODEL_INFO
+from core.cache import TTLCache
+from core.outbound import outbound
+from core.throttle import user_limiter
+from core.keepwarm import keepwarm
+from core import routing
+from core.telemetry import telemetry, REPORT_DAYS
+from core.deadline import with_deadline, DEADLINE_ADMIN, DEADLINE_EXPORT
+from core.export import parse_export_args, send_export, ExportInProgress, ExportTooLarge
 from core.registry import register_user, is_admin
-from core.balance import add_tokens, subtract_tokens, set_balance, get_balance
-from core.supabase import (
-    supabase_fetch_recent_users,
-    supabase_get_user,
-    log_admin_action,
+from core.balance import add_tokens, change_balance, set_balance, bulk_add_tokens
+from core.storage import get_storage
+from utils.logging_config import dropped_records
+from .views import (
+    build_admin_main_keyboard,
+    build_admin_user_card_text,
+    build_admin_user_keyboard,
 )
-from .views import build_admin_main_keyboard, build_admin_user_keyboard
+
+ADMIN_PAGE_SIZE = 20
+BULK_GRANT_KEY = "admin_bulk_grant"
+BULK_PROGRESS_EDIT_INTERVAL = 1.5  # сек, чтобы не упереться в лимит edit_message
+
+# Короткий кэш страниц списка: листание туда-обратно не ходит в Supabase.
+# Сбрасывается после изменений баланса из админки.
+_admin_pages_cache = TTLCache(maxsize=64, ttl=30.0)
+
+
+async def _fetch_admin_page(cursor: str | None = None, direction: str = "next"):
+    key = (cursor, direction)
+    page = _admin_pages_cache.get(key)
+    if page is None:
+        page = await get_storage().fetch_users_page(cursor, direction, limit=ADMIN_PAGE_SIZE)
+        _admin_pages_cache.set(key, page)
+    return page
+
+
+async def _build_admin_main(cursor: str | None = None, direction: str = "next"):
+    users, next_cursor, prev_cursor = await _fetch_admin_page(cursor, direction)
+
+    text_lines = ["Админ-панель nano-bot 👑", ""]
+    if prev_cursor:
+        text_lines.append(f"Показаны {len(users)} пользователей (более ранние регистрации).")
+    else:
+        text_lines.append(f"Показаны последние {len(users)} пользователей.")
+    text_lines.append("")
+    text_lines.append("Выберите пользователя, чтобы начислить/списать токены:")
+    kb = build_admin_main_keyboard(users, next_cursor=next_cursor, prev_cursor=prev_cursor)
+    return "\n".join(text_lines), kb
 
 
 async def admin_help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -26,7 +75,15 @@ async def admin_help_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = (
         "Админ-панель:\n\n"
         "/admin — открыть визуальную админку с кнопками.\n"
-        "/add_tokens <telegram_id> <amount> — начислить токены вручную.\n\n"
+        "/add_tokens <telegram_id> <amount> — начислить токены вручную.\n"
+        "/bulk_grant <amount> <id1> <id2> ... — начислить токены списку пользователей.\n"
+        "/bulk_grant <amount> since <YYYY-MM-DD> — всем, кто генерировал с этой даты.\n"
+        "/admin_queue — состояние очереди исходящих сообщений.\n"
+        "/admin_warm — прогрев моделей и латентность холодных/тёплых запусков.\n"
+        "/admin_models — p95 и доля ошибок моделей, переключения на запасные.\n"
+        "/admin_stats — генерации, траты и покупки за сегодня, 7 и 30 дней.\n"
+        "/admin_perf [дней] — p50/p95/p99 времени и размера результата по моделям и настройкам.\n"
+        "/export_user <telegram_id> [csv|jsonl] [zip] — вся история генераций пользователя.\n\n"
         "Пример:\n"
         "/add_tokens 123456789 500"
     )
@@ -59,26 +116,462 @@ async def add_tokens_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("amount должен быть > 0.")
         return
 
-    new_balance = await add_tokens(target_id, amount)
-    await log_admin_action(admin_id, target_id, "add_tokens_command", amount)
+    if await get_storage().get_user(target_id) is None:
+        await update.message.reply_text(f"Пользователь {target_id} не найден.")
+        return
+
+    action_id = await get_storage().log_admin_action(admin_id, target_id, "add_tokens_command", amount)
+    new_balance = await add_tokens(target_id, amount, admin_action_id=action_id)
+    _admin_pages_cache.clear()
 
     await update.message.reply_text(
         f"✅ Пользователю {target_id} начислено {amount} токенов.\n"
         f"Новый баланс: {new_balance}"
     )
 
-    try:
-        await context.bot.send_message(
+    outbound.submit(
+        target_id,
+        lambda: context.bot.send_message(
             chat_id=target_id,
             text=(
                 f"🎉 Ваш баланс пополнен на {amount} токенов.\n"
                 f"Текущий баланс: {new_balance} токенов.\n\n"
                 "Можете продолжать генерации в боте 🙂"
             ),
+        ),
+    )
+
+
+async def bulk_grant_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    admin_id = update.effective_user.id
+    if not is_admin(admin_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    usage = (
+        "Использование:\n"
+        "/bulk_grant <amount> <id1> <id2> ... — по списку ID (через пробел или запятую)\n"
+        "/bulk_grant <amount> since <YYYY-MM-DD> — всем, кто генерировал с этой даты\n\n"
+        "Пример: /bulk_grant 150 since 2024-06-01"
+    )
+    args = context.args
+    if len(args) < 2:
+        await update.message.reply_text(usage)
+        return
+
+    try:
+        amount = int(args[0])
+    except ValueError:
+        await update.message.reply_text("amount должен быть числом.\n\n" + usage)
+        return
+    if amount <= 0:
+        await update.message.reply_text("amount должен быть > 0.")
+        return
+
+    if args[1].lower() == "since":
+        if len(args) != 3:
+            await update.message.reply_text(usage)
+            return
+        try:
+            since = datetime.strptime(args[2], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        except ValueError:
+            await update.message.reply_text("Дата должна быть в формате YYYY-MM-DD.")
+            return
+        user_ids = await get_storage().fetch_active_user_ids(since.isoformat())
+        source = f"active since {args[2]}"
+    else:
+        try:
+            user_ids = [
+                int(x) for arg in args[1:] for x in arg.split(",") if x.strip()
+            ]
+        except ValueError:
+            await update.message.reply_text("ID пользователей должны быть числами.")
+            return
+        source = "id list"
+
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        await update.message.reply_text("Под условие не попал ни один пользователь.")
+        return
+
+    context.user_data[BULK_GRANT_KEY] = {
+        "user_ids": user_ids,
+        "amount": amount,
+        "source": source,
+    }
+    kb = InlineKeyboardMarkup(
+        [[
+            InlineKeyboardButton("✅ Начислить", callback_data="admin_bulk|go"),
+            InlineKeyboardButton("Отмена", callback_data="admin_bulk|cancel"),
+        ]]
+    )
+    await update.message.reply_text(
+        f"Массовое начисление ({source}):\n"
+        f"Пользователей: {len(user_ids)}\n"
+        f"По {amount} токенов, всего {amount * len(user_ids)}.\n\n"
+        "Подтвердить?",
+        reply_markup=kb,
+    )
+
+
+async def _run_bulk_grant(query, context: ContextTypes.DEFAULT_TYPE, admin_id: int) -> None:
+    pending = context.user_data.pop(BULK_GRANT_KEY, None)
+    if not pending:
+        await query.message.edit_text("Нет ожидающего массового начисления.")
+        return
+
+    user_ids = pending["user_ids"]
+    amount = pending["amount"]
+    source = pending["source"]
+    total = len(user_ids)
+
+    await query.message.edit_text(f"⏳ Начисляю {amount} токенов: 0/{total}")
+    last_edit = time.monotonic()
+
+    async def on_progress(done: int, total_count: int) -> None:
+        nonlocal last_edit
+        if done < total_count and time.monotonic() - last_edit < BULK_PROGRESS_EDIT_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        try:
+            await query.message.edit_text(f"⏳ Начисляю {amount} токенов: {done}/{total_count}")
+        except Exception as e:
+            logging.warning("bulk_grant progress edit failed: %s", e)
+
+    # Действие пишется до первой пачки: записи журнала токенов ссылаются на него,
+    # и прерванное начисление видно по уже применённым пачкам
+    action_id = await get_storage().log_admin_action(
+        admin_id, None, "bulk_grant", amount, note=f"{source}, пользователей: {total}"
+    )
+    try:
+        balances = await bulk_add_tokens(
+            user_ids, amount, on_progress=on_progress, admin_action_id=action_id
         )
     except Exception as e:
-        import logging
-        logging.warning("Не удалось отправить уведомление пользователю %s: %s", target_id, e)
+        logging.exception("bulk_grant failed")
+        _admin_pages_cache.clear()
+        await query.message.edit_text(
+            f"❌ Массовое начисление прервано: {e}\n"
+            "Часть пачек могла уже примениться — записи bulk_grant в token_ledger "
+            f"с admin_action_id={action_id}."
+        )
+        return
+    _admin_pages_cache.clear()
+
+    for uid, new_balance in balances.items():
+        outbound.submit(
+            uid,
+            lambda uid=uid, new_balance=new_balance: context.bot.send_message(
+                chat_id=uid,
+                text=(
+                    f"🎉 Ваш баланс пополнен на {amount} токенов.\n"
+                    f"Текущий баланс: {new_balance} токенов.\n\n"
+                    "Можете продолжать генерации в боте 🙂"
+                ),
+            ),
+        )
+
+    missing = total - len(balances)
+    lines = [
+        f"✅ Начислено по {amount} токенов {len(balances)} пользователям ({source}).",
+    ]
+    if missing:
+        lines.append(f"Не найдено в базе: {missing}.")
+    lines.append("Уведомления поставлены в очередь (/admin_queue).")
+    await query.message.edit_text("\n".join(lines))
+
+
+async def admin_bulk_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not query:
+        return
+
+    admin_id = query.from_user.id
+    if not is_admin(admin_id):
+        await query.answer("Нет доступа", show_alert=True)
+        return
+
+    await query.answer()
+    if query.data == "admin_bulk|go":
+        await _run_bulk_grant(query, context, admin_id)
+    else:
+        context.user_data.pop(BULK_GRANT_KEY, None)
+        await query.message.edit_text("Массовое начисление отменено.")
+
+
+async def export_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await register_user(update.effective_user)
+    admin_id = update.effective_user.id
+    if not is_admin(admin_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    args = context.args
+    try:
+        target_id = int(args[0])
+        fmt, zipped = parse_export_args(args[1:])
+    except (IndexError, ValueError):
+        await update.message.reply_text(
+            "Использование: /export_user <telegram_id> [csv|jsonl] [zip]\n"
+            "Пример: /export_user 123456789 jsonl zip"
+        )
+        return
+
+    await update.message.reply_text(f"⏳ Выгружаю историю генераций {target_id}…")
+    try:
+        total = await send_export(context.bot, update.effective_chat.id, target_id, fmt, zipped)
+    except ExportInProgress:
+        await update.message.reply_text("Выгрузка для этого пользователя уже идёт.")
+        return
+    except ExportTooLarge:
+        await update.message.reply_text("Файл больше 50 МБ — попробуйте с zip.")
+        return
+
+    if total == 0:
+        await update.message.reply_text(f"У пользователя {target_id} нет генераций.")
+
+
+async def admin_queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    m = outbound.metrics()
+    by_priority = ", ".join(
+        f"p{prio}: {depth}" for prio, depth in sorted(m["depth_by_priority"].items())
+    ) or "—"
+    lines = [
+        "📬 Очередь исходящих сообщений",
+        "",
+        f"Работает: {'да' if m['running'] else 'нет'}",
+        f"В очереди: {m['depth']} ({by_priority})",
+        f"Отложено (лимиты / RetryAfter): {m['deferred']}",
+        f"Макс. глубина: {m['max_depth']}",
+        f"Макс. ожидание: {m['max_wait_ms']} мс",
+        f"Отправлено: {m['sent']}, ошибок: {m['failed']}, RetryAfter: {m['retry_after']}",
+        "",
+        "🐢 Отклонено лимитом на пользователя: "
+        + (", ".join(f"{a}: {n}" for a, n in user_limiter.rejected.items()) or "—"),
+        f"📝 Потеряно строк лога (очередь переполнена): {dropped_records()}",
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+
+def _fmt_seconds(value) -> str:
+    return "—" if value is None else f"{value:.1f} с"
+
+
+async def admin_warm_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    lines = [
+        "🔥 Прогрев моделей Replicate",
+        "",
+        f"Часы (UTC): {KEEPWARM_ACTIVE_HOURS[0]}–{KEEPWARM_ACTIVE_HOURS[1]}, "
+        f"потрачено сегодня: ${keepwarm.spent_today_usd:.4f} из ${KEEPWARM_DAILY_BUDGET_USD:.2f}",
+        "",
+    ]
+    for row in keepwarm.report():
+        idle = "не запускалась" if row["idle_s"] is None else f"простой {row['idle_s']} с"
+        flag = "🔥" if row["keepwarm"] else "•"
+        lines.append(f"{flag} {row['model']} — {idle}")
+        lines.append(
+            f"  холодные: {row['cold_runs']} (медиана {_fmt_seconds(row['cold_median_s'])}), "
+            f"тёплые: {row['warm_runs']} (медиана {_fmt_seconds(row['warm_median_s'])})"
+        )
+        if row["keepwarm"]:
+            lines.append(
+                f"  прогревов: {row['warmups']} (ошибок {row['warmup_failures']}, "
+                f"медиана {_fmt_seconds(row['warmup_median_s'])})"
+            )
+    await update.message.reply_text("\n".join(lines))
+
+
+async def admin_models_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    lines = ["🧭 Состояние моделей (последние 15 минут)", ""]
+    for row in routing.report():
+        status = f"⚠️ {row['degraded']}" if row["degraded"] else "✅"
+        lines.append(
+            f"{status} {row['model']}: запусков {row['samples']}, "
+            f"ошибок {row['error_rate']:.0%}, p95 {_fmt_seconds(row['p95_s'])}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+
+# ---------------------------------------------------------
+# MODEL TELEMETRY
+# ---------------------------------------------------------
+
+TELEGRAM_TEXT_LIMIT = 4000
+PERF_METRICS = (
+    ("predict_s", "predict", "с"),
+    ("queue_s", "очередь", "с"),
+    ("total_s", "всего", "с"),
+    ("output_mb", "размер", "МБ"),
+)
+PERF_STATUSES = {"succeeded": "", "failed": "❌ упали", "canceled": "✖️ отменены"}
+
+
+def _fmt_quantiles(sketch, unit: str) -> str:
+    values = [sketch.quantile(q) for q in (0.5, 0.95, 0.99)]
+    return " / ".join(f"{v:.1f}" for v in values) + f" {unit}"
+
+
+def build_perf_text(report, days: int) -> list:
+    """Отчёт телеметрии; длинный — несколькими сообщениями."""
+    lines = [f"⏱ Модели за {days} дн. (p50 / p95 / p99)"]
+    order = {key: i for i, key in enumerate(MODEL_INFO)}
+    statuses = {status: i for i, status in enumerate(PERF_STATUSES)}
+    for (model_key, combo, status), metrics in sorted(
+        report.items(),
+        key=lambda item: (
+            order.get(item[0][0], len(order)), item[0][1], statuses.get(item[0][2], len(statuses))
+        ),
+    ):
+        cfg = MODEL_INFO.get(model_key, {})
+        runs = metrics["total_s"].count if "total_s" in metrics else 0
+        title = f"{cfg.get('emoji', '')} {cfg.get('label', model_key)} · {combo}"
+        if status != "succeeded":
+            title += f" · {PERF_STATUSES.get(status, status)}"
+        lines.append("")
+        lines.append(f"{title} — {runs} запусков")
+        for metric, title, unit in PERF_METRICS:
+            sketch = metrics.get(metric)
+            if sketch is not None and sketch.count:
+                lines.append(f"  {title}: {_fmt_quantiles(sketch, unit)}")
+    if len(lines) == 1:
+        lines.append("\nЗапусков пока не было.")
+
+    chunks, current = [], ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > TELEGRAM_TEXT_LIMIT:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    chunks.append(current)
+    return chunks
+
+
+async def admin_perf_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    days = REPORT_DAYS
+    if context.args:
+        try:
+            days = max(1, min(90, int(context.args[0])))
+        except ValueError:
+            await update.message.reply_text("Использование: /admin_perf [дней]")
+            return
+
+    report = await telemetry.report(days)
+    for text in build_perf_text(report, days):
+        await update.message.reply_text(text)
+
+
+# ---------------------------------------------------------
+# USAGE STATS
+# ---------------------------------------------------------
+# Читаются только дневные сводки (migrations/007): не больше STATS_DAYS × моделей
+# строк, сколько бы ни накопилось генераций.
+
+STATS_DAYS = 30
+STATS_TOP_USERS = 5
+_USAGE_FIELDS = ("users", "generations", "tokens_spent", "purchases", "tokens_purchased")
+
+
+def _model_label(model_id: str) -> str:
+    for cfg in MODEL_INFO.values():
+        if cfg["replicate"] == model_id:
+            return f"{cfg['emoji']} {cfg['label']}"
+    return model_id
+
+
+def _sum_usage(rows) -> dict:
+    return {field: sum(row[field] for row in rows) for field in _USAGE_FIELDS}
+
+
+def _fmt_usage(usage: dict) -> str:
+    text = f"генераций {usage['generations']}, потрачено {usage['tokens_spent']} ток."
+    if usage["purchases"]:
+        text += f", покупок {usage['purchases']} на {usage['tokens_purchased']} ток."
+    return text
+
+
+def build_usage_stats_text(days, top_users, today: str) -> str:
+    totals = [row for row in days if row["model"] == ""]
+    today_total = next((row for row in totals if row["day"] == today), None)
+    week_start = (datetime.fromisoformat(today) - timedelta(days=6)).date().isoformat()
+
+    lines = ["📊 Статистика (UTC)", ""]
+    if today_total:
+        lines.append(f"Сегодня: {_fmt_usage(today_total)}, пользователей {today_total['users']}")
+    else:
+        lines.append("Сегодня: пока ничего.")
+    for row in sorted(
+        (r for r in days if r["day"] == today and r["model"]),
+        key=lambda r: r["tokens_spent"],
+        reverse=True,
+    ):
+        lines.append(
+            f"  {_model_label(row['model'])}: {row['generations']} ген., "
+            f"{row['tokens_spent']} ток., {row['users']} польз."
+        )
+
+    lines.append("")
+    lines.append("7 дней: " + _fmt_usage(_sum_usage([r for r in totals if r["day"] >= week_start])))
+    lines.append(f"{STATS_DAYS} дней: " + _fmt_usage(_sum_usage(totals)))
+
+    by_model: dict = {}
+    for row in days:
+        if row["model"]:
+            by_model.setdefault(row["model"], []).append(row)
+    if by_model:
+        lines.append("")
+        lines.append(f"Модели за {STATS_DAYS} дней (по тратам):")
+        ranked = sorted(by_model.items(), key=lambda item: -sum(r["tokens_spent"] for r in item[1]))
+        for model, rows in ranked:
+            usage = _sum_usage(rows)
+            lines.append(
+                f"  {_model_label(model)}: {usage['tokens_spent']} ток., {usage['generations']} ген."
+            )
+
+    if top_users:
+        lines.append("")
+        lines.append("Топ по тратам сегодня:")
+        for i, row in enumerate(top_users, start=1):
+            lines.append(
+                f"  {i}. {row['user_id']} — {row['tokens_spent']} ток., {row['generations']} ген."
+                + (f", куплено {row['tokens_purchased']}" if row["purchases"] else "")
+            )
+    return "\n".join(lines)
+
+
+async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("У вас нет доступа к этой команде.")
+        return
+
+    today = datetime.now(timezone.utc).date()
+    since = today - timedelta(days=STATS_DAYS - 1)
+    storage = get_storage()
+    days, top_users = await asyncio.gather(
+        storage.fetch_usage_days(since.isoformat()),
+        storage.fetch_top_users(today.isoformat(), limit=STATS_TOP_USERS),
+    )
+    await update.message.reply_text(build_usage_stats_text(days, top_users, today.isoformat()))
 
 
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -88,18 +581,34 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("У вас нет доступа к админ-панели.")
         return
 
-    users = await supabase_fetch_recent_users(limit=20)
-    total = len(users)
+    text, kb = await _build_admin_main()
+
+    context.user_data["admin_search_mode"] = False
+
+    await update.message.reply_text(text, reply_markup=kb)
 
-    text_lines = ["Админ-панель nano-bot 👑", ""]
-    text_lines.append(f"Показаны последние {total} пользователей.")
-    text_lines.append("")
-    text_lines.append("Выберите пользователя, чтобы начислить/списать токены:")
-    kb = build_admin_main_keyboard(users)
+
+async def admin_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Текст после «🔎 Поиск» — запрос поиска, а не промт для генерации."""
+    if not context.user_data.get("admin_search_mode"):
+        return
+    if not update.message or not update.message.text:
+        return
+    if not is_admin(update.effective_user.id):
+        return
 
     context.user_data["admin_search_mode"] = False
+    query_text = update.message.text.strip()
+    users = await get_storage().search_users(query_text, limit=ADMIN_PAGE_SIZE)
 
-    await update.message.reply_text("\n".join(text_lines), reply_markup=kb)
+    if users:
+        text = f"Найдено пользователей: {len(users)} (запрос: {query_text})"
+    else:
+        text = f"По запросу «{query_text}» никого не найдено."
+    await update.message.reply_text(text, reply_markup=build_admin_main_keyboard(users))
+
+    # Не отдаём сообщение пользовательским хендлерам
+    raise ApplicationHandlerStop
 
 
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -119,15 +628,22 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     if data == "admin_back_main":
         await query.answer()
-        users = await supabase_fetch_recent_users(limit=20)
-        total = len(users)
-        text_lines = ["Админ-панель nano-bot 👑", ""]
-        text_lines.append(f"Показаны последние {total} пользователей.")
-        text_lines.append("")
-        text_lines.append("Выберите пользователя, чтобы начислить/списать токены:")
-        kb = build_admin_main_keyboard(users)
+        text, kb = await _build_admin_main()
+        context.user_data["admin_search_mode"] = False
+        await query.message.edit_text(text, reply_markup=kb)
+        return
+
+    if data.startswith("admin_page|"):
+        await query.answer()
+        try:
+            _, direction_flag, cursor = data.split("|", 2)
+            text, kb = await _build_admin_main(
+                cursor, "prev" if direction_flag == "p" else "next"
+            )
+        except ValueError:
+            return
         context.user_data["admin_search_mode"] = False
-        await query.message.edit_text("\n".join(text_lines), reply_markup=kb)
+        await query.message.edit_text(text, reply_markup=kb)
         return
 
     if data == "admin_search_prompt":
@@ -154,33 +670,19 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         except ValueError:
             return
 
-        user = await supabase_get_user(uid)
+        user = await get_storage().get_user(uid)
         if not user:
             await query.message.edit_text("Пользователь не найден.")
             return
 
-        first_name = user.get("first_name") or ""
-        last_name = user.get("last_name") or ""
-        name = (first_name + " " + (last_name or "")).strip() or "Без имени"
-        username = user.get("username")
-        balance = user.get("balance", 0)
-
-        lines = [
-            "Карточка пользователя 👤",
-            "",
-            f"ID: {uid}",
-            f"Имя: {name}",
-            f"Username: @{username}" if username else "Username: —",
-            f"Баланс: {balance} токенов",
-            "",
-            "Начислить / списать токены:",
-        ]
-
         kb = build_admin_user_keyboard(uid)
         context.user_data["admin_search_mode"] = False
-        await query.message.edit_text("\n".join(lines), reply_markup=kb)
+        await query.message.edit_text(build_admin_user_card_text(user), reply_markup=kb)
         return
 
+    # Мутации ниже получают обновлённую строку пользователя прямо из ответа
+    # на запись в журнал токенов и по ней перерисовывают карточку.
+
     if data.startswith("admin_add|"):
         await query.answer()
         try:
@@ -190,50 +692,33 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         except ValueError:
             return
 
-        new_balance = await add_tokens(uid, amount)
-        await log_admin_action(admin_id, uid, "admin_add_button", amount)
+        action_id = await get_storage().log_admin_action(admin_id, uid, "admin_add_button", amount)
+        user = await change_balance(uid, amount, admin_action_id=action_id)
+        if not user:
+            await query.message.edit_text("Пользователь не найден.")
+            return
+        new_balance = user.get("balance", 0)
+        _admin_pages_cache.clear()
 
         await query.answer(
             f"Начислено {amount} токенов (баланс {new_balance})",
             show_alert=False,
         )
 
-        try:
-            await context.bot.send_message(
+        outbound.submit(
+            uid,
+            lambda: context.bot.send_message(
                 chat_id=uid,
                 text=(
                     f"🎉 Ваш баланс пополнен на {amount} токенов.\n"
                     f"Текущий баланс: {new_balance} токенов.\n\n"
                     "Можете продолжать генерации в боте 🙂"
                 ),
-            )
-        except Exception as e:
-            import logging
-            logging.warning("Не удалось отправить уведомление пользователю %s: %s", uid, e)
-
-        user = await supabase_get_user(uid)
-        if not user:
-            await query.message.edit_text("Пользователь не найден.")
-            return
+            ),
+        )
 
-        first_name = user.get("first_name") or ""
-        last_name = user.get("last_name") or ""
-        name = (first_name + " " + (last_name or "")).strip() or "Без имени"
-        username = user.get("username")
-        balance = user.get("balance", 0)
-
-        lines = [
-            "Карточка пользователя 👤",
-            "",
-            f"ID: {uid}",
-            f"Имя: {name}",
-            f"Username: @{username}" if username else "Username: —",
-            f"Баланс: {balance} токенов",
-            "",
-            "Начислить / списать токены:",
-        ]
         kb = build_admin_user_keyboard(uid)
-        await query.message.edit_text("\n".join(lines), reply_markup=kb)
+        await query.message.edit_text(build_admin_user_card_text(user), reply_markup=kb)
         return
 
     if data.startswith("admin_sub|"):
@@ -245,49 +730,32 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         except ValueError:
             return
 
-        new_balance = await subtract_tokens(uid, amount)
-        await log_admin_action(admin_id, uid, "admin_sub_button", -amount)
+        action_id = await get_storage().log_admin_action(admin_id, uid, "admin_sub_button", -amount)
+        user = await change_balance(uid, -amount, admin_action_id=action_id)
+        if not user:
+            await query.message.edit_text("Пользователь не найден.")
+            return
+        new_balance = user.get("balance", 0)
+        _admin_pages_cache.clear()
 
         await query.answer(
             f"Списано {amount} токенов (баланс {new_balance})",
             show_alert=False,
         )
 
-        try:
-            await context.bot.send_message(
+        outbound.submit(
+            uid,
+            lambda: context.bot.send_message(
                 chat_id=uid,
                 text=(
                     f"⚠️ С вашего баланса списано {amount} токенов.\n"
                     f"Текущий баланс: {new_balance} токенов."
                 ),
-            )
-        except Exception as e:
-            import logging
-            logging.warning("Не удалось отправить уведомление пользователю %s: %s", uid, e)
-
-        user = await supabase_get_user(uid)
-        if not user:
-            await query.message.edit_text("Пользователь не найден.")
-            return
+            ),
+        )
 
-        first_name = user.get("first_name") or ""
-        last_name = user.get("last_name") or ""
-        name = (first_name + " " + (last_name or "")).strip() or "Без имени"
-        username = user.get("username")
-        balance = user.get("balance", 0)
-
-        lines = [
-            "Карточка пользователя 👤",
-            "",
-            f"ID: {uid}",
-            f"Имя: {name}",
-            f"Username: @{username}" if username else "Username: —",
-            f"Баланс: {balance} токенов",
-            "",
-            "Начислить / списать токены:",
-        ]
         kb = build_admin_user_keyboard(uid)
-        await query.message.edit_text("\n".join(lines), reply_markup=kb)
+        await query.message.edit_text(build_admin_user_card_text(user), reply_markup=kb)
         return
 
     if data.startswith("admin_zero|"):
@@ -298,50 +766,50 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         except ValueError:
             return
 
-        await set_balance(uid, 0)
-        await log_admin_action(admin_id, uid, "admin_zero_button", 0)
-        new_balance = 0
+        action_id = await get_storage().log_admin_action(admin_id, uid, "admin_zero_button", 0)
+        user = await set_balance(uid, 0, admin_action_id=action_id)
+        if not user:
+            await query.message.edit_text("Пользователь не найден.")
+            return
+        _admin_pages_cache.clear()
 
         await query.answer("Баланс пользователя обнулён", show_alert=False)
 
-        try:
-            await context.bot.send_message(
+        outbound.submit(
+            uid,
+            lambda: context.bot.send_message(
                 chat_id=uid,
                 text="🧹 Ваш баланс был обнулён администратором.",
-            )
-        except Exception as e:
-            import logging
-            logging.warning("Не удалось отправить уведомление пользователю %s: %s", uid, e)
-
-        user = await supabase_get_user(uid)
-        if not user:
-            await query.message.edit_text("Пользователь не найден.")
-            return
+            ),
+        )
 
-        first_name = user.get("first_name") or ""
-        last_name = user.get("last_name") or ""
-        name = (first_name + " " + (last_name or "")).strip() or "Без имени"
-        username = user.get("username")
-
-        lines = [
-            "Карточка пользователя 👤",
-            "",
-            f"ID: {uid}",
-            f"Имя: {name}",
-            f"Username: @{username}" if username else "Username: —",
-            f"Баланс: {new_balance} токенов",
-            "",
-            "Начислить / списать токены:",
-        ]
         kb = build_admin_user_keyboard(uid)
-        await query.message.edit_text("\n".join(lines), reply_markup=kb)
+        await query.message.edit_text(build_admin_user_card_text(user), reply_markup=kb)
         return
 
 
 def register_admin_handlers(app: Application) -> None:
-    app.add_handler(CommandHandler("admin", admin_command))
-    app.add_handler(CommandHandler("admin_help", admin_help_command))
-    app.add_handler(CommandHandler("add_tokens", add_tokens_command))
+    admin = with_deadline(DEADLINE_ADMIN)
+
+    # Группа -1: поисковый запрос админа перехватывается раньше промтов
+    app.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, admin(admin_search_text)), group=-1
+    )
+
+    app.add_handler(CommandHandler("admin", admin(admin_command)))
+    app.add_handler(CommandHandler("admin_help", admin(admin_help_command)))
+    app.add_handler(CommandHandler("add_tokens", admin(add_tokens_command)))
+    app.add_handler(CommandHandler("bulk_grant", admin(bulk_grant_command)))
+    app.add_handler(CommandHandler("admin_queue", admin(admin_queue_command)))
+    app.add_handler(CommandHandler("admin_warm", admin(admin_warm_command)))
+    app.add_handler(CommandHandler("admin_models", admin(admin_models_command)))
+    app.add_handler(CommandHandler("admin_stats", admin(admin_stats_command)))
+    app.add_handler(CommandHandler("admin_perf", admin(admin_perf_command)))
+    app.add_handler(
+        CommandHandler("export_user", with_deadline(DEADLINE_EXPORT)(export_user_command))
+    )
 
-    # Обязательно до settings_callback (pattern="^admin_")
-    app.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
+    # Обязательно до settings_callback (pattern="^admin_").
+    # Подтверждённое массовое начисление идёт без дедлайна: пачки нельзя бросать на полпути
+    app.add_handler(CallbackQueryHandler(admin_bulk_callback, pattern=r"^admin_bulk\|"))
+    app.add_handler(CallbackQueryHandler(admin(admin_callback), pattern="^admin_"))
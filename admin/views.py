@@ -1,8 +1,12 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 
-def build_admin_main_keyboard(users: List[Dict]) -> InlineKeyboardMarkup:
+def build_admin_main_keyboard(
+    users: List[Dict],
+    next_cursor: Optional[str] = None,
+    prev_cursor: Optional[str] = None,
+) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
 
     for u in users:
@@ -17,11 +21,45 @@ def build_admin_main_keyboard(users: List[Dict]) -> InlineKeyboardMarkup:
     if not rows:
         rows = [[InlineKeyboardButton("Нет пользователей", callback_data="admin_none")]]
 
+    # ---- keyset-пагинация ----
+    nav_row = []
+    if prev_cursor:
+        nav_row.append(
+            InlineKeyboardButton("⬅️ Новее", callback_data=f"admin_page|p|{prev_cursor}")
+        )
+    if next_cursor:
+        nav_row.append(
+            InlineKeyboardButton("Старее ➡️", callback_data=f"admin_page|n|{next_cursor}")
+        )
+    if nav_row:
+        rows.append(nav_row)
+
     rows.append([InlineKeyboardButton("🔎 Поиск", callback_data="admin_search_prompt")])
 
     return InlineKeyboardMarkup(rows)
 
 
+def build_admin_user_card_text(user: Dict) -> str:
+    uid = user["id"]
+    first_name = user.get("first_name") or ""
+    last_name = user.get("last_name") or ""
+    name = (first_name + " " + (last_name or "")).strip() or "Без имени"
+    username = user.get("username")
+    balance = user.get("balance", 0)
+
+    lines = [
+        "Карточка пользователя 👤",
+        "",
+        f"ID: {uid}",
+        f"Имя: {name}",
+        f"Username: @{username}" if username else "Username: —",
+        f"Баланс: {balance} токенов",
+        "",
+        "Начислить / списать токены:",
+    ]
+    return "\n".join(lines)
+
+
 def build_admin_user_keyboard(uid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -0,0 +1,289 @@
+import asyncio
+import base64
+import binascii
+import logging
+from typing import Dict, List, Optional
+
+import httpx
+from aiohttp import web
+
+from config import MODEL_INFO
+from core import deadline, inflight
+from core.api_tokens import verify_api_token
+from core.balance import get_balance, get_effective_cost, settle_generation
+from core.deadline import DEADLINE_COMMAND, DEADLINE_GENERATION
+from core.generators import run_model
+from core.http import get_http_client
+from core.references import prepare_reference_bytes
+from core.resilience import CircuitOpenError
+from core.settings import DEFAULT_SETTINGS
+from core.storage import get_storage
+from core.throttle import user_limiter
+from utils.logging_config import bind_log_context
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# HTTP API (Photoshop-плагин)
+# ---------------------------------------------------------
+# Поднимается внутри процесса бота (main.post_init) при заданном API_PORT и
+# делит с ним всё: httpx-пул, клиент Replicate, кэш референсов, лимиты,
+# circuit breaker'ы и журнал токенов. Авторизация — токен из /ps_token
+# в заголовке "Authorization: Bearer ps_...".
+#
+#   GET  /api/balance
+#   GET  /api/history?cursor=&direction=next|prev&limit=
+#   POST /api/generate   {"prompt", "model", "settings": {...}, "images": [base64]}
+#   POST /api/remove_bg  {"image": base64}
+#
+# Генерация отвечает JSON со ссылкой; с ?stream=1 или "Accept: image/*" —
+# самой картинкой, которая проксируется из Replicate по мере скачивания.
+
+API_MAX_BODY = 40 * 1024 * 1024
+API_MAX_IMAGES = 4
+API_HISTORY_MAX_LIMIT = 50
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_TIMEOUT = 60.0
+
+
+def _error(status: int, code: str, message: str, headers: Optional[Dict] = None) -> web.Response:
+    return web.json_response({"error": code, "message": message}, status=status, headers=headers)
+
+
+@web.middleware
+async def _errors_middleware(request: web.Request, handler) -> web.StreamResponse:
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except deadline.DeadlineExceeded:
+        return _error(504, "timeout", "Не уложились в отведённое время, попробуйте ещё раз.")
+    except (CircuitOpenError, httpx.TransportError, asyncio.TimeoutError) as e:
+        logger.warning("API %s: dependency failure: %r", request.path, e)
+        return _error(503, "unavailable", "Сервис временно недоступен, попробуйте позже.")
+    except Exception:
+        logger.exception("API %s: unhandled error", request.path)
+        return _error(500, "internal", "Внутренняя ошибка.")
+
+
+@web.middleware
+async def _auth_middleware(request: web.Request, handler) -> web.StreamResponse:
+    header = request.headers.get("Authorization", "")
+    token = header[len("Bearer "):].strip() if header.startswith("Bearer ") else ""
+    user_id = await verify_api_token(token)
+    if user_id is None:
+        return _error(401, "unauthorized", "Неверный или просроченный токен, получите новый через /ps_token.")
+    request["user_id"] = user_id
+    bind_log_context(user_id=user_id)
+    return await handler(request)
+
+
+def _rate_limited(user_id: int, action: str) -> Optional[web.Response]:
+    wait = user_limiter.hit(action, user_id)
+    if wait <= 0:
+        return None
+    return _error(
+        429, "rate_limited", "Слишком много запросов, подождите немного.",
+        headers={"Retry-After": str(max(1, round(wait)))},
+    )
+
+
+def _decode_image(value: object) -> bytes:
+    """Картинка из JSON: base64 или data URI."""
+    if not isinstance(value, str) or not value:
+        raise ValueError("image must be a base64 string")
+    if value.startswith("data:"):
+        value = value.partition(",")[2]
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise ValueError("image is not valid base64") from None
+
+
+def _build_settings(body: Dict, model_key: str) -> Dict:
+    overrides = body.get("settings") or {}
+    if not isinstance(overrides, dict):
+        raise ValueError("settings must be an object")
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({k: str(v) for k, v in overrides.items() if k in DEFAULT_SETTINGS})
+    settings["model"] = model_key
+    return settings
+
+
+def _wants_stream(request: web.Request) -> bool:
+    if request.query.get("stream") in ("1", "true"):
+        return True
+    return request.headers.get("Accept", "").startswith("image/")
+
+
+# ---------------------------------------------------------
+# HANDLERS
+# ---------------------------------------------------------
+
+async def balance_handler(request: web.Request) -> web.Response:
+    balance = await deadline.run_with_deadline(DEADLINE_COMMAND, get_balance(request["user_id"]))
+    return web.json_response({"balance": balance})
+
+
+async def history_handler(request: web.Request) -> web.Response:
+    direction = request.query.get("direction", "next")
+    if direction not in ("next", "prev"):
+        return _error(400, "bad_request", "direction: next или prev")
+    try:
+        limit = min(API_HISTORY_MAX_LIMIT, max(1, int(request.query.get("limit", "20"))))
+    except ValueError:
+        return _error(400, "bad_request", "limit должен быть числом")
+
+    rows, next_cursor, prev_cursor = await deadline.run_with_deadline(
+        DEADLINE_COMMAND,
+        get_storage().fetch_generations_page(
+            request["user_id"], request.query.get("cursor") or None, direction, limit
+        ),
+    )
+    return web.json_response(
+        {"items": rows, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+    )
+
+
+async def _stream_image(request: web.Request, image_url: str, meta: Dict) -> web.StreamResponse:
+    """Проксирует результат из Replicate, не держа файл в памяти целиком."""
+    client = get_http_client()
+    async with client.stream(
+        "GET", image_url, timeout=STREAM_TIMEOUT, follow_redirects=True
+    ) as upstream:
+        upstream.raise_for_status()
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": upstream.headers.get("content-type", "application/octet-stream"),
+                "X-Image-Url": image_url,
+                "X-Model": meta["model"],
+                "X-Tokens-Spent": str(meta["tokens_spent"]),
+                "X-Balance": str(meta["balance"]),
+            }
+        )
+        length = upstream.headers.get("content-length")
+        if length and length.isdigit():
+            response.content_length = int(length)
+        await response.prepare(request)
+        async for chunk in upstream.aiter_bytes(STREAM_CHUNK_SIZE):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+async def _generate(request: web.Request, model_key: str, prompt: str, images: List) -> web.StreamResponse:
+    user_id = request["user_id"]
+    if len(images) > API_MAX_IMAGES:
+        return _error(400, "bad_request", f"Не больше {API_MAX_IMAGES} картинок за запрос")
+
+    limited = _rate_limited(user_id, "generation")
+    if limited is not None:
+        return limited
+
+    body = request["body"]
+    settings = _build_settings(body, model_key)
+    raw_images = [_decode_image(item) for item in images]
+
+    cost, _ = await get_effective_cost(user_id, settings)
+    balance = await get_balance(user_id)
+    if cost > 0 and balance < cost:
+        return web.json_response(
+            {
+                "error": "insufficient_balance",
+                "message": f"Недостаточно токенов: нужно {cost}, у вас {balance}.",
+                "cost": cost,
+                "balance": balance,
+            },
+            status=402,
+        )
+
+    image_urls = list(
+        await asyncio.gather(*(prepare_reference_bytes(raw, model_key) for raw in raw_images))
+    ) or None
+
+    route: Dict = {}
+    # Ответ клиенту после рестарта не отправить — результат придёт в чат с ботом
+    async with inflight.track(user_id, user_id, prompt, settings, cost):
+        image_url = await run_model(prompt, settings, image_urls=image_urls, route=route)
+
+        # Replicate уже выставил счёт — проводим генерацию независимо от дедлайна
+        used_cost, new_balance = await deadline.run_to_completion(
+            settle_generation(user_id, prompt, image_url, settings, cost, route=route, balance=balance)
+        )
+    meta = {
+        "image_url": image_url,
+        "model": route.get("model", model_key),
+        "requested_model": model_key,
+        "tokens_spent": used_cost,
+        "balance": new_balance,
+    }
+    if _wants_stream(request):
+        return await _stream_image(request, image_url, meta)
+    return web.json_response(meta)
+
+
+async def _read_body(request: web.Request) -> Dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise ValueError("body must be JSON") from None
+    if not isinstance(body, dict):
+        raise ValueError("body must be a JSON object")
+    request["body"] = body
+    return body
+
+
+async def generate_handler(request: web.Request) -> web.StreamResponse:
+    try:
+        body = await _read_body(request)
+        model_key = body.get("model") or DEFAULT_SETTINGS["model"]
+        if model_key not in MODEL_INFO or model_key == "remove_bg":
+            return _error(400, "bad_request", f"Неизвестная модель: {model_key}")
+        prompt = str(body.get("prompt") or "").strip()
+        if not prompt:
+            return _error(400, "bad_request", "Пустой prompt")
+        images = body.get("images") or []
+        if not isinstance(images, list):
+            return _error(400, "bad_request", "images должен быть списком")
+        return await deadline.run_with_deadline(
+            DEADLINE_GENERATION, _generate(request, model_key, prompt, images)
+        )
+    except ValueError as e:
+        return _error(400, "bad_request", str(e))
+
+
+async def remove_bg_handler(request: web.Request) -> web.StreamResponse:
+    try:
+        body = await _read_body(request)
+        if not body.get("image"):
+            return _error(400, "bad_request", "Нужна картинка в поле image")
+        return await deadline.run_with_deadline(
+            DEADLINE_GENERATION,
+            _generate(request, "remove_bg", "remove background", [body["image"]]),
+        )
+    except ValueError as e:
+        return _error(400, "bad_request", str(e))
+
+
+# ---------------------------------------------------------
+# SERVER
+# ---------------------------------------------------------
+
+def build_api_app() -> web.Application:
+    app = web.Application(
+        client_max_size=API_MAX_BODY,
+        middlewares=[_errors_middleware, _auth_middleware],
+    )
+    app.router.add_get("/api/balance", balance_handler)
+    app.router.add_get("/api/history", history_handler)
+    app.router.add_post("/api/generate", generate_handler)
+    app.router.add_post("/api/remove_bg", remove_bg_handler)
+    return app
+
+
+async def start_api_server(port: int) -> web.AppRunner:
+    runner = web.AppRunner(build_api_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    logger.info("HTTP API listening on :%s", port)
+    return runner
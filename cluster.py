@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import time
+from typing import List, Optional
+
+from aiohttp import web
+from telegram import Bot, Update
+
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    BOT_WORKERS,
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    PORT,
+    STATE_DIR,
+    validate_config,
+)
+from core.sharding import HashRing, routing_key
+from utils.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# CLUSTER MODE
+# ---------------------------------------------------------
+# python cluster.py — лёгкий фронт принимает webhook Telegram и раскладывает
+# апдейты по N воркерам (отдельные процессы, у каждого своё ядро) по
+# консистентному хешу user_id. Воркер — обычное приложение PTB из main.py.
+#
+# - пользователь закреплён за слотом воркера: его user_data живёт там;
+# - user_data слота сохраняется в STATE_DIR/worker-<slot>.pickle, упавший
+#   воркер перезапускается в тот же слот с той же очередью — апдейты,
+#   пришедшие за время рестарта, ждут в ней, настройки восстанавливаются;
+# - очередь слота переполнена — отвечаем 503, Telegram повторит доставку.
+
+WORKER_QUEUE_SIZE = 10_000
+SUPERVISE_INTERVAL = 2.0
+RESTART_DELAY = 1.0
+SHUTDOWN_TIMEOUT = 30.0
+PARENT_CHECK_INTERVAL = 1.0
+WEBHOOK_PATH = "/webhook"
+
+
+# ---------------------------------------------------------
+# WORKER PROCESS
+# ---------------------------------------------------------
+
+def _worker_main(slot: int, workers: int, updates: "mp.Queue", parent_pid: int) -> None:
+    # Останавливает воркеры фронт (через очередь), а не сигнал группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging(worker=slot)
+    asyncio.run(_serve_worker(slot, workers, updates, parent_pid))
+
+
+def _next_update(updates: "mp.Queue", parent_pid: int) -> Optional[dict]:
+    while True:
+        try:
+            return updates.get(timeout=PARENT_CHECK_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                logger.error("Front process is gone, worker exits")
+                return None
+
+
+async def _serve_worker(slot: int, workers: int, updates: "mp.Queue", parent_pid: int) -> None:
+    from telegram.ext import PicklePersistence
+
+    import main as bot_main
+    from core import inflight
+    from core.telemetry import telemetry
+    from core.outbound import outbound, GLOBAL_RATE
+
+    os.makedirs(STATE_DIR, exist_ok=True)
+    persistence = PicklePersistence(
+        os.path.join(STATE_DIR, f"worker-{slot}.pickle"), update_interval=30
+    )
+    # Журнал генераций и телеметрию слот ведёт под своим номером:
+    # прерванные генерации разбирает только свои, чужие ещё могут быть в работе
+    inflight.set_worker(slot)
+    telemetry.worker = slot
+    # Компакцию журнала токенов достаточно крутить в одном воркере
+    application = bot_main.build_application(persistence=persistence, background_jobs=slot == 0)
+    # Лимит Telegram ~30 сообщений/с — на бота целиком, делим между воркерами
+    outbound.set_global_rate(GLOBAL_RATE / workers)
+
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    logger.info("Worker %s/%s ready (pid %s)", slot, workers, os.getpid())
+    try:
+        while True:
+            data = await loop.run_in_executor(None, _next_update, updates, parent_pid)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        logger.info("Worker %s stopped", slot)
+
+
+# ---------------------------------------------------------
+# FRONT
+# ---------------------------------------------------------
+
+class Cluster:
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.ring = HashRing(range(workers))
+        self._ctx = mp.get_context("spawn")
+        self._queues = [self._ctx.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self._processes: List[Optional[mp.Process]] = [None] * workers
+        self._restarts = [0] * workers
+        self._stopping = False
+
+    def _spawn(self, slot: int) -> None:
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(slot, self.workers, self._queues[slot], os.getpid()),
+            name=f"bot-worker-{slot}",
+            daemon=True,
+        )
+        proc.start()
+        self._processes[slot] = proc
+        logger.info("Worker %s started (pid %s)", slot, proc.pid)
+
+    def start(self) -> None:
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+    async def supervise(self) -> None:
+        """Перезапускает упавшие воркеры в их же слот."""
+        while not self._stopping:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for slot, proc in enumerate(self._processes):
+                if self._stopping or proc is None or proc.is_alive():
+                    continue
+                self._restarts[slot] += 1
+                logger.error(
+                    "Worker %s died (exit code %s), restart #%s",
+                    slot, proc.exitcode, self._restarts[slot],
+                )
+                await asyncio.sleep(RESTART_DELAY)
+                self._spawn(slot)
+
+    def dispatch(self, update: dict) -> bool:
+        """Кладёт апдейт в очередь его воркера. False — очередь переполнена."""
+        slot = self.ring.node_for(routing_key(update))
+        try:
+            self._queues[slot].put_nowait(update)
+        except queue.Full:
+            logger.warning("Worker %s queue is full, update %s deferred", slot, update.get("update_id"))
+            return False
+        return True
+
+    def status(self) -> List[dict]:
+        return [
+            {
+                "slot": slot,
+                "pid": proc.pid if proc else None,
+                "alive": bool(proc and proc.is_alive()),
+                "restarts": self._restarts[slot],
+            }
+            for slot, proc in enumerate(self._processes)
+        ]
+
+    async def stop(self) -> None:
+        """Мягкая остановка: воркеры дорабатывают очередь и сохраняют user_data."""
+        self._stopping = True
+        for q in self._queues:
+            q.put(None)
+
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for proc in self._processes:
+            if proc is None:
+                continue
+            await loop.run_in_executor(None, proc.join, max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                logger.warning("Worker %s did not stop in time, terminating", proc.name)
+                proc.terminate()
+
+
+def _build_front(cluster: Cluster) -> web.Application:
+    async def webhook(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not cluster.dispatch(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def healthz(request: web.Request) -> web.Response:
+        workers = cluster.status()
+        ok = all(w["alive"] for w in workers)
+        return web.json_response({"ok": ok, "workers": workers}, status=200 if ok else 503)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook)
+    app.router.add_get("/healthz", healthz)
+    return app
+
+
+async def run_cluster(workers: int) -> None:
+    cluster = Cluster(workers)
+    cluster.start()
+    supervisor = asyncio.create_task(cluster.supervise())
+
+    runner = web.AppRunner(_build_front(cluster))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    logger.info("Front listening on :%s, %s workers", PORT, workers)
+
+    async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info("Shutting down cluster")
+    await runner.cleanup()
+    supervisor.cancel()
+    await cluster.stop()
+
+
+def main() -> None:
+    setup_logging()
+    validate_config()
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_URL and WEBHOOK_SECRET are required in cluster mode")
+
+    asyncio.run(run_cluster(BOT_WORKERS))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import os
-from typing import List
+from typing import List, Tuple
 
 # ---------------------------------------------------------
 # ENV
@@ -19,16 +19,74 @@ if ADMIN_IDS_RAW:
     except Exception:
         pass
 
-if not TELEGRAM_BOT_TOKEN:
-    raise ValueError("TELEGRAM_BOT_TOKEN not set")
 
-if not REPLICATE_API_TOKEN:
-    raise ValueError("REPLICATE_API_TOKEN not set")
+def _parse_rate(value: str) -> Tuple[int, float]:
+    """'6/60' -> (6, 60.0): не больше 6 действий за 60 секунд."""
+    count, _, seconds = value.partition("/")
+    return int(count), float(seconds or 1)
 
-if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-    raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not set")
 
-SUPABASE_REST_URL = SUPABASE_URL.rstrip("/") + "/rest/v1"
+def _parse_hours(value: str) -> Tuple[int, int]:
+    """'6-22' -> (6, 22): с 6:00 до 22:00."""
+    start, _, end = value.partition("-")
+    return int(start), int(end or 24)
+
+
+# Лимиты на пользователя по классам действий, env RATE_LIMIT_<CLASS>=N/секунд
+RATE_LIMITS = {
+    "generation": _parse_rate(os.getenv("RATE_LIMIT_GENERATION", "6/60")),
+    "callback": _parse_rate(os.getenv("RATE_LIMIT_CALLBACK", "20/10")),
+    "command": _parse_rate(os.getenv("RATE_LIMIT_COMMAND", "10/10")),
+    "payment": _parse_rate(os.getenv("RATE_LIMIT_PAYMENT", "5/60")),
+}
+
+# Прогрев моделей Replicate (core/keepwarm.py): часы UTC "с-по" и дневной бюджет
+KEEPWARM_ACTIVE_HOURS = _parse_hours(os.getenv("KEEPWARM_ACTIVE_HOURS", "6-22"))
+KEEPWARM_DAILY_BUDGET_USD = float(os.getenv("KEEPWARM_DAILY_BUDGET_USD", "0.5"))
+
+# HTTP API для Photoshop-плагина (api/server.py); 0 — не поднимать.
+# PS_API_BASE_URL — адрес, который /ps_token подсказывает пользователю.
+API_PORT = int(os.getenv("API_PORT", "0") or 0)
+PS_API_BASE_URL = os.getenv("PS_API_BASE_URL", "https://nanobot.glebmishin72.workers.dev")
+# Ключ HMAC для хешей токенов плагина (core/api_tokens.py). Если не задан —
+# SUPABASE_SERVICE_ROLE_KEY; смена ключа делает все выданные токены недействительными.
+API_TOKEN_SECRET = os.getenv("API_TOKEN_SECRET")
+
+# Кластерный режим (cluster.py): webhook-фронт + N воркеров
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0") or 0) or (os.cpu_count() or 1)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+PORT = int(os.getenv("PORT", "8080"))
+STATE_DIR = os.getenv("STATE_DIR", "state")
+
+# Хранилище (core/storage.py): supabase (по умолчанию) или sqlite —
+# встроенная база в файле SQLITE_PATH, без внешних сервисов.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH") or os.path.join(STATE_DIR, "nano_bot.sqlite3")
+
+
+def validate_config() -> None:
+    """
+    Проверка обязательных переменных окружения. Вызывается из main() при запуске,
+    а не при импорте: модули можно импортировать (профилировать, проверять) без секретов.
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        raise ValueError("TELEGRAM_BOT_TOKEN not set")
+
+    if not REPLICATE_API_TOKEN:
+        raise ValueError("REPLICATE_API_TOKEN not set")
+
+    if STORAGE_BACKEND == "supabase":
+        if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
+            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not set")
+    elif STORAGE_BACKEND == "sqlite":
+        if not API_TOKEN_SECRET and not SUPABASE_SERVICE_ROLE_KEY:
+            raise ValueError("API_TOKEN_SECRET not set (required with STORAGE_BACKEND=sqlite)")
+    else:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+
+SUPABASE_REST_URL = (SUPABASE_URL or "").rstrip("/") + "/rest/v1"
 SUPABASE_HEADERS_BASE = {
     "apikey": SUPABASE_SERVICE_ROLE_KEY,
     "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
@@ -39,6 +97,12 @@ SUPABASE_HEADERS_BASE = {
 # MODELS CONFIG
 # ---------------------------------------------------------
 
+# 1x1 PNG — вход для прогревочных запусков
+WARMUP_IMAGE = (
+    "data:image/png;base64,"
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
 MODEL_INFO = {
     "banana": {
         "key": "banana",
@@ -47,6 +111,14 @@ MODEL_INFO = {
         "replicate": "google/nano-banana",
         "base_cost": 50,
         "pricing_text": "50 токенов за изображение",
+        "input_max_side": 1536,  # px: больше модель всё равно не использует
+        # Если banana тормозит или падает — генерируем на PRO по цене banana
+        "fallbacks": ["banana_pro"],
+        "routing": {
+            "p95_max": 45.0,         # сек
+            "error_rate_max": 0.3,
+            "fail_after": 60.0,      # сек: дольше не ждём, переключаемся на запасную
+        },
     },
     "banana_pro": {
         "key": "banana_pro",
@@ -55,6 +127,8 @@ MODEL_INFO = {
         "replicate": "google/nano-banana-pro",
         "base_cost": 150,  # 150 токенов (1K/2K), 300 токенов (4K)
         "pricing_text": "150 токенов (1K/2K), 300 токенов (4K)",
+        "input_max_side": 3072,
+        "routing": {"p95_max": 90.0, "error_rate_max": 0.3},
     },
     "flux_ultra": {
         "key": "flux_ultra",
@@ -63,6 +137,7 @@ MODEL_INFO = {
         "replicate": "black-forest-labs/flux-1.1-pro-ultra",
         "base_cost": 80,  # ~0.12$ при x2 от себестоимости 0.06$
         "pricing_text": "80 токенов за изображение",
+        "input_max_side": 2048,
     },
     "remove_bg": {
         "key": "remove_bg",
@@ -71,6 +146,15 @@ MODEL_INFO = {
         "replicate": "lucataco/remove-bg:95fcc2a26d3899cd6c2691c900465aaeff466285a65c14638cc5f36f34befaf1",
         "base_cost": 1,
         "pricing_text": "5 бесплатных в день, затем 1₽",
+        "input_max_side": 2048,
+        # Community-модель на своём железе: после простоя выгружается и грузится
+        # заново. Официальные модели выше всегда тёплые и оплачиваются за картинку —
+        # греть их незачем и дорого.
+        "keepwarm": {
+            "idle_after": 240,       # сек простоя, после которых модель считаем остывшей
+            "cost_usd": 0.0005,      # оценка стоимости одного прогрева
+            "payload": {"image": WARMUP_IMAGE},
+        },
     },
 }
 
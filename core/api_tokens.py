@@ -1,23 +1,53 @@
 import datetime
+import hashlib
+import hmac
+import logging
 import secrets
-from typing import Optional
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
-import httpx
+from config import SUPABASE_SERVICE_ROLE_KEY, API_TOKEN_SECRET
+from .cache import TTLCache
+from .storage import get_storage
 
-from config import SUPABASE_REST_URL, SUPABASE_SERVICE_ROLE_KEY
+logger = logging.getLogger(__name__)
 
-SUPABASE_HEADERS = {
-    "apikey": SUPABASE_SERVICE_ROLE_KEY,
-    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-    "Content-Type": "application/json",
-}
+# ---------------------------------------------------------
+# STORAGE
+# ---------------------------------------------------------
+# В api_tokens хранится не сам токен, а HMAC-SHA256 от него (ключ —
+# API_TOKEN_SECRET) и короткий префикс для поиска строки (migrations/006).
+# Утечка таблицы не даёт рабочих токенов, а префикс пользователь видит
+# в /ps_token и может отозвать конкретный токен через /ps_revoke <префикс>.
+# Старые строки с открытым токеном переводятся на хеш при первой проверке.
 
+TOKEN_PREFIX = "ps_"
+LOOKUP_PREFIX_LEN = 8
 
-def _generate_token(prefix: str = "ps_", length: int = 32) -> str:
+
+def _generate_token(prefix: str = TOKEN_PREFIX, length: int = 32) -> str:
     """Генерируем токен вида ps_xxx, который будем отдавать пользователю."""
     return prefix + secrets.token_urlsafe(length)
 
 
+def _hash_token(token: str) -> str:
+    key = (API_TOKEN_SECRET or SUPABASE_SERVICE_ROLE_KEY or "").encode()
+    return hmac.new(key, token.encode(), hashlib.sha256).hexdigest()
+
+
+def token_lookup_prefix(token: str) -> str:
+    return token[len(TOKEN_PREFIX):len(TOKEN_PREFIX) + LOOKUP_PREFIX_LEN]
+
+
+def _parse_expires(expires_at: Optional[str]) -> Optional[datetime.datetime]:
+    if not expires_at:
+        return None
+    expires = datetime.datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
+    if expires.tzinfo is None:
+        expires = expires.replace(tzinfo=datetime.timezone.utc)
+    return expires
+
+
 async def create_api_token_for_user(
     user_id: int,
     scope: str = "photoshop",
@@ -25,7 +55,8 @@ async def create_api_token_for_user(
 ) -> str:
     """
     Создаёт новый токен для пользователя в таблице api_tokens и возвращает его строкой.
-    Старые токены НЕ отключаем (при желании можно сделать отдельную команду /ps_revoke).
+    Старые токены НЕ отключаем — для этого есть /ps_revoke.
+    Сам токен не сохраняется: показать его повторно нельзя, только выпустить новый.
     """
     token = _generate_token()
 
@@ -37,19 +68,149 @@ async def create_api_token_for_user(
 
     payload = {
         "user_id": user_id,
-        "token": token,
+        "token_hash": _hash_token(token),
+        "token_prefix": token_lookup_prefix(token),
         "scope": scope,
     }
     if expires_at:
         payload["expires_at"] = expires_at
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.post(
-            f"{SUPABASE_REST_URL}/api_tokens",
-            headers=SUPABASE_HEADERS,
-            json=payload,
-        )
-        # если что-то пошло не так — пусть упадёт, чтобы мы увидели ошибку в логах
-        resp.raise_for_status()
-
+    await get_storage().insert_api_token(payload)
     return token
+
+
+# ---------------------------------------------------------
+# VERIFICATION CACHE
+# ---------------------------------------------------------
+# Плагин присылает токен в каждом запросе — без кэша это запрос в хранилище
+# на каждый вызов API. Кэш по хешу токена:
+# - известный токен живёт POSITIVE_TTL, но не дольше своего expires_at;
+# - неизвестный/отозванный — NEGATIVE_TTL (перебор токенов не долбит базу).
+# /ps_revoke чистит записи пользователя сразу. В кластере API работает
+# в воркере 0, а /ps_revoke — в воркере пользователя, поэтому попадание
+# в кэш раз в REVOCATION_POLL сверяет самый свежий revoked_at в хранилище
+# (один запрос на все токены, migrations/016): новый отзыв — кэш сбрасывается.
+# Отозванный в другом воркере токен работает не дольше REVOCATION_POLL.
+
+POSITIVE_TTL = 300.0
+NEGATIVE_TTL = 60.0
+VERIFY_CACHE_SIZE = 10_000
+REVOCATION_POLL = 5.0
+
+# token_hash -> (user_id, scope) | None
+_verified = TTLCache(maxsize=VERIFY_CACHE_SIZE, ttl=POSITIVE_TTL)
+# user_id -> хеши его токенов, попавших в кэш (для отзыва)
+_cached_hashes: Dict[int, Set[str]] = {}
+# Последний увиденный отзыв и когда сверялись (time.monotonic)
+_last_revocation: Optional[str] = None
+_revocations_checked_at = -REVOCATION_POLL
+
+
+def _positive_ttl(expires: Optional[datetime.datetime]) -> float:
+    if expires is None:
+        return POSITIVE_TTL
+    left = (expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return min(POSITIVE_TTL, left)
+
+
+async def _lookup(token: str, token_hash: str) -> Tuple[Optional[Dict], str]:
+    """Активная строка токена (или None) и столбец, по которому она найдена."""
+    storage = get_storage()
+    for row in await storage.find_api_tokens(token_lookup_prefix(token)):
+        if hmac.compare_digest(row.get("token_hash") or "", token_hash):
+            return row, "token_hash"
+
+    # Токены, выпущенные до migrations/006, лежат в открытом виде
+    row = await storage.find_legacy_api_token(token)
+    return (row, "token") if row else (None, "")
+
+
+async def _upgrade_legacy_row(row_id: int, token: str) -> None:
+    try:
+        await get_storage().update_api_token(row_id, {
+            "token": None,
+            "token_hash": _hash_token(token),
+            "token_prefix": token_lookup_prefix(token),
+        })
+    except Exception as e:
+        logger.warning("Could not hash legacy api token %s: %s", row_id, e)
+
+
+async def _sync_revocations() -> None:
+    """Сбрасывает кэш, если с прошлой сверки где-то отозвали токен."""
+    global _last_revocation, _revocations_checked_at
+    now = time.monotonic()
+    if now - _revocations_checked_at < REVOCATION_POLL:
+        return
+    # отметка до запроса: параллельные проверки не сверяются повторно
+    _revocations_checked_at = now
+    try:
+        last = await get_storage().last_api_token_revocation()
+    except Exception as e:
+        logger.warning("Could not check api token revocations: %s", e)
+        return
+    if last != _last_revocation:
+        _last_revocation = last
+        _verified.clear()
+        _cached_hashes.clear()
+
+
+async def verify_api_token(token: str, scope: str = "photoshop") -> Optional[int]:
+    """
+    Проверяет токен плагина. Возвращает user_id владельца или None,
+    если токен неизвестен, отозван, другого scope или истёк.
+    """
+    if not token or not token.startswith(TOKEN_PREFIX):
+        return None
+
+    token_hash = _hash_token(token)
+    cached = _verified.get(token_hash, False)
+    if cached is None:
+        return None
+    if cached is not False:
+        await _sync_revocations()
+        cached = _verified.get(token_hash, False)
+    if cached is not False:
+        user_id, token_scope = cached
+        return user_id if token_scope == scope else None
+
+    row, found_by = await _lookup(token, token_hash)
+    expires = _parse_expires(row.get("expires_at")) if row else None
+    if row is None or _positive_ttl(expires) <= 0:
+        _verified.set(token_hash, None, ttl=NEGATIVE_TTL)
+        return None
+
+    if found_by == "token":
+        await _upgrade_legacy_row(row["id"], token)
+
+    _verified.set(token_hash, (row["user_id"], row.get("scope")), ttl=_positive_ttl(expires))
+    _cached_hashes.setdefault(row["user_id"], set()).add(token_hash)
+    return row["user_id"] if row.get("scope") == scope else None
+
+
+# ---------------------------------------------------------
+# REVOCATION
+# ---------------------------------------------------------
+
+async def list_api_tokens(user_id: int) -> List[Dict]:
+    """Активные токены пользователя: префикс, scope, срок действия."""
+    return await get_storage().list_api_tokens(user_id)
+
+
+def _invalidate_user(user_id: int) -> int:
+    hashes = _cached_hashes.pop(user_id, set())
+    return _verified.invalidate(lambda key: key in hashes)
+
+
+async def revoke_api_tokens(user_id: int, prefix: Optional[str] = None) -> int:
+    """
+    Отзывает токены пользователя (все или один по префиксу из /ps_token).
+    Возвращает число отозванных.
+    """
+    revoked = await get_storage().revoke_api_tokens(user_id, prefix)
+
+    dropped = _invalidate_user(user_id)
+    logger.info(
+        "Revoked %s api tokens of user %s (%s cache entries dropped)", revoked, user_id, dropped
+    )
+    return revoked
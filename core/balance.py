@@ -1,8 +1,11 @@
 import logging
-from typing import Tuple
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 from config import MODEL_INFO
-from .supabase import supabase_get_user, supabase_update_user
+from . import inflight
+from .ledger import InsufficientTokens, ledger
+from .storage import get_storage
 
 logger = logging.getLogger(__name__)
 
@@ -10,30 +13,80 @@ logger = logging.getLogger(__name__)
 # ---------------------------------------------------------
 # BALANCE MANAGEMENT
 # ---------------------------------------------------------
+# Баланс не перезаписывается: каждое изменение — запись в token_ledger
+# (core.ledger), а читается актуальный баланс из view user_accounts.
+# Всё, что зависит от текущего баланса (списание, «не ниже 0», выставление),
+# проверяется в самой записи (mode), а не чтением перед ней — иначе
+# параллельные генерации успевают списать один и тот же баланс дважды.
 
 async def get_balance(user_id: int) -> int:
-    try:
-        user = await supabase_get_user(user_id)
-        if user and isinstance(user.get("balance"), int):
-            return user["balance"]
-    except Exception as e:
-        logger.error("get_balance error: %s", e)
+    """
+    Баланс пользователя (0 — если пользователя ещё нет).
+    Ошибки хранилища пробрасываются: показать «0 токенов» из-за сбоя хуже,
+    чем сообщить, что сервис временно недоступен (см. error handler в main.py).
+    """
+    user = await get_storage().get_user(user_id)
+    if user and isinstance(user.get("balance"), int):
+        return user["balance"]
     return 0
 
 
-async def set_balance(user_id: int, val: int) -> None:
-    try:
-        await supabase_update_user(user_id, {"balance": val, "updated_at": "now()"})
-    except Exception as e:
-        logger.error("set_balance error: %s", e)
+def _balance_of(user: Optional[Dict], fallback: int) -> int:
+    if user and isinstance(user.get("balance"), int):
+        return user["balance"]
+    return fallback
+
+
+async def change_balance(
+    user_id: int,
+    delta: int,
+    reason: str = "admin",
+    payment_charge_id: Optional[str] = None,
+    generation_id: Optional[int] = None,
+    admin_action_id: Optional[int] = None,
+) -> Optional[Dict]:
+    """
+    Меняет баланс на delta записью в журнал токенов (core.ledger) и возвращает
+    строку пользователя с новым балансом из ответа на запись.
+    Списание не уводит баланс ниже 0. None — пользователь не найден.
+    """
+    return await ledger.append(
+        user_id,
+        delta,
+        reason,
+        payment_charge_id=payment_charge_id,
+        generation_id=generation_id,
+        admin_action_id=admin_action_id,
+        mode="clamp" if delta < 0 else "add",
+    )
+
+
+async def set_balance(
+    user_id: int, val: int, reason: str = "admin", admin_action_id: Optional[int] = None
+) -> Optional[Dict]:
+    """
+    Выставляет баланс в val: в журнал пишется разница с балансом на момент записи.
+    Возвращает обновлённую строку пользователя. None — пользователь не найден.
+    """
+    return await ledger.append(user_id, val, reason, admin_action_id=admin_action_id, mode="set")
 
 
-async def add_tokens(user_id: int, amount: int) -> int:
+async def add_tokens(
+    user_id: int,
+    amount: int,
+    reason: str = "admin",
+    payment_charge_id: Optional[str] = None,
+    admin_action_id: Optional[int] = None,
+) -> int:
     """Плюсовать токены к балансу (покупки / админка)."""
-    current = await get_balance(user_id)
-    new_balance = max(0, current + amount)
-    await set_balance(user_id, new_balance)
-    return new_balance
+    user = await change_balance(
+        user_id,
+        amount,
+        reason,
+        payment_charge_id=payment_charge_id,
+        admin_action_id=admin_action_id,
+    )
+    return _balance_of(user, 0)
 
 
 async def subtract_tokens(user_id: int, amount: int) -> int:
@@ -43,10 +96,39 @@ async def subtract_tokens(user_id: int, amount: int) -> int:
     if amount <= 0:
         return await get_balance(user_id)
 
-    current = await get_balance(user_id)
-    new_balance = max(0, current - amount)
-    await set_balance(user_id, new_balance)
-    return new_balance
+    user = await change_balance(user_id, -amount)
+    return _balance_of(user, 0)
+
+
+BULK_BATCH_SIZE = 200
+
+
+async def bulk_add_tokens(
+    user_ids: List[int],
+    amount: int,
+    batch_size: int = BULK_BATCH_SIZE,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    admin_action_id: Optional[int] = None,
+) -> Dict[int, int]:
+    """
+    Массовое начисление: пачками по batch_size, каждая пачка — один вызов
+    bulk_add_tokens хранилища (записи в журнал токенов со ссылкой на admin_action_id).
+    on_progress(обработано, всего) вызывается после пачки.
+    Возвращает {user_id: новый_баланс} для пользователей, которые нашлись.
+    """
+    unique_ids = list(dict.fromkeys(user_ids))
+    total = len(unique_ids)
+    balances: Dict[int, int] = {}
+
+    for start in range(0, total, batch_size):
+        batch = unique_ids[start:start + batch_size]
+        rows = await get_storage().bulk_add_tokens(batch, amount, admin_action_id)
+        for row in rows:
+            balances[row["id"]] = row["balance"]
+        if on_progress:
+            await on_progress(min(start + batch_size, total), total)
+
+    return balances
 
 
 # ---------------------------------------------------------
@@ -72,19 +154,108 @@ def get_generation_cost_tokens(settings: dict) -> int:
 
 
 async def deduct_tokens(
-    user_id: int, settings: dict, override_cost: int | None = None
+    user_id: int,
+    settings: dict,
+    override_cost: int | None = None,
+    generation_id: int | None = None,
+    inflight_id: int | None = None,
 ) -> Tuple[bool, int, int]:
     """
     Списывает токены за одну генерацию по текущим настройкам.
+    inflight_id — ключ идемпотентности: повторное списание по той же записи
+    журнала генерации не проводится и считается успешным.
     Возвращает:
       (успех, стоимость, новый_баланс_или_текущий_если_не_хватило)
     """
     cost = override_cost if override_cost is not None else get_generation_cost_tokens(settings)
-    current = await get_balance(user_id)
+    try:
+        user = await ledger.append(
+            user_id, -cost, "generation",
+            generation_id=generation_id, mode="debit", inflight_id=inflight_id,
+        )
+    except InsufficientTokens as e:
+        return False, cost, e.balance
+
+    if user is None:
+        return False, cost, 0
+    return True, cost, _balance_of(user, 0)
+
+
+# ---------------------------------------------------------
+# EFFECTIVE COST & SETTLEMENT
+# ---------------------------------------------------------
+# Общие для бота и HTTP API (api/): сколько стоит запуск и как его провести.
+
+FREE_REMOVE_BG_PER_DAY = 5
+
+
+def _today_utc_iso() -> str:
+    today = datetime.now(timezone.utc).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    return today.isoformat()
+
+
+async def get_remove_bg_free_left(user_id: int) -> int:
+    model_id = MODEL_INFO["remove_bg"]["replicate"]
+    used = await get_storage().count_generations_since(user_id, model_id, _today_utc_iso())
+    return max(0, FREE_REMOVE_BG_PER_DAY - used)
+
+
+async def get_effective_cost(user_id: int, settings: dict) -> tuple[int, int | None]:
+    """(стоимость запуска, бесплатных remove_bg на сегодня или None)."""
+    model_key = settings.get("model", "banana")
+    if model_key == "remove_bg":
+        free_left = await get_remove_bg_free_left(user_id)
+        if free_left > 0:
+            return 0, free_left
+        return MODEL_INFO["remove_bg"]["base_cost"], 0
+
+    return get_generation_cost_tokens(settings), None
+
+
+async def settle_generation(
+    user_id: int,
+    prompt: str,
+    image_url: str,
+    settings: dict,
+    cost: int,
+    route: Optional[Dict] = None,
+    balance: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    Проводит успешную генерацию: лог в generations, затем списание cost.
+    Возвращает (списано, новый баланс). Вызывать через deadline.run_to_completion:
+    Replicate уже выставил счёт, бросать на полпути нельзя.
+    Закрывает запись журнала генерации (core.inflight), если он ведётся.
+    Её id — ключ проведения: повтор (recover() после падения между списанием
+    и закрытием записи) не пишет второй лог и не списывает второй раз.
+    """
+    inflight_id = inflight.entry_id()
+    # Сначала лог: id генерации попадает в запись журнала токенов
+    generation_id = await get_storage().log_generation(
+        user_id=user_id,
+        prompt=prompt,
+        image_url=image_url,
+        settings=settings,
+        tokens_spent=cost,
+        route=route,
+        inflight_id=inflight_id,
+    )
 
-    if current < cost:
-        return False, cost, current
+    if cost <= 0:
+        await inflight.settled()
+        return 0, balance if balance is not None else await get_balance(user_id)
 
-    new_balance = current - cost
-    await set_balance(user_id, new_balance)
-    return True, cost, new_balance
+    ok, used_cost, new_balance = await deduct_tokens(
+        user_id, settings, override_cost=cost,
+        generation_id=generation_id, inflight_id=inflight_id,
+    )
+    await inflight.settled()
+    if not ok:
+        logger.error(
+            "Не удалось списать токены после успешной генерации "
+            f"(user_id={user_id}, expected_cost={cost})"
+        )
+        return 0, await get_balance(user_id)
+    return used_cost, new_balance
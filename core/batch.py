@@ -0,0 +1,326 @@
+import asyncio
+import csv
+import io
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Bot, InputMediaDocument, InputMediaPhoto, Message
+from telegram.error import BadRequest
+
+from config import MODEL_INFO, MODEL_SETTINGS_SCHEMA
+from . import deadline, inflight
+from .balance import get_balance, get_generation_cost_tokens
+from .deadline import DEADLINE_GENERATION
+from .generators import run_model
+from .ledger import InsufficientTokens, ledger
+from .outbound import outbound
+from .settings import DEFAULT_SETTINGS
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# BATCH GENERATION
+# ---------------------------------------------------------
+# Файл .txt (промт на строку) или .csv (колонка prompt + колонки настроек).
+# В .txt настройки строки — после " | ":  кот в шляпе | aspect_ratio=16:9, model=banana_pro
+#
+# Стоимость всего пакета резервируется одной записью в журнале токенов,
+# промты идут через run_model не больше BATCH_CONCURRENCY одновременно,
+# готовые картинки уходят альбомами по MEDIA_GROUP_SIZE, прогресс — в одном
+# редактируемом сообщении. Генерации альбома пишутся в generations одним
+# запросом после его отправки, а стоимость неудавшихся промтов в конце
+# возвращается одной записью.
+# Резерв журналируется в inflight_predictions (core.inflight): в записи —
+# ещё не проведённый остаток, и если процесс упал посреди пакета, recover()
+# возвращает его при следующем старте. Возврат идёт с inflight_id записи —
+# второй раз тот же остаток не вернётся.
+
+BATCH_MAX_FILE_BYTES = 256 * 1024
+BATCH_MAX_PROMPTS = 50
+BATCH_MAX_PROMPT_LEN = 2000
+BATCH_CONCURRENCY = 3
+MEDIA_GROUP_SIZE = 10               # больше Telegram в один альбом не берёт
+PROGRESS_EDIT_INTERVAL = 2.0        # сек между правками сообщения о прогрессе
+CAPTION_PROMPT_LEN = 200
+
+# Не больше одного пакета на пользователя одновременно
+_batches_in_progress: set[int] = set()
+
+
+class BatchFileError(ValueError):
+    """Файл с промтами не разобрать; текст — для пользователя."""
+
+
+class BatchInProgress(Exception):
+    """У пользователя уже идёт пакетная генерация."""
+
+
+# ---------------------------------------------------------
+# PARSING
+# ---------------------------------------------------------
+
+def _allowed_options(model_key: str) -> Dict[str, List[str]]:
+    return {field["key"]: field["options"] for field in MODEL_SETTINGS_SCHEMA.get(model_key, [])}
+
+
+def _item(line_no: int, prompt: str, overrides: Dict[str, str], base: Dict) -> Dict:
+    prompt = prompt.strip()
+    if not prompt:
+        raise BatchFileError(f"Строка {line_no}: пустой промт.")
+    if len(prompt) > BATCH_MAX_PROMPT_LEN:
+        raise BatchFileError(f"Строка {line_no}: промт длиннее {BATCH_MAX_PROMPT_LEN} символов.")
+
+    settings = dict(base)
+    applied = set()
+    for key, value in overrides.items():
+        key, value = key.strip(), value.strip()
+        if not value:
+            continue
+        if key not in DEFAULT_SETTINGS:
+            raise BatchFileError(f"Строка {line_no}: неизвестная настройка {key}.")
+        settings[key] = value
+        applied.add(key)
+
+    model_key = settings.get("model")
+    if model_key not in MODEL_INFO or model_key == "remove_bg":
+        raise BatchFileError(f"Строка {line_no}: модель {model_key} не подходит для пакета.")
+    for key, options in _allowed_options(model_key).items():
+        if key in applied and settings[key] not in options:
+            raise BatchFileError(
+                f"Строка {line_no}: {key}={settings[key]} — допустимо: {', '.join(options)}."
+            )
+    return {"line": line_no, "prompt": prompt, "settings": settings}
+
+
+def _parse_txt(text: str, base: Dict) -> List[Dict]:
+    items = []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        prompt, sep, tail = line.rpartition(" | ")
+        overrides: Dict[str, str] = {}
+        if sep and "=" in tail:
+            for pair in tail.split(","):
+                key, eq, value = pair.partition("=")
+                if not eq:
+                    raise BatchFileError(f"Строка {line_no}: настройки пишутся как key=value.")
+                overrides[key.strip()] = value
+        else:
+            prompt = line
+        items.append(_item(line_no, prompt, overrides, base))
+    return items
+
+
+def _parse_csv(text: str, base: Dict) -> List[Dict]:
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or "prompt" not in reader.fieldnames:
+        raise BatchFileError("В CSV нужна колонка prompt.")
+    items = []
+    for row in reader:
+        prompt = row.pop("prompt") or ""
+        if not prompt.strip():
+            continue
+        overrides = {k: v for k, v in row.items() if k and v is not None}
+        items.append(_item(reader.line_num, prompt, overrides, base))
+    return items
+
+
+def parse_prompt_file(data: bytes, filename: str, base_settings: Dict) -> List[Dict]:
+    """
+    Промты из файла: [{"line", "prompt", "settings"}]. base_settings — текущие
+    настройки пользователя, строки файла их переопределяют. Ошибка — BatchFileError.
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise BatchFileError("Файл должен быть в кодировке UTF-8.") from None
+
+    base = {k: base_settings.get(k, v) for k, v in DEFAULT_SETTINGS.items()}
+    if filename.lower().endswith(".csv"):
+        items = _parse_csv(text, base)
+    else:
+        items = _parse_txt(text, base)
+
+    if not items:
+        raise BatchFileError("В файле нет ни одного промта.")
+    if len(items) > BATCH_MAX_PROMPTS:
+        raise BatchFileError(f"Слишком много промтов: {len(items)}, максимум {BATCH_MAX_PROMPTS}.")
+    return items
+
+
+def quote_batch(items: List[Dict]) -> int:
+    return sum(get_generation_cost_tokens(item["settings"]) for item in items)
+
+
+# ---------------------------------------------------------
+# EXECUTION
+# ---------------------------------------------------------
+
+async def reserve_batch(user_id: int, chat_id: int, cost: int) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Резервирует стоимость пакета одной записью журнала токенов.
+    Возвращает (новый баланс, id записи inflight-журнала) или None,
+    если токенов не хватает.
+    """
+    if user_id in _batches_in_progress:
+        raise BatchInProgress()
+    _batches_in_progress.add(user_id)
+    entry_id = None
+    try:
+        # Запись о резерве — до списания: упадём между ними — recover() вернёт резерв
+        entry_id = await inflight.journal_reservation(user_id, chat_id, cost)
+        user = await ledger.append(user_id, -cost, "batch_reserve", mode="debit")
+    except InsufficientTokens:
+        user = None
+    except BaseException:
+        _batches_in_progress.discard(user_id)
+        await deadline.shielded(inflight.close_entry(entry_id))
+        raise
+    if user is None:
+        _batches_in_progress.discard(user_id)
+        await inflight.close_entry(entry_id)
+        return None
+    return user["balance"], entry_id
+
+
+async def refund_reservation(user_id: int, entry_id: Optional[int], amount: int) -> Tuple[int, int]:
+    """
+    Возвращает неизрасходованный резерв пакета: (возвращено, новый баланс).
+    Повтор для той же записи журнала ничего не начисляет.
+    """
+    if amount <= 0:
+        return 0, await get_balance(user_id)
+    user = await ledger.append(user_id, amount, "batch_refund", inflight_id=entry_id)
+    return amount, user["balance"] if user else 0
+
+
+def _caption(item: Dict) -> str:
+    prompt = item["prompt"]
+    if len(prompt) > CAPTION_PROMPT_LEN:
+        prompt = prompt[:CAPTION_PROMPT_LEN - 1] + "…"
+    return f"{item['line']}. {prompt}"
+
+
+async def _send_album(bot: Bot, chat_id: int, done: List[Tuple[Dict, str]]) -> None:
+    """Альбом фотографий по ссылкам; что Telegram не возьмёт фото — документами, иначе ссылками."""
+    photos = [InputMediaPhoto(url, caption=_caption(item)) for item, url in done]
+    try:
+        await outbound.send(chat_id, lambda: bot.send_media_group(chat_id, photos))
+        return
+    except BadRequest as e:
+        logger.info("Batch album as photos rejected (%s), sending documents", e)
+
+    documents = [InputMediaDocument(url, caption=_caption(item)) for item, url in done]
+    try:
+        await outbound.send(chat_id, lambda: bot.send_media_group(chat_id, documents))
+        return
+    except BadRequest as e:
+        logger.warning("Batch album as documents rejected (%s), sending links", e)
+
+    links = "\n".join(f"{_caption(item)}\n{url}" for item, url in done)
+    await outbound.send(chat_id, lambda: bot.send_message(chat_id, links))
+
+
+def _progress_text(total: int, done: int, failed: int) -> str:
+    return f"⏳ Пакет: готово {done} из {total}" + (f", ошибок: {failed}" if failed else "") + "…"
+
+
+async def _run_item(
+    item: Dict, semaphore: asyncio.Semaphore, results: "asyncio.Queue"
+) -> None:
+    route: Dict = {}
+    try:
+        async with semaphore:
+            image_url = await deadline.run_with_deadline(
+                DEADLINE_GENERATION, run_model(item["prompt"], item["settings"], route=route)
+            )
+    except Exception as e:
+        logger.warning("Batch prompt on line %s failed: %r", item["line"], e)
+        await results.put((item, None, route))
+        return
+    await results.put((item, image_url, route))
+
+
+async def run_batch(
+    bot: Bot,
+    chat_id: int,
+    user_id: int,
+    items: List[Dict],
+    reserved: int,
+    progress: Message,
+    entry_id: Optional[int] = None,
+) -> None:
+    """
+    Выполняет зарезервированный пакет (reserve_batch) и проводит его:
+    bulk-лог генераций по альбомам и возврат стоимости неудавшихся промтов.
+    entry_id — запись резерва в inflight-журнале, закрывается после возврата.
+    Запускать через deadline.spawn_detached — пакет дольше бюджета апдейта.
+    """
+    total = len(items)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results: "asyncio.Queue" = asyncio.Queue()
+    tasks = [asyncio.create_task(_run_item(item, semaphore, results)) for item in items]
+
+    album: List[Tuple[Dict, str]] = []
+    unlogged: List[Dict] = []
+    failed: List[Dict] = []
+    logged = spent = 0
+    last_edit = time.monotonic()
+
+    async def log_album() -> None:
+        nonlocal logged, spent
+        if not unlogged:
+            return
+        await get_storage().log_generations(unlogged)
+        logged += len(unlogged)
+        spent += sum(entry["tokens_spent"] for entry in unlogged)
+        unlogged.clear()
+        await inflight.reservation_left(entry_id, reserved - spent)
+
+    try:
+        for finished in range(1, total + 1):
+            item, image_url, route = await results.get()
+            if image_url is None:
+                failed.append(item)
+            else:
+                unlogged.append({
+                    "user_id": user_id,
+                    "prompt": item["prompt"],
+                    "image_url": image_url,
+                    "settings": item["settings"],
+                    "tokens_spent": get_generation_cost_tokens(item["settings"]),
+                    "route": route,
+                })
+                album.append((item, image_url))
+
+            if len(album) == MEDIA_GROUP_SIZE:
+                await _send_album(bot, chat_id, album)
+                album = []
+                await log_album()
+            if time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL and finished < total:
+                last_edit = time.monotonic()
+                text = _progress_text(total, finished - len(failed), len(failed))
+                outbound.submit(chat_id, lambda t=text: progress.edit_text(t))
+
+        if album:
+            await _send_album(bot, chat_id, album)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _batches_in_progress.discard(user_id)
+
+        await log_album()
+        refund, balance = await refund_reservation(user_id, entry_id, reserved - spent)
+        await inflight.close_entry(entry_id)
+
+    lines = [f"✅ Пакет готов: {logged} из {total}."]
+    if failed:
+        lines.append(f"Не получилось: строки {', '.join(str(item['line']) for item in failed)}.")
+    lines.append(f"Списано {spent} токенов" + (f", возвращено {refund}" if refund else "") + ".")
+    lines.append(f"Баланс: {balance}.")
+    text = "\n".join(lines)
+    await outbound.send(chat_id, lambda: progress.edit_text(text))
@@ -0,0 +1,142 @@
+import asyncio
+import functools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Абсолютный дедлайн текущего апдейта (time.monotonic), None — без ограничения.
+# Контекст копируется в дочерние задачи, поэтому дедлайн видят все вызовы,
+# сделанные из хендлера: Supabase, Replicate, внутренние gather и т.п.
+_deadline: ContextVar[Optional[float]] = ContextVar("update_deadline", default=None)
+
+# ---------------------------------------------------------
+# BUDGETS PER HANDLER TYPE
+# ---------------------------------------------------------
+
+DEADLINE_CALLBACK = 2.0       # нажатия на inline-кнопки настроек
+DEADLINE_COMMAND = 5.0        # обычные команды (/start, /balance, ...)
+DEADLINE_PRECHECKOUT = 8.0    # Telegram ждёт ответ на pre_checkout не дольше 10 с
+DEADLINE_ADMIN = 10.0
+DEADLINE_EXPORT = 120.0       # /export: постранично вся история + загрузка файла
+DEADLINE_DELIVERY = 90.0      # отправка оригинала результата документом
+DEADLINE_GENERATION = 150.0   # генерация: Supabase + Replicate + отправка
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Бюджет времени апдейта исчерпан — работа отменена, зависимость не виновата."""
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось до дедлайна (может быть <= 0), None — дедлайна нет."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def clamp_timeout(timeout: float) -> float:
+    """
+    Ужимает таймаут отдельного вызова до остатка бюджета.
+    Если бюджет уже исчерпан — DeadlineExceeded, вызов не начинается.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("deadline exceeded")
+    return min(timeout, left)
+
+
+async def run_with_deadline(seconds: float, coro: Awaitable[T]) -> T:
+    """
+    Выполняет coro с бюджетом seconds (вложенный бюджет не может быть шире внешнего).
+    По истечении работа отменяется и поднимается DeadlineExceeded.
+    """
+    new_deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        new_deadline = min(new_deadline, outer)
+
+    token = _deadline.set(new_deadline)
+    try:
+        return await asyncio.wait_for(coro, max(0.0, new_deadline - time.monotonic()))
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError:
+        if new_deadline - time.monotonic() <= 0:
+            raise DeadlineExceeded(f"deadline of {seconds:.1f}s exceeded") from None
+        raise
+    finally:
+        _deadline.reset(token)
+
+
+def with_deadline(seconds: float) -> Callable:
+    """Декоратор хендлера PTB: весь апдейт должен уложиться в seconds."""
+
+    def decorator(handler: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            try:
+                return await run_with_deadline(seconds, handler(update, context))
+            except DeadlineExceeded:
+                logger.warning("%s: deadline %.1fs exceeded, work cancelled", handler.__name__, seconds)
+                raise
+
+        return wrapper
+
+    return decorator
+
+
+def spawn_detached(coro: Awaitable[T]) -> "asyncio.Task[T]":
+    """Запускает задачу без дедлайна текущего апдейта (фоновая / общая работа)."""
+    token = _deadline.set(None)
+    try:
+        return asyncio.ensure_future(coro)
+    finally:
+        _deadline.reset(token)
+
+
+async def shielded(coro: Awaitable[T]) -> T:
+    """
+    Доводит coro до конца независимо от дедлайна: без бюджета и без отмены
+    извне. Для работы, которую нельзя бросить на полпути (деньги уже потрачены).
+    """
+    task = spawn_detached(coro)
+    task.add_done_callback(_log_orphan_error)
+    return await asyncio.shield(task)
+
+
+async def run_to_completion(coro: Awaitable[T]) -> T:
+    """
+    Как shielded, но и вызывающий не прерывается: отмена (дедлайн апдейта,
+    остановка) дожидается конца coro, а вызывающий получает её результат,
+    как будто отмены не было. Для точки невозврата — генерация уже проводится
+    и пользователю отвечает сама coro; «не успел вовремя» поверх — неправда.
+    """
+    task = spawn_detached(coro)
+    task.add_done_callback(_log_orphan_error)
+    interrupted = 0
+    while True:
+        try:
+            result = await asyncio.shield(task)
+            break
+        except asyncio.CancelledError:
+            if task.cancelled():
+                raise
+            interrupted += 1
+    current = asyncio.current_task()
+    for _ in range(interrupted):
+        current.uncancel()
+    if interrupted:
+        logger.info("Deadline reached during a committed step, finished anyway")
+    return result
+
+
+def _log_orphan_error(task: asyncio.Future) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Shielded task failed", exc_info=task.exception())
@@ -0,0 +1,127 @@
+import functools
+import logging
+import secrets
+from typing import Awaitable, Callable, Optional, Tuple
+
+import httpx
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Message
+from telegram.error import BadRequest
+
+from .cache import TTLCache
+from .http import get_http_client, download_bytes
+from .imaging import transcode_preview
+from .outbound import outbound
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# LIMITS
+# ---------------------------------------------------------
+# Telegram сам скачивает фото по URL, если оно не больше 5 МБ и это JPEG/PNG —
+# тогда через бота не проходит ни байта. Всё остальное (4K PNG от banana_pro
+# и т.п.) скачиваем, пережимаем в превью и загружаем уже его.
+# Оригинал без сжатия — отдельным документом по кнопке.
+
+URL_PHOTO_MAX_BYTES = 5 * 1024 * 1024
+URL_PHOTO_TYPES = {"image/jpeg", "image/png"}
+DOCUMENT_MAX_BYTES = 50 * 1024 * 1024
+PROBE_TIMEOUT = 5.0
+DOWNLOAD_TIMEOUT = 60.0
+
+# Ссылки Replicate на результат живут около часа — столько же держим кнопку
+ORIGINALS_TTL = 3600.0
+_originals = TTLCache(maxsize=5000, ttl=ORIGINALS_TTL)
+
+
+async def _probe(url: str) -> Tuple[Optional[int], Optional[str]]:
+    """(размер, content-type) по HEAD; None, если сервер их не сообщил."""
+    try:
+        resp = await get_http_client().head(url, timeout=PROBE_TIMEOUT, follow_redirects=True)
+        resp.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.info("HEAD %s failed: %s", url, e)
+        return None, None
+    length = resp.headers.get("content-length")
+    content_type = resp.headers.get("content-type", "").split(";")[0].strip().lower()
+    return (int(length) if length and length.isdigit() else None), content_type or None
+
+
+def _original_keyboard(url: str, filename: str) -> InlineKeyboardMarkup:
+    key = secrets.token_urlsafe(8)
+    _originals.set(key, (url, filename))
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("📎 Оригинал без сжатия", callback_data=f"orig|{key}")]]
+    )
+
+
+async def deliver_image(message: Message, image_url: str, output_format: str = "png") -> None:
+    """
+    Отправляет результат генерации ответом на message самым дешёвым способом:
+    1) ссылкой — если Telegram может скачать файл сам;
+    2) иначе — превью JPEG, пережатым в процессном пуле.
+    Под фото — кнопка, присылающая оригинал документом.
+    """
+    await _deliver(message.chat_id, message.reply_photo, image_url, output_format)
+
+
+async def deliver_image_to_chat(bot: Bot, chat_id: int, image_url: str, output_format: str = "png") -> None:
+    """То же, что deliver_image, но без исходного сообщения (восстановление после рестарта)."""
+    await _deliver(chat_id, functools.partial(bot.send_photo, chat_id), image_url, output_format)
+
+
+async def _deliver(
+    chat_id: int,
+    send_photo: Callable[..., Awaitable[Message]],
+    image_url: str,
+    output_format: str,
+) -> None:
+    markup = _original_keyboard(image_url, f"nano-bot.{output_format}")
+
+    size, content_type = await _probe(image_url)
+    if size is not None and size <= URL_PHOTO_MAX_BYTES and content_type in URL_PHOTO_TYPES:
+        try:
+            await outbound.send(
+                chat_id, lambda: send_photo(photo=image_url, reply_markup=markup)
+            )
+            return
+        except BadRequest as e:
+            # Telegram не смог забрать файл сам — загружаем
+            logger.info("Photo by URL rejected (%s), uploading preview", e)
+
+    try:
+        data = await download_bytes(image_url, DOCUMENT_MAX_BYTES, DOWNLOAD_TIMEOUT)
+        preview = await transcode_preview(data)
+    except Exception as e:
+        logger.warning("Preview transcoding failed for %s: %s", image_url, e)
+        await outbound.send(
+            chat_id, lambda: send_photo(photo=image_url, reply_markup=markup)
+        )
+        return
+
+    logger.info(
+        "Delivering preview: %s -> %s bytes (%s)", len(data), len(preview), image_url
+    )
+    await outbound.send(
+        chat_id,
+        lambda: send_photo(
+            photo=InputFile(preview, filename="nano-bot.jpg"), reply_markup=markup
+        ),
+    )
+
+
+async def send_original(message: Message, key: str) -> bool:
+    """
+    Отправляет оригинал документом. False — ссылка устарела.
+    Файл больше DOCUMENT_MAX_BYTES — core.http.DownloadTooLarge.
+    """
+    entry = _originals.get(key)
+    if entry is None:
+        return False
+
+    url, filename = entry
+    data = await download_bytes(url, DOCUMENT_MAX_BYTES, DOWNLOAD_TIMEOUT)
+    await outbound.send(
+        message.chat_id,
+        lambda: message.reply_document(document=InputFile(data, filename=filename)),
+    )
+    return True
@@ -0,0 +1,167 @@
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from .outbound import outbound
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# GENERATIONS EXPORT
+# ---------------------------------------------------------
+# История читается keyset-страницами и сразу дописывается во временный файл,
+# так что в памяти одновременно не больше одной страницы — сколько бы ни было генераций.
+
+EXPORT_CHUNK_SIZE = 500
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_FIELDS = [
+    "id",
+    "created_at",
+    "prompt",
+    "image_url",
+    "tokens_spent",
+    "model",
+    "aspect_ratio",
+    "resolution",
+    "output_format",
+]
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024  # лимит Telegram на отправку документа ботом
+
+# Не больше одной выгрузки на пользователя одновременно
+_exports_in_progress: set[int] = set()
+
+
+class ExportTooLarge(Exception):
+    """Файл выгрузки больше, чем Telegram примет от бота."""
+
+
+class ExportInProgress(Exception):
+    """Для этого пользователя выгрузка уже идёт."""
+
+
+def parse_export_args(args: Sequence[str]) -> Tuple[str, bool]:
+    """
+    Аргументы /export: [csv|jsonl] [zip] в любом порядке.
+    Возвращает (fmt, zipped); неизвестный аргумент — ValueError.
+    """
+    fmt = "csv"
+    zipped = False
+    for arg in args:
+        arg = arg.lower()
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg == "zip":
+            zipped = True
+        else:
+            raise ValueError(arg)
+    return fmt, zipped
+
+
+async def iter_generation_chunks(
+    user_id: int, chunk_size: int = EXPORT_CHUNK_SIZE
+) -> AsyncIterator[List[Dict]]:
+    """Вся история пользователя страницами по chunk_size, новые сверху."""
+    columns = ",".join(EXPORT_FIELDS)
+    cursor: Optional[str] = None
+    while True:
+        rows, cursor, _ = await get_storage().fetch_generations_page(
+            user_id, cursor, "next", limit=chunk_size, columns=columns
+        )
+        if rows:
+            yield rows
+        if cursor is None:
+            return
+
+
+class _RowWriter:
+    """Пишет строки в CSV или JSONL поверх текстового потока."""
+
+    def __init__(self, stream: io.TextIOBase, fmt: str) -> None:
+        self.stream = stream
+        self.fmt = fmt
+        self._csv: Optional[csv.DictWriter] = None
+        if fmt == "csv":
+            self._csv = csv.DictWriter(stream, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+            self._csv.writeheader()
+
+    def write(self, rows: List[Dict]) -> None:
+        if self._csv is not None:
+            self._csv.writerows(rows)
+        else:
+            for row in rows:
+                self.stream.write(json.dumps(row, ensure_ascii=False))
+                self.stream.write("\n")
+
+
+def _open_output(stack: contextlib.ExitStack, path: str, inner_name: str, zipped: bool):
+    if not zipped:
+        return stack.enter_context(open(path, "w", encoding="utf-8", newline=""))
+    archive = stack.enter_context(zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED))
+    raw = stack.enter_context(archive.open(inner_name, "w"))
+    return stack.enter_context(io.TextIOWrapper(raw, encoding="utf-8", newline=""))
+
+
+@contextlib.asynccontextmanager
+async def export_generations(
+    user_id: int, fmt: str = "csv", zipped: bool = False
+) -> AsyncIterator[Tuple[str, str, int]]:
+    """
+    Выгружает историю генераций во временный файл.
+    Отдаёт (path, filename, rows); файл удаляется при выходе из контекста.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"unknown export format: {fmt}")
+    if user_id in _exports_in_progress:
+        raise ExportInProgress(user_id)
+
+    inner_name = f"generations_{user_id}.{fmt}"
+    filename = inner_name + (".zip" if zipped else "")
+    fd, path = tempfile.mkstemp(prefix="export_", suffix="_" + filename)
+    os.close(fd)
+
+    _exports_in_progress.add(user_id)
+    try:
+        total = 0
+        with contextlib.ExitStack() as stack:
+            writer = _RowWriter(_open_output(stack, path, inner_name, zipped), fmt)
+            async for rows in iter_generation_chunks(user_id):
+                # запись и сжатие — в потоке, чтобы не держать event loop
+                await asyncio.to_thread(writer.write, rows)
+                total += len(rows)
+
+        size = os.path.getsize(path)
+        if size > MAX_DOCUMENT_BYTES:
+            raise ExportTooLarge(f"{size} bytes")
+
+        logger.info("Exported %s generations of %s (%s, %s bytes)", total, user_id, filename, size)
+        yield path, filename, total
+    finally:
+        _exports_in_progress.discard(user_id)
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+async def send_export(bot, chat_id: int, user_id: int, fmt: str, zipped: bool) -> int:
+    """Выгружает историю user_id и отправляет файл в chat_id. Возвращает число строк."""
+    async with export_generations(user_id, fmt, zipped) as (path, filename, total):
+        if total == 0:
+            return 0
+        await outbound.send(
+            chat_id,
+            lambda: bot.send_document(
+                chat_id=chat_id,
+                document=Path(path),
+                filename=filename,
+                caption=f"История генераций {user_id}: {total} шт.",
+            ),
+        )
+        return total
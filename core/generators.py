@@ -1,33 +1,45 @@
+import asyncio
 import logging
-from typing import Dict, List, Tuple, Optional
-
-import replicate
+import time
+from typing import Dict, List, Optional
 
 from config import REPLICATE_API_TOKEN, MODEL_INFO
+from . import deadline, inflight, resilience, routing
+from .keepwarm import keepwarm
+from .telemetry import telemetry
 
 logger = logging.getLogger(__name__)
 
-# Инициализация клиента Replicate (если нужен)
-replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+# Клиент Replicate создаётся при первом обращении: сам пакет replicate
+# (pydantic-модели и т.п.) заметно удлиняет импорт, а нужен не сразу.
+_replicate_client = None
+
+
+def get_replicate_client():
+    global _replicate_client
+    if _replicate_client is None:
+        import replicate
+
+        _replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+    return _replicate_client
 
 
-def _extract_url_and_bytes(output) -> Tuple[Optional[str], Optional[bytes]]:
+def _extract_url(output) -> Optional[str]:
     """
     Универсальный парсер результата Replicate:
-    - поддерживает объект с .url / .read (метод или property)
+    - поддерживает объект с .url (метод или property)
     - поддерживает строку (url)
     - поддерживает list[строка] / list[dict{url=...}]
+
+    Байты результата здесь не читаем: FileOutput.read() качает файл синхронно
+    и блокирует event loop. Что и как отправлять — решает core.delivery.
     """
     url = None
-    data = None
 
-    # 1) Объект с атрибутами .url / .read
+    # 1) Объект с атрибутом .url
     if hasattr(output, "url"):
         attr = getattr(output, "url")
         url = attr() if callable(attr) else attr
-    if hasattr(output, "read"):
-        attr = getattr(output, "read")
-        data = attr() if callable(attr) else attr
 
     # 2) Если url всё ещё нет — пробуем более «сырые» варианты
     if url is None:
@@ -39,33 +51,115 @@ def _extract_url_and_bytes(output) -> Tuple[Optional[str], Optional[bytes]]:
                 url = first
             elif isinstance(first, dict) and "url" in first:
                 url = first["url"]
+            elif hasattr(first, "url"):
+                return _extract_url(first)
 
-    return url, data
+    return str(url) if url is not None else None
 
 
-async def run_model(
+async def _create_prediction(model_id: str, payload: Dict):
+    """Создаёт предсказание и сразу возвращает его, не дожидаясь результата."""
+    client = get_replicate_client()
+    name, _, version = model_id.partition(":")
+    if version:
+        return await client.predictions.async_create(version=version, input=payload)
+    return await client.models.predictions.async_create(model=name, input=payload)
+
+
+FINISHED_STATUSES = ("succeeded", "failed", "canceled")
+
+
+async def cancel_prediction(prediction_id: str) -> None:
+    """Отменяет предсказание, которое больше никто не ждёт: Replicate перестаёт его считать."""
+    try:
+        await get_replicate_client().predictions.async_cancel(prediction_id)
+    except Exception as e:
+        logger.warning("Could not cancel prediction %s: %s", prediction_id, e)
+
+
+async def _cancel_running(running: List[str]) -> None:
+    ids, running[:] = list(running), []
+    await asyncio.gather(*(cancel_prediction(prediction_id) for prediction_id in ids))
+
+
+async def _wait_prediction(prediction):
+    """Ждёт завершения; неуспешное предсказание — replicate.exceptions.ModelError."""
+    from replicate.exceptions import ModelError
+
+    await prediction.async_wait()
+    if prediction.status != "succeeded":
+        raise ModelError(prediction)
+    return prediction
+
+
+async def _replicate_run(model_key: str, payload: Dict, running: Optional[List[str]] = None):
+    """
+    Вызов Replicate по политике replicate.run: таймаут и circuit breaker модели.
+    Без повторов — каждая попытка платная. Предсказание создаётся отдельно
+    от ожидания: его id сразу попадает в журнал генерации (core.inflight)
+    и в running, пока предсказание не завершилось, — чтобы брошенное
+    ожидание можно было отменить (run_model).
+    Неудавшееся предсказание тоже попадает в телеметрию (status failed /
+    canceled); брошенное ожидание — как canceled: run_model его отменит.
+    """
+    model_id = MODEL_INFO[model_key]["replicate"]
+
+    async def attempt(timeout: float):
+        created = time.monotonic()
+        prediction = await _create_prediction(model_id, payload)
+        if running is not None:
+            running.append(prediction.id)
+        await inflight.dispatched(model_key, prediction.id)
+        try:
+            return await _wait_prediction(prediction)
+        except BaseException:
+            status = prediction.status if prediction.status in ("failed", "canceled") else "canceled"
+            telemetry.record(model_key, payload, prediction, time.monotonic() - created, None, status=status)
+            raise
+        finally:
+            if running is not None and prediction.status in FINISHED_STATUSES:
+                running.remove(prediction.id)
+
+    started = time.monotonic()
+    prediction = await resilience.call("replicate.run", attempt, dependency=f"replicate/{model_id}")
+    elapsed = time.monotonic() - started
+    keepwarm.record_run(model_id, elapsed)
+    telemetry.record(model_key, payload, prediction, elapsed, _extract_url(prediction.output))
+    return prediction.output
+
+
+async def resume_prediction(prediction_id: str, timeout: float) -> Optional[str]:
+    """
+    Дожидается предсказания, запущенного до перезапуска процесса (core.inflight).
+    URL результата или None, если оно упало / отменено. Не успело за timeout —
+    отменяется (счёт за дальнейшую работу не копится) и поднимается TimeoutError.
+    """
+    from replicate.exceptions import ModelError
+
+    prediction = await get_replicate_client().predictions.async_get(prediction_id)
+    try:
+        await asyncio.wait_for(_wait_prediction(prediction), timeout)
+    except ModelError:
+        return None
+    except asyncio.TimeoutError:
+        await cancel_prediction(prediction_id)
+        raise
+    return _extract_url(prediction.output)
+
+
+def _build_payload(
+    model_key: str,
     prompt: str,
     settings: Dict,
-    image_urls: Optional[List[str]] = None,
-) -> Tuple[str, bytes]:
+    image_urls: List[str],
+) -> Dict:
     """
-    Универсальный раннер моделей:
+    Вход Replicate для модели model_key:
     - banana (google/nano-banana)
     - banana_pro (google/nano-banana-pro)
     - flux_ultra (black-forest-labs/flux-1.1-pro-ultra)
-
-    Возвращает (image_url, image_bytes)
+    - remove_bg
     """
-    model_key = settings.get("model", "banana")
-    if model_key not in MODEL_INFO:
-        model_key = "banana"
-
-    model_cfg = MODEL_INFO[model_key]
-    model_id = model_cfg["replicate"]
-
-    image_urls = image_urls or []
-
-    logger.info("run_model: model=%s, prompt=%s", model_key, prompt[:200])
 
     # -------- BANANA ----------
     if model_key == "banana":
@@ -76,16 +170,7 @@ async def run_model(
             "output_format": settings.get("output_format", "jpg"),
         }
 
-        output = replicate_client.run(
-            model_id,
-            input=payload,
-        )
-
-        image_url, image_bytes = _extract_url_and_bytes(output)
-        if image_url is None:
-            raise ValueError("Не удалось получить URL изображения от nano-banana")
-
-        return image_url, image_bytes or b""
+        return payload
 
     # -------- BANANA PRO ----------
     if model_key == "banana_pro":
@@ -98,16 +183,7 @@ async def run_model(
             "safety_filter_level": settings.get("safety_filter_level", "block_only_high"),
         }
 
-        output = replicate_client.run(
-            model_id,
-            input=payload,
-        )
-
-        image_url, image_bytes = _extract_url_and_bytes(output)
-        if image_url is None:
-            raise ValueError("Не удалось получить URL изображения от nano-banana-pro")
-
-        return image_url, image_bytes or b""
+        return payload
 
     # -------- FLUX 1.1 PRO ULTRA ----------
     if model_key == "flux_ultra":
@@ -150,16 +226,7 @@ async def run_model(
             except ValueError:
                 pass
 
-        output = replicate_client.run(
-            model_id,
-            input=payload,
-        )
-
-        image_url, image_bytes = _extract_url_and_bytes(output)
-        if image_url is None:
-            raise ValueError("Не удалось получить URL изображения от flux_ultra")
-
-        return image_url, image_bytes or b""
+        return payload
 
     # -------- REMOVE BACKGROUND ----------
     if model_key == "remove_bg":
@@ -170,16 +237,92 @@ async def run_model(
             "image": image_urls[0],
         }
 
-        output = replicate_client.run(
-            model_id,
-            input=payload,
-        )
+        return payload
 
-        image_url, image_bytes = _extract_url_and_bytes(output)
-        if image_url is None:
-            raise ValueError("Не удалось получить URL изображения от remove_bg")
+    raise ValueError(f"Unsupported model: {model_key}")
 
-        return image_url, image_bytes or b""
 
-    # fallback
-    raise ValueError(f"Unsupported model: {model_key}")
+async def _run_once(
+    model_key: str,
+    prompt: str,
+    settings: Dict,
+    image_urls: List[str],
+    running: Optional[List[str]] = None,
+) -> str:
+    model_cfg = MODEL_INFO[model_key]
+    payload = _build_payload(model_key, prompt, settings, image_urls)
+    output = await _replicate_run(model_key, payload, running)
+
+    image_url = _extract_url(output)
+    if image_url is None:
+        raise ValueError(f"Не удалось получить URL изображения от {model_cfg['label']}")
+    return image_url
+
+
+async def run_model(
+    prompt: str,
+    settings: Dict,
+    image_urls: Optional[List[str]] = None,
+    route: Optional[Dict] = None,
+) -> str:
+    """
+    Запускает модель из settings с учётом здоровья моделей (core.routing):
+    деградировавшая модель подменяется запасной, при сбое — следующая по цепочке.
+
+    Возвращает URL результата. В route (если передан) записывается, что
+    реально отработало: requested, model, decision, reason — для лога генерации.
+    """
+    model_key = settings.get("model", "banana")
+    if model_key not in MODEL_INFO:
+        model_key = "banana"
+
+    image_urls = image_urls or []
+    candidates, decision, reason = routing.plan(model_key)
+
+    logger.info(
+        "run_model: model=%s, route=%s (%s), prompt_len=%s, images=%s",
+        model_key, candidates[0], decision, len(prompt), len(image_urls),
+    )
+    logger.debug("run_model prompt: %s", prompt[:200])
+
+    for i, candidate in enumerate(candidates):
+        has_next = i + 1 < len(candidates)
+        # Пока есть запасной вариант, медленную модель не ждём до таймаута Replicate
+        fail_after = MODEL_INFO[candidate].get("routing", {}).get("fail_after") if has_next else None
+        running: List[str] = []  # созданные, но не завершившиеся предсказания попытки
+        started = time.monotonic()
+        try:
+            attempt = _run_once(candidate, prompt, settings, image_urls, running)
+            image_url = await (asyncio.wait_for(attempt, fail_after) if fail_after else attempt)
+        except asyncio.CancelledError:
+            # Дедлайн или отмена пакета — результат уже никто не заберёт.
+            # Остановка процесса при записи в журнале — предсказание доведёт recover()
+            left = deadline.remaining()
+            if running and ((left is not None and left <= 0) or not inflight.journaled()):
+                await deadline.shielded(_cancel_running(running))
+            raise
+        except Exception as e:
+            # Брошенное ожидание (fail_after, таймаут, дедлайн, сбой сети) — отменяем
+            # предсказание, иначе Replicate выставит счёт и за него, и за запасную модель
+            if running:
+                await deadline.shielded(_cancel_running(running))
+            if not isinstance(e, (deadline.DeadlineExceeded, ValueError)):
+                routing.record(candidate, time.monotonic() - started, ok=False)
+
+            left = deadline.remaining()
+            enough_time = left is None or left >= routing.MIN_FALLBACK_BUDGET
+            if has_next and enough_time and routing.is_failover_error(e):
+                logger.warning(
+                    "Model %s failed (%s), falling back to %s",
+                    candidate, e.__class__.__name__, candidates[i + 1],
+                )
+                decision, reason = "fallback", f"{candidate}: {e.__class__.__name__}"
+                continue
+            raise
+
+        routing.record(candidate, time.monotonic() - started, ok=True)
+        if route is not None:
+            route.update(requested=model_key, model=candidate, decision=decision, reason=reason)
+        return image_url
+
+    raise RuntimeError("unreachable")
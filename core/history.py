@@ -0,0 +1,41 @@
+from typing import Dict, List, Optional, Tuple
+
+from .cache import TTLCache
+from .storage import get_storage
+
+HISTORY_PAGE_SIZE = 5
+MAX_PAGES_PER_USER = 50
+
+# Per-user LRU: user_id -> {(cursor, direction): страница}.
+# Вытесняются целиком давно не заходившие пользователи; новая генерация
+# пользователя (log_generation) сбрасывает все его страницы.
+_history_cache = TTLCache(maxsize=2000, ttl=600.0)
+
+HistoryPage = Tuple[List[Dict], Optional[str], Optional[str]]
+
+
+async def get_history_page(
+    user_id: int,
+    cursor: Optional[str] = None,
+    direction: str = "next",
+) -> HistoryPage:
+    """Страница /history: (generations, next_cursor, prev_cursor), из кэша если есть."""
+    pages = _history_cache.get(user_id)
+    if pages is None:
+        pages = {}
+        _history_cache.set(user_id, pages)
+
+    key = (cursor, direction)
+    page = pages.get(key)
+    if page is None:
+        page = await get_storage().fetch_generations_page(
+            user_id, cursor, direction, limit=HISTORY_PAGE_SIZE
+        )
+        if len(pages) >= MAX_PAGES_PER_USER:
+            pages.clear()
+        pages[key] = page
+    return page
+
+
+def invalidate_history(user_id: int) -> None:
+    _history_cache.pop(user_id)
@@ -0,0 +1,42 @@
+from typing import Optional
+
+import httpx
+
+# Общий пул соединений для Supabase и прочих HTTP-вызовов:
+# keep-alive и TLS-сессии переиспользуются между запросами.
+_client: Optional[httpx.AsyncClient] = None
+
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=DEFAULT_TIMEOUT)
+    return _client
+
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+class DownloadTooLarge(Exception):
+    """Файл больше допустимого размера — скачивание прервано."""
+
+
+async def download_bytes(url: str, max_bytes: int, timeout: float = 60.0) -> bytes:
+    """Потоково скачивает url в память, не больше max_bytes."""
+    buf = bytearray()
+    async with get_http_client().stream(
+        "GET", url, timeout=timeout, follow_redirects=True
+    ) as resp:
+        resp.raise_for_status()
+        async for chunk in resp.aiter_bytes():
+            buf.extend(chunk)
+            if len(buf) > max_bytes:
+                raise DownloadTooLarge(f"more than {max_bytes} bytes")
+    return bytes(buf)
@@ -0,0 +1,123 @@
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# PROCESS POOL
+# ---------------------------------------------------------
+# Декодирование и пережатие картинок — чистый CPU. В event loop это
+# останавливало бы все апдейты, в потоке — упиралось бы в GIL, поэтому
+# работа уходит в отдельные процессы. Pillow импортируется только в них.
+
+IMAGING_WORKERS = max(1, min(2, (os.cpu_count() or 1) - 1))
+PREVIEW_MAX_SIDE = 2560          # больше Telegram всё равно не покажет
+PREVIEW_MAX_BYTES = 3 * 1024 * 1024
+PREVIEW_QUALITY = 88
+PREVIEW_MIN_QUALITY = 60
+REFERENCE_QUALITY = 90
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGING_WORKERS)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+def _warm_sync() -> None:
+    import PIL.Image  # noqa: F401
+
+
+async def warm_pool() -> None:
+    """Поднимает процессы пула и импортирует в них Pillow заранее, до первой картинки."""
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    await asyncio.gather(*(loop.run_in_executor(pool, _warm_sync) for _ in range(IMAGING_WORKERS)))
+
+
+async def _run_in_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool(), func, *args)
+
+
+# ---------------------------------------------------------
+# WORKERS (выполняются в дочерних процессах)
+# ---------------------------------------------------------
+
+def _transcode_sync(
+    data: bytes, fmt: str, max_side: int, max_bytes: int, quality: int
+) -> bytes:
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as src:
+        src.load()
+        img = src
+        if fmt == "JPEG" and img.mode != "RGB":
+            # прозрачность JPEG не умеет — кладём на белый фон
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif fmt == "WEBP" and img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        while True:
+            out = io.BytesIO()
+            img.save(out, fmt, quality=quality, optimize=True)
+            if out.tell() <= max_bytes or quality <= PREVIEW_MIN_QUALITY:
+                return out.getvalue()
+            quality -= 8
+
+
+def _reference_sync(data: bytes, max_side: int, quality: int) -> bytes:
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as src:
+        # Поворот из EXIF применяем к пикселям: сами метаданные дальше не пишем
+        img = ImageOps.exif_transpose(src)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
+
+
+# ---------------------------------------------------------
+# API
+# ---------------------------------------------------------
+
+async def transcode_preview(
+    data: bytes,
+    fmt: str = "JPEG",
+    max_side: int = PREVIEW_MAX_SIDE,
+    max_bytes: int = PREVIEW_MAX_BYTES,
+) -> bytes:
+    """
+    Превью для отправки фотографией: не больше max_side по длинной стороне
+    и (по возможности) не больше max_bytes. fmt — JPEG или WEBP.
+    """
+    return await _run_in_pool(_transcode_sync, data, fmt, max_side, max_bytes, PREVIEW_QUALITY)
+
+
+async def prepare_reference_image(data: bytes, max_side: int) -> bytes:
+    """
+    Референс для модели: JPEG без EXIF/GPS и прочих метаданных,
+    не больше max_side по длинной стороне.
+    """
+    return await _run_in_pool(_reference_sync, data, max_side, REFERENCE_QUALITY)
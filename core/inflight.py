@@ -0,0 +1,275 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, Optional
+
+from telegram import Bot
+
+from . import deadline
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# IN-FLIGHT PREDICTIONS
+# ---------------------------------------------------------
+# Replicate считает предсказание, даже если процесс бота упал, не дождавшись
+# результата (деплой, OOM). Поэтому генерация из чата или API идёт под track():
+# - запись в inflight_predictions (пользователь, чат, промт, настройки,
+#   стоимость) появляется до запуска предсказания;
+# - id предсказания дописывается сразу после его создания (core.generators);
+# - запись удаляется, как только генерация проведена (settle_generation)
+#   или пользователю сказано, что токены не списаны.
+# При старте воркера (main.post_init) recover() разбирает оставшиеся записи:
+# готовое — проводится и отправляется в чат, упавшее или не начатое —
+# пользователь узнаёт, что токены не списаны.
+# Пакет (core.batch) журналирует резерв: запись с settings {"batch": true}
+# появляется до списания, cost — ещё не израсходованная часть резерва.
+# Упавший пакет recover() не доигрывает, а возвращает этот остаток.
+
+RECOVERY_WAIT = 600.0                  # сек: столько ждём предсказание, которое ещё идёт
+RECOVERY_MAX_AGE = 3600.0              # сек: результаты Replicate по API живут около часа
+
+# Слот воркера (cluster.py): каждый воркер разбирает только свои записи,
+# чужие в этот момент могут быть ещё в работе
+_worker = 0
+
+# Запись журнала текущей генерации: {"id", "done"}. Словарь, а не id: копии
+# контекста (shielded-задачи) отмечают закрытие в том же объекте
+_entry: ContextVar[Optional[Dict]] = ContextVar("inflight_entry", default=None)
+
+
+def set_worker(slot: int) -> None:
+    global _worker
+    _worker = slot
+
+
+async def _close(entry: Optional[Dict]) -> None:
+    if entry is None or entry["done"] or entry["id"] is None:
+        return
+    entry["done"] = True
+    try:
+        await get_storage().delete_inflight(entry["id"])
+    except Exception as e:
+        logger.warning("Could not close inflight entry %s: %s", entry["id"], e)
+
+
+@asynccontextmanager
+async def track(user_id: int, chat_id: int, prompt: str, settings: Dict, cost: int) -> AsyncIterator[None]:
+    """
+    Ведёт запись журнала для генерации внутри блока. Ошибка или дедлайн —
+    запись закрывается (пользователю сообщают, что токены не списаны);
+    отмена при остановке процесса — запись остаётся для recover().
+    Журнал недоступен — генерация идёт без него.
+    """
+    row = {
+        "worker": _worker,
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "prompt": prompt,
+        "settings": settings,
+        "cost": cost,
+    }
+    try:
+        entry_id = await get_storage().insert_inflight(row)
+    except Exception as e:
+        logger.warning("Inflight journal unavailable, user %s runs untracked: %s", user_id, e)
+        entry_id = None
+
+    entry = {"id": entry_id, "done": False}
+    token = _entry.set(entry)
+    try:
+        yield
+    except asyncio.CancelledError:
+        left = deadline.remaining()
+        if left is not None and left <= 0:
+            await deadline.shielded(_close(entry))
+        raise
+    except BaseException:
+        await deadline.shielded(_close(entry))
+        raise
+    else:
+        await _close(entry)
+    finally:
+        _entry.reset(token)
+
+
+async def dispatched(model_key: str, prediction_id: str) -> None:
+    """Предсказание создано: id и модель — в запись текущей генерации."""
+    entry = _entry.get()
+    if entry is None or entry["id"] is None:
+        return
+    try:
+        await get_storage().update_inflight(
+            entry["id"], {"model": model_key, "prediction_id": prediction_id}
+        )
+    except Exception as e:
+        logger.warning("Could not journal prediction %s: %s", prediction_id, e)
+
+
+async def journal_reservation(user_id: int, chat_id: int, cost: int) -> Optional[int]:
+    """Запись о резерве пакета; None — журнал недоступен, пакет идёт без него."""
+    row = {
+        "worker": _worker,
+        "user_id": user_id,
+        "chat_id": chat_id,
+        "prompt": "batch",
+        "settings": {"batch": True},
+        "cost": cost,
+    }
+    try:
+        return await get_storage().insert_inflight(row)
+    except Exception as e:
+        logger.warning("Inflight journal unavailable, batch of user %s runs untracked: %s", user_id, e)
+        return None
+
+
+async def reservation_left(entry_id: Optional[int], unspent: int) -> None:
+    """Часть резерва проведена: в записи остаётся неизрасходованный остаток."""
+    if entry_id is None:
+        return
+    try:
+        await get_storage().update_inflight(entry_id, {"cost": unspent})
+    except Exception as e:
+        logger.warning("Could not journal batch reservation %s: %s", entry_id, e)
+
+
+async def close_entry(entry_id: Optional[int]) -> None:
+    """Закрывает запись не из контекста track() (резерв пакета)."""
+    await _close({"id": entry_id, "done": False})
+
+
+def journaled() -> bool:
+    """Текущая генерация записана в журнал — после остановки процесса её подхватит recover()."""
+    entry = _entry.get()
+    return entry is not None and entry["id"] is not None and not entry["done"]
+
+
+def entry_id() -> Optional[int]:
+    """id записи текущей генерации — ключ идемпотентного проведения (None — журнала нет)."""
+    entry = _entry.get()
+    return entry["id"] if entry is not None else None
+
+
+async def settled() -> None:
+    """Генерация проведена — запись больше не нужна (вызывает settle_generation)."""
+    await _close(_entry.get())
+
+
+# ---------------------------------------------------------
+# RECOVERY
+# ---------------------------------------------------------
+
+RECOVERED_TEXT = "♻️ Бот перезапускался, пока шла генерация, — вот результат."
+BATCH_REFUNDED_TEXT = (
+    "♻️ Бот перезапускался, пока шёл пакет, и он прервался.\n"
+    "Возвращено {refund} токенов за необработанные промты. Баланс: {balance}."
+)
+NOT_RECOVERED_TEXT = (
+    "♻️ Бот перезапускался, пока шла генерация, и она не завершилась.\n"
+    "Токены не списаны — отправьте запрос ещё раз."
+)
+
+
+def _age(entry: Dict) -> float:
+    created = datetime.fromisoformat(str(entry["created_at"]).replace("Z", "+00:00"))
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - created).total_seconds()
+
+
+async def _recover_batch(bot: Bot, entry: Dict) -> None:
+    from .batch import refund_reservation  # локальный импорт, чтобы избежать циклов
+    from .outbound import outbound
+
+    chat_id = entry["chat_id"]
+    refund, balance = await refund_reservation(entry["user_id"], entry["id"], entry["cost"])
+    await get_storage().delete_inflight(entry["id"])
+    if refund > 0:
+        text = BATCH_REFUNDED_TEXT.format(refund=refund, balance=balance)
+        await outbound.send(chat_id, lambda: bot.send_message(chat_id, text))
+
+
+async def _recover_entry(bot: Bot, entry: Dict) -> None:
+    # локальный импорт, чтобы избежать циклов
+    from config import MODEL_INFO
+    from .balance import settle_generation
+    from .delivery import deliver_image_to_chat
+    from .generators import resume_prediction
+    from .outbound import outbound
+
+    chat_id = entry["chat_id"]
+    settings = entry["settings"]
+    requested = settings.get("model", "banana")
+    model_key = entry.get("model") or requested
+
+    image_url = None
+    if entry.get("prediction_id"):
+        try:
+            image_url = await resume_prediction(entry["prediction_id"], RECOVERY_WAIT)
+        except asyncio.TimeoutError:
+            logger.warning("Prediction %s did not finish after restart", entry["prediction_id"])
+
+    if image_url is None:
+        await get_storage().delete_inflight(entry["id"])
+        await outbound.send(chat_id, lambda: bot.send_message(chat_id, NOT_RECOVERED_TEXT))
+        return
+
+    route = {
+        "requested": requested,
+        "model": model_key,
+        "decision": "primary" if model_key == requested else "fallback",
+        "reason": "recovered after restart",
+    }
+    _entry.set({"id": entry["id"], "done": False})
+    used_cost, new_balance = await settle_generation(
+        entry["user_id"], entry["prompt"], image_url, settings, entry["cost"], route=route
+    )
+    await deliver_image_to_chat(bot, chat_id, image_url, settings.get("output_format", "png"))
+
+    text = RECOVERED_TEXT
+    if used_cost > 0:
+        text += f"\nСписано {used_cost} токенов. Новый баланс: {new_balance}."
+    if model_key != requested and model_key in MODEL_INFO:
+        text += f"\nКартинку сделала {MODEL_INFO[model_key]['label']}."
+    await outbound.send(chat_id, lambda: bot.send_message(chat_id, text))
+
+
+async def recover(bot: Bot) -> None:
+    """Разбирает записи, оставшиеся от прошлого запуска этого воркера."""
+    try:
+        entries = await get_storage().fetch_inflight(_worker)
+    except Exception as e:
+        logger.warning("Could not read inflight journal: %s", e)
+        return
+    if not entries:
+        return
+
+    logger.info("Recovering %s in-flight generations of worker %s", len(entries), _worker)
+    fresh = []
+    for entry in entries:
+        if entry["settings"].get("batch"):
+            # резерв возвращается в любом возрасте записи
+            fresh.append(entry)
+        elif _age(entry) > RECOVERY_MAX_AGE:
+            logger.warning(
+                "Dropping stale inflight entry %s (user %s, prediction %s)",
+                entry["id"], entry["user_id"], entry.get("prediction_id"),
+            )
+            await get_storage().delete_inflight(entry["id"])
+        else:
+            fresh.append(entry)
+
+    results = await asyncio.gather(
+        *(
+            _recover_batch(bot, entry) if entry["settings"].get("batch") else _recover_entry(bot, entry)
+            for entry in fresh
+        ),
+        return_exceptions=True,
+    )
+    for entry, result in zip(fresh, results):
+        if isinstance(result, Exception):
+            # Запись остаётся — следующий запуск попробует ещё раз
+            logger.error("Recovery of inflight entry %s failed: %r", entry["id"], result)
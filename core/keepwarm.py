@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional
+
+from config import MODEL_INFO, KEEPWARM_ACTIVE_HOURS, KEEPWARM_DAILY_BUDGET_USD
+from . import resilience
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# KEEP-WARM
+# ---------------------------------------------------------
+# Модели с ключом "keepwarm" в MODEL_INFO после простоя выгружаются Replicate,
+# и следующая генерация ждёт холодный старт. Планировщик следит за последним
+# использованием каждой модели и в активные часы запускает дешёвый прогрев
+# незадолго до того, как модель остынет — в пределах дневного бюджета.
+#
+# Латентность реальных запусков пишется отдельно для «холодных» (после простоя
+# дольше idle_after) и «тёплых» — по ним видно, окупается ли прогрев.
+# В кластере (cluster.py) планировщик работает в одном воркере и видит
+# только его запуски, поэтому прежде чем греть модель, которая выглядит
+# простаивающей (и после рестарта), он сверяется с последней генерацией
+# модели в generations — её пишут все воркеры.
+# Потраченное за день хранится в keepwarm_spend (migrations/013): рестарт
+# не обнуляет бюджет. Пока расход за день не прочитан, прогрева нет.
+
+CHECK_INTERVAL = 30.0
+DEFAULT_IDLE_AFTER = 300.0
+WARM_MARGIN = 45.0          # греем за столько секунд до предполагаемого остывания
+LATENCY_WINDOW = 200
+
+
+class _ModelUsage:
+    def __init__(self) -> None:
+        self.last_active: Optional[float] = None
+        self.cold: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.warm: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.warmup: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.warmups = 0
+        self.warmup_failures = 0
+
+
+def _median(values: Deque[float]) -> Optional[float]:
+    return statistics.median(values) if values else None
+
+
+class KeepWarm:
+    def __init__(self, models: Dict[str, Dict] = MODEL_INFO) -> None:
+        self.models = models
+        self._key_by_replicate = {cfg["replicate"]: key for key, cfg in models.items()}
+        self._usage = {key: _ModelUsage() for key in models}
+        self._spend_day: Optional[str] = None
+        self.spent_today_usd = 0.0
+        self._warmups_today = 0
+
+    def _idle_after(self, key: str) -> float:
+        return float(self.models[key].get("keepwarm", {}).get("idle_after", DEFAULT_IDLE_AFTER))
+
+    def _idle_for(self, key: str, now: float) -> float:
+        last = self._usage[key].last_active
+        return float("inf") if last is None else now - last
+
+    def record_run(self, replicate_id: str, latency: float) -> None:
+        """Учитывает успешную генерацию: латентность и время последней активности."""
+        key = self._key_by_replicate.get(replicate_id)
+        if key is None:
+            return
+        usage = self._usage[key]
+        now = time.monotonic()
+        # Простой считаем от конца прошлого запуска до начала этого
+        cold = self._idle_for(key, now - latency) > self._idle_after(key)
+        (usage.cold if cold else usage.warm).append(latency)
+        usage.last_active = now
+
+    # ---------- планировщик ----------
+
+    async def _load_spend(self) -> bool:
+        """Расход за сегодня из хранилища; False — прочитать не удалось."""
+        today = datetime.now(timezone.utc).date().isoformat()
+        if today == self._spend_day:
+            return True
+        try:
+            row = await get_storage().fetch_keepwarm_spend(today)
+        except Exception as e:
+            logger.warning("Could not load keep-warm spend: %s", e)
+            return False
+        self._spend_day = today
+        self.spent_today_usd = float(row["spent_usd"]) if row else 0.0
+        self._warmups_today = int(row["warmups"]) if row else 0
+        return True
+
+    async def _save_spend(self) -> None:
+        try:
+            await get_storage().save_keepwarm_spend({
+                "day": self._spend_day,
+                "spent_usd": self.spent_today_usd,
+                "warmups": self._warmups_today,
+            })
+        except Exception as e:
+            logger.warning("Could not save keep-warm spend: %s", e)
+
+    def _budget_allows(self, cost: float) -> bool:
+        return self.spent_today_usd + cost <= KEEPWARM_DAILY_BUDGET_USD
+
+    async def _sync_last_active(self, key: str, now: float) -> None:
+        """Последний запуск модели по generations — в том числе в других воркерах."""
+        try:
+            created_at = await get_storage().last_generation_at(self.models[key]["replicate"])
+        except Exception as e:
+            logger.warning("Could not read last run of %s: %s", key, e)
+            return
+        if created_at is None:
+            return
+        created = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=timezone.utc)
+        ago = max(0.0, (datetime.now(timezone.utc) - created).total_seconds())
+        usage = self._usage[key]
+        if usage.last_active is None or now - ago > usage.last_active:
+            usage.last_active = now - ago
+
+    @staticmethod
+    def _in_active_hours() -> bool:
+        start, end = KEEPWARM_ACTIVE_HOURS
+        return start <= datetime.now(timezone.utc).hour < end
+
+    async def _warm(self, key: str, cfg: Dict) -> None:
+        from .generators import get_replicate_client  # локальный импорт, чтобы избежать циклов
+
+        usage = self._usage[key]
+        self.spent_today_usd += float(cfg.get("cost_usd", 0.0))
+        self._warmups_today += 1
+        usage.warmups += 1
+        await self._save_spend()
+        started = time.monotonic()
+
+        async def attempt(timeout: float):
+            return await get_replicate_client().async_run(
+                self.models[key]["replicate"], input=cfg.get("payload", {})
+            )
+
+        try:
+            await resilience.call("replicate.warmup", attempt, dependency="replicate")
+        except Exception as e:
+            # Даже ошибка модели означает, что контейнер поднят — простой сбрасываем
+            usage.warmup_failures += 1
+            logger.warning("Warm-up of %s failed: %r", key, e)
+        elapsed = time.monotonic() - started
+        usage.warmup.append(elapsed)
+        usage.last_active = time.monotonic()
+        logger.info("Warm-up of %s took %.1fs", key, elapsed)
+
+    async def tick(self) -> None:
+        if not self._in_active_hours():
+            return
+        if not await self._load_spend():
+            return
+        now = time.monotonic()
+        for key, model_cfg in self.models.items():
+            cfg = model_cfg.get("keepwarm")
+            if not cfg:
+                continue
+            if self._idle_for(key, now) < self._idle_after(key) - WARM_MARGIN:
+                continue
+            await self._sync_last_active(key, now)
+            if self._idle_for(key, now) < self._idle_after(key) - WARM_MARGIN:
+                continue
+            if not self._budget_allows(float(cfg.get("cost_usd", 0.0))):
+                logger.info("Keep-warm budget for today is spent, %s is left to cool", key)
+                continue
+            await self._warm(key, cfg)
+
+    # ---------- отчёт ----------
+
+    def report(self) -> List[Dict]:
+        now = time.monotonic()
+        rows = []
+        for key in self.models:
+            usage = self._usage[key]
+            idle = self._idle_for(key, now)
+            rows.append({
+                "model": key,
+                "keepwarm": bool(self.models[key].get("keepwarm")),
+                "idle_s": None if idle == float("inf") else round(idle),
+                "cold_runs": len(usage.cold),
+                "cold_median_s": _median(usage.cold),
+                "warm_runs": len(usage.warm),
+                "warm_median_s": _median(usage.warm),
+                "warmups": usage.warmups,
+                "warmup_failures": usage.warmup_failures,
+                "warmup_median_s": _median(usage.warmup),
+            })
+        return rows
+
+
+keepwarm = KeepWarm()
+
+
+async def run_keepwarm_loop(interval: float = CHECK_INTERVAL) -> None:
+    while True:
+        try:
+            await keepwarm.tick()
+        except Exception as e:
+            logger.warning("Keep-warm tick failed: %s", e)
+        await asyncio.sleep(interval)
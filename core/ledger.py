@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from .deadline import spawn_detached
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# BATCHED LEDGER WRITER
+# ---------------------------------------------------------
+# Все изменения баланса — записи в token_ledger (migrations/003_token_ledger.sql).
+# Записи, пришедшие почти одновременно, уходят одним rpc ledger_append;
+# каждый вызывающий получает результат своей записи из ответа — запись
+# для несуществующего пользователя не роняет чужие записи пачки.
+
+FLUSH_DELAY = 0.05       # сек: окно, в которое копится пачка
+MAX_BATCH = 200
+COMPACTION_INTERVAL = 60.0
+
+
+class InsufficientTokens(Exception):
+    """Списанию mode="debit" не хватило баланса; balance — баланс на момент проверки."""
+
+    def __init__(self, balance: int) -> None:
+        super().__init__(f"insufficient balance: {balance}")
+        self.balance = balance
+
+
+class LedgerWriter:
+    def __init__(self, flush_delay: float = FLUSH_DELAY, max_batch: int = MAX_BATCH) -> None:
+        self.flush_delay = flush_delay
+        self.max_batch = max_batch
+        self._pending: List[tuple[Dict, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._inflight: set[asyncio.Task] = set()
+
+    async def append(
+        self,
+        user_id: int,
+        delta: int,
+        reason: str,
+        payment_charge_id: Optional[str] = None,
+        generation_id: Optional[int] = None,
+        admin_action_id: Optional[int] = None,
+        mode: str = "add",
+        inflight_id: Optional[int] = None,
+    ) -> Optional[Dict]:
+        """
+        Добавляет запись в журнал и ждёт, пока пачка будет записана.
+        mode — как delta применяется к балансу (core.storage.LEDGER_MODES).
+        Возвращает строку user_accounts пользователя (с новым балансом) или None,
+        если пользователя нет. Отказ debit — InsufficientTokens. Повтор
+        payment_charge_id или inflight_id ничего не пишет и возвращает текущую строку.
+        """
+        entry = {
+            "user_id": user_id,
+            "delta": delta,
+            "mode": mode,
+            "reason": reason,
+            "payment_charge_id": payment_charge_id,
+            "generation_id": generation_id,
+            "admin_action_id": admin_action_id,
+            "inflight_id": inflight_id,
+        }
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((entry, fut))
+
+        if len(self._pending) >= self.max_batch:
+            self._flush_now()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_delay, self._flush_now)
+
+        # shield: отмена вызывающего не должна «потерять» уже отправленную запись
+        return await asyncio.shield(fut)
+
+    def _flush_now(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        # Пачка общая для разных апдейтов — дедлайн того, кто её «закрыл», не наследуем
+        task = spawn_detached(self._write(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _write(self, batch: List[tuple[Dict, asyncio.Future]]) -> None:
+        try:
+            rows = await get_storage().ledger_append([entry for entry, _ in batch])
+        except Exception as e:
+            logger.error("ledger_append failed for %s entries: %s", len(batch), e)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for (entry, fut), result in zip(batch, rows):
+            if result["status"] == "no_user":
+                logger.warning("Ledger entry for unknown user %s dropped: %s", entry["user_id"], entry["reason"])
+            if fut.done():
+                continue
+            if result["status"] == "insufficient":
+                fut.set_exception(InsufficientTokens(result["account"]["balance"]))
+            else:
+                fut.set_result(result["account"])
+
+    async def flush(self) -> None:
+        """Дописывает всё накопленное (при остановке бота)."""
+        self._flush_now()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+
+ledger = LedgerWriter()
+
+
+# ---------------------------------------------------------
+# COMPACTION
+# ---------------------------------------------------------
+
+async def run_compaction_loop(interval: float = COMPACTION_INTERVAL) -> None:
+    """Периодически сворачивает хвост журнала в telegram_users.balance."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            users = await get_storage().compact_ledger()
+            if users:
+                logger.info("Ledger compaction: %s users updated", users)
+        except Exception as e:
+            logger.warning("Ledger compaction failed: %s", e)
@@ -0,0 +1,271 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram.error import RetryAfter
+
+from .cache import TTLCache
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# LIMITS
+# ---------------------------------------------------------
+# Лимиты Telegram Bot API: ~30 сообщений/с на бота,
+# ~1 сообщение/с в личный чат (с небольшим всплеском), 20 сообщений/мин в группу.
+
+GLOBAL_RATE = 30.0
+PRIVATE_CHAT_RATE = 1.0
+PRIVATE_CHAT_BURST = 3.0
+GROUP_CHAT_RATE = 20.0 / 60.0
+GROUP_CHAT_BURST = 5.0
+
+SEND_WORKERS = 4
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Чем меньше число, тем раньше уходит сообщение
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 10
+
+SendFactory = Callable[[], Awaitable[Any]]
+
+
+def _retry_after_seconds(err: RetryAfter) -> float:
+    value = err.retry_after
+    if hasattr(value, "total_seconds"):
+        return float(value.total_seconds())
+    return float(value)
+
+
+class _Job:
+    __slots__ = ("chat_id", "factory", "future", "priority", "attempts", "enqueued_at")
+
+    def __init__(self, chat_id: int, factory: SendFactory, future: asyncio.Future, priority: int):
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.priority = priority
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundQueue:
+    """
+    Центральная очередь исходящих сообщений в Telegram.
+    - глобальный token bucket (~30/с) и отдельный bucket на каждый чат
+    - интерактивные ответы обгоняют уведомления (приоритетная очередь)
+    - RetryAfter (429) не теряет сообщение: чат ставится на паузу, отправка повторяется
+    Пока очередь не запущена (start), отправка идёт напрямую.
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS) -> None:
+        self._workers_count = workers
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        # Простаивающие ведра можно выбрасывать: через минуту они всё равно полные
+        self._chat_buckets = TTLCache(maxsize=50_000, ttl=60.0)
+        self._chat_paused_until = TTLCache(maxsize=10_000, ttl=300.0)
+        self._depth_by_priority: Dict[int, int] = {}
+        # Задачи, ждущие паузы чата / RetryAfter вне очереди
+        self._deferred: Dict[_Job, asyncio.TimerHandle] = {}
+        self._stats = {
+            "sent": 0,
+            "failed": 0,
+            "retry_after": 0,
+            "max_depth": 0,
+            "max_wait_ms": 0,
+        }
+
+    # ---------- lifecycle ----------
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"outbound-{i}")
+            for i in range(self._workers_count)
+        ]
+        logger.info("Outbound queue started with %s workers", self._workers_count)
+
+    async def stop(self) -> None:
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        # Невзятые и отложенные отправки уже не уйдут: отменяем их future,
+        # чтобы ждущие send() не висели до своего дедлайна
+        pending = list(self._deferred)
+        for handle in self._deferred.values():
+            handle.cancel()
+        self._deferred.clear()
+        while self._queue is not None and not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            self._queue.task_done()
+            pending.append(job)
+        self._depth_by_priority.clear()
+
+        dropped = 0
+        for job in pending:
+            if not job.future.done():
+                job.future.cancel()
+                dropped += 1
+        if dropped:
+            logger.warning("Outbound queue stopped, %s queued sends cancelled", dropped)
+
+    def set_global_rate(self, rate: float) -> None:
+        """Глобальный лимит бота; в кластере (cluster.py) он делится между воркерами."""
+        self._global_bucket = TokenBucket(rate, rate)
+
+    # ---------- API ----------
+
+    async def send(
+        self,
+        chat_id: int,
+        factory: SendFactory,
+        priority: int = PRIORITY_INTERACTIVE,
+    ) -> Any:
+        """Ставит отправку в очередь и ждёт результата (Message и т.п.)."""
+        if not self.running:
+            return await factory()
+        return await self._enqueue(chat_id, factory, priority)
+
+    def submit(
+        self,
+        chat_id: int,
+        factory: SendFactory,
+        priority: int = PRIORITY_NOTIFICATION,
+    ) -> asyncio.Future:
+        """Отправка «выстрелил и забыл»: ошибки только логируются."""
+        if self.running:
+            fut = self._enqueue(chat_id, factory, priority)
+        else:
+            fut = asyncio.ensure_future(factory())
+        fut.add_done_callback(lambda f, cid=chat_id: self._log_failure(f, cid))
+        return fut
+
+    def metrics(self) -> Dict[str, Any]:
+        depth = self._queue.qsize() if self._queue else 0
+        return {
+            "running": self.running,
+            "depth": depth,
+            "depth_by_priority": dict(self._depth_by_priority),
+            "deferred": len(self._deferred),
+            **self._stats,
+        }
+
+    # ---------- internals ----------
+
+    def _enqueue(self, chat_id: int, factory: SendFactory, priority: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._put(_Job(chat_id, factory, fut, priority))
+        return fut
+
+    def _put(self, job: _Job) -> None:
+        self._queue.put_nowait((job.priority, next(self._seq), job))
+        self._depth_by_priority[job.priority] = self._depth_by_priority.get(job.priority, 0) + 1
+        self._stats["max_depth"] = max(self._stats["max_depth"], self._queue.qsize())
+
+    def _defer(self, job: _Job, delay: float) -> None:
+        """Возвращает задачу в очередь через delay секунд, не занимая воркер."""
+
+        def _requeue() -> None:
+            self._deferred.pop(job, None)
+            if self.running and not job.future.done():
+                self._put(job)
+
+        self._deferred[job] = asyncio.get_running_loop().call_later(delay, _requeue)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+        # set продлевает TTL активного чата
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            self._depth_by_priority[job.priority] -= 1
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception:
+                logger.exception("Outbound worker error")
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: _Job) -> None:
+        if job.future.done():
+            return
+
+        paused_until = self._chat_paused_until.get(job.chat_id)
+        if paused_until and paused_until > time.monotonic():
+            self._defer(job, paused_until - time.monotonic())
+            return
+
+        delay = self._chat_bucket(job.chat_id).try_consume()
+        if delay > 0:
+            self._defer(job, delay)
+            return
+
+        await self._global_bucket.consume()
+
+        wait_ms = int((time.monotonic() - job.enqueued_at) * 1000)
+        self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], wait_ms)
+
+        try:
+            result = await job.factory()
+        except RetryAfter as e:
+            self._stats["retry_after"] += 1
+            retry_in = _retry_after_seconds(e)
+            job.attempts += 1
+            self._chat_paused_until.set(
+                job.chat_id, time.monotonic() + retry_in, ttl=retry_in + 1.0
+            )
+            if job.attempts > MAX_RETRY_AFTER_ATTEMPTS:
+                self._stats["failed"] += 1
+                job.future.set_exception(e)
+                return
+            logger.warning(
+                "RetryAfter %.1fs for chat %s (attempt %s)", retry_in, job.chat_id, job.attempts
+            )
+            self._defer(job, retry_in)
+            return
+        except Exception as e:
+            self._stats["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+
+        self._stats["sent"] += 1
+        if not job.future.done():
+            job.future.set_result(result)
+
+    @staticmethod
+    def _log_failure(fut: asyncio.Future, chat_id: int) -> None:
+        if fut.cancelled():
+            return
+        err = fut.exception()
+        if err is not None:
+            logger.warning("Не удалось отправить уведомление пользователю %s: %s", chat_id, err)
+
+
+outbound = OutboundQueue()
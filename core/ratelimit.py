@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity.
+    Не потокобезопасен — рассчитан на работу внутри одного event loop.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+    def try_consume(self, tokens: float = 1.0) -> float:
+        """
+        Пытается списать tokens. Возвращает 0.0 при успехе,
+        иначе — сколько секунд подождать до следующей попытки.
+        """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def consume(self, tokens: float = 1.0) -> None:
+        """Ждёт, пока в ведре не наберётся tokens, и списывает их."""
+        while True:
+            delay = self.try_consume(tokens)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
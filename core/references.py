@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import io
+import logging
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Sequence, Tuple
+
+from telegram import Bot, PhotoSize
+
+from config import MODEL_INFO
+from . import resilience
+from .cache import TTLCache
+from .generators import get_replicate_client
+from .http import download_bytes
+from .imaging import prepare_reference_image
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# REFERENCE IMAGES
+# ---------------------------------------------------------
+# Ссылка Telegram на файл (file_path) содержит токен бота — наружу её не отдаём.
+# Референс скачиваем сами, чистим метаданные, уменьшаем до полезного для модели
+# размера и передаём в Replicate data URI или загруженным файлом.
+
+TELEGRAM_DOWNLOAD_MAX_BYTES = 20 * 1024 * 1024  # лимит Bot API на getFile
+DATA_URI_MAX_BYTES = 1024 * 1024                # больше — грузим через Files API
+DEFAULT_INPUT_MAX_SIDE = 2048
+
+# ---------------------------------------------------------
+# CACHE
+# ---------------------------------------------------------
+# Чаще всего пользователь правит одно и то же фото разными подписями.
+# Готовый вход модели кэшируем по file_unique_id (стабилен для одного файла
+# у всех ботов) и по sha256 скачанных байт — тогда повторная попытка
+# не делает ни get_file, ни скачивания, ни загрузки в Replicate.
+# Файлы Replicate живут 24 ч: запись истекает с запасом до expires_at.
+# Data URI держим отдельно и меньше штук — они тяжёлые (до 1 МБ каждый).
+
+REFERENCE_CACHE_TTL = 23 * 3600.0
+EXPIRY_MARGIN = 3600.0
+_uploaded_inputs = TTLCache(maxsize=5000, ttl=REFERENCE_CACHE_TTL)
+_inline_inputs = TTLCache(maxsize=128, ttl=REFERENCE_CACHE_TTL)
+
+
+def _cache_get(key: Tuple) -> Optional[Tuple[str, float]]:
+    """(вход модели, time.monotonic() истечения) или None."""
+    return _uploaded_inputs.get(key) or _inline_inputs.get(key)
+
+
+def _cache_set(keys: List[Tuple], value: str, expires: float) -> None:
+    cache = _inline_inputs if value.startswith("data:") else _uploaded_inputs
+    for key in keys:
+        cache.set(key, (value, expires), expires - time.monotonic())
+
+
+def _ttl_until(expires_at: Optional[str]) -> float:
+    if not expires_at:
+        return REFERENCE_CACHE_TTL
+    try:
+        expires = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
+    except ValueError:
+        return REFERENCE_CACHE_TTL
+    left = (expires - datetime.now(timezone.utc)).total_seconds() - EXPIRY_MARGIN
+    return min(REFERENCE_CACHE_TTL, left)
+
+
+def _pick_photo_size(sizes: List[PhotoSize], max_side: int) -> PhotoSize:
+    """Самый маленький вариант фото, которого хватает модели (иначе самый большой)."""
+    for size in sorted(sizes, key=lambda s: max(s.width, s.height)):
+        if max(size.width, size.height) >= max_side:
+            return size
+    return max(sizes, key=lambda s: s.width * s.height)
+
+
+async def _upload_to_replicate(data: bytes, filename: str) -> Tuple[str, float]:
+    """Загружает файл в Replicate. Возвращает (url, сколько секунд его можно кэшировать)."""
+    async def attempt(timeout: float):
+        return await get_replicate_client().files.async_create(
+            io.BytesIO(data), filename=filename, content_type="image/jpeg"
+        )
+
+    file = await resilience.call(
+        "replicate.upload", attempt, dependency="replicate", idempotent=True
+    )
+    return file.urls["get"], _ttl_until(file.expires_at)
+
+
+def _input_max_side(model_key: str) -> int:
+    return MODEL_INFO.get(model_key, {}).get("input_max_side", DEFAULT_INPUT_MAX_SIDE)
+
+
+async def prepare_reference_bytes(
+    raw: bytes, model_key: str, extra_keys: Sequence[Tuple] = ()
+) -> str:
+    """
+    Готовит уже скачанную картинку как вход модели model_key (бот и HTTP API).
+    Возвращает data URI или URL файла в Replicate. extra_keys — дополнительные
+    ключи кэша для того же результата (file_unique_id и т.п.).
+    """
+    max_side = _input_max_side(model_key)
+    digest = hashlib.sha256(raw).hexdigest()
+    hash_key = ("sha256", digest, max_side)
+    cached = _cache_get(hash_key)
+    if cached is not None:
+        logger.info("Reference %s: cache hit by content hash", digest[:12])
+        _cache_set(list(extra_keys), *cached)
+        return cached[0]
+
+    data = await prepare_reference_image(raw, max_side)
+    logger.info("Reference %s prepared: %s -> %s bytes", digest[:12], len(raw), len(data))
+
+    if len(data) <= DATA_URI_MAX_BYTES:
+        value = "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii")
+        ttl = REFERENCE_CACHE_TTL
+    else:
+        value, ttl = await _upload_to_replicate(data, f"{digest[:16]}.jpg")
+
+    _cache_set([*extra_keys, hash_key], value, time.monotonic() + ttl)
+    return value
+
+
+async def prepare_reference(bot: Bot, sizes: List[PhotoSize], model_key: str) -> str:
+    """
+    Готовит фото из сообщения как вход модели model_key.
+    Возвращает data URI или URL файла в Replicate — без токена бота.
+    """
+    max_side = _input_max_side(model_key)
+    photo = _pick_photo_size(sizes, max_side)
+
+    uid_key = ("uid", photo.file_unique_id, max_side)
+    cached = _cache_get(uid_key)
+    if cached is not None:
+        logger.info("Reference %s: cache hit", photo.file_unique_id)
+        return cached[0]
+
+    file = await bot.get_file(photo.file_id)
+    raw = await download_bytes(file.file_path, TELEGRAM_DOWNLOAD_MAX_BYTES)
+    # Тот же файл мог прийти с другим file_unique_id (переотправка) — ловит кэш по хешу
+    return await prepare_reference_bytes(raw, model_key, extra_keys=[uid_key])
@@ -1,10 +1,10 @@
 import logging
-from typing import Optional
+from typing import Dict, Optional
 
 from telegram import User as TgUser
 
 from config import ADMIN_IDS
-from .supabase import supabase_get_user, supabase_insert_user, supabase_update_user
+from .storage import get_storage
 
 logger = logging.getLogger(__name__)
 
@@ -13,9 +13,15 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
-async def register_user(tg_user: Optional[TgUser]) -> None:
+async def register_user(tg_user: Optional[TgUser]) -> Optional[Dict]:
+    """
+    Создаёт или обновляет пользователя и возвращает его профиль из хранилища —
+    без balance (баланс — core.balance.get_balance).
+    Сначала PATCH с return=representation: для существующего пользователя
+    это один запрос вместо GET + PATCH. Пустой ответ — пользователя нет, создаём.
+    """
     if not tg_user:
-        return
+        return None
 
     uid = tg_user.id
     username = tg_user.username
@@ -23,23 +29,24 @@ async def register_user(tg_user: Optional[TgUser]) -> None:
     last_name = tg_user.last_name
 
     try:
-        existing = await supabase_get_user(uid)
-        if existing:
-            payload = {
-                "username": username,
-                "first_name": first_name,
-                "last_name": last_name,
-                "updated_at": "now()",
-            }
-            await supabase_update_user(uid, payload)
-        else:
-            payload = {
-                "id": uid,
-                "username": username,
-                "first_name": first_name,
-                "last_name": last_name,
-                "balance": 0,
-            }
-            await supabase_insert_user(payload)
+        payload = {
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "updated_at": "now()",
+        }
+        user = await get_storage().update_user(uid, payload)
+        if user:
+            return user
+
+        payload = {
+            "id": uid,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "balance": 0,
+        }
+        return await get_storage().insert_user(payload)
     except Exception as e:
         logger.error("register_user error for %s: %s", uid, e)
+    return None
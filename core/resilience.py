@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+
+from . import deadline
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Зависимость помечена как недоступная — запрос даже не отправлялся."""
+
+    def __init__(self, dependency: str, retry_in: float) -> None:
+        super().__init__(f"{dependency} недоступен, повтор через {retry_in:.0f} с")
+        self.dependency = dependency
+        self.retry_in = retry_in
+
+
+class RetryableStatusError(Exception):
+    """HTTP-ответ 5xx/429: запрос можно повторить, зависимость считается сбойной."""
+
+    def __init__(self, response: httpx.Response) -> None:
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+# ---------------------------------------------------------
+# CIRCUIT BREAKER
+# ---------------------------------------------------------
+
+class CircuitBreaker:
+    """
+    closed -> open после failure_threshold сбоев подряд;
+    open -> half_open через reset_timeout (пропускаем одну пробную попытку);
+    half_open -> closed при успехе, снова open при сбое.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        if self.state == "closed":
+            return
+        elapsed = time.monotonic() - self._opened_at
+        if self.state == "open" and elapsed >= self.reset_timeout:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        raise CircuitOpenError(self.name, max(0.0, self.reset_timeout - elapsed))
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("Circuit %s closed", self.name)
+        self.state = "closed"
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Пробная попытка отменена, не дойдя до результата."""
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self._failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning("Circuit %s opened after %s failures", self.name, self._failures)
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+# ---------------------------------------------------------
+# POLICIES
+# ---------------------------------------------------------
+
+class Policy:
+    """
+    Параметры вызова одного эндпоинта:
+    - timeout: таймаут одной попытки, сек
+    - retries: сколько раз повторять (только для идемпотентных вызовов)
+    - backoff_base / backoff_max: экспоненциальная пауза с full jitter
+    - hedge_after: через сколько секунд без ответа отправить дублирующий запрос
+    """
+
+    def __init__(
+        self,
+        timeout: float,
+        retries: int = 0,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2.0,
+        hedge_after: Optional[float] = None,
+    ) -> None:
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+
+
+POLICIES: Dict[str, Policy] = {
+    "supabase.get_user": Policy(timeout=2.0, retries=2, hedge_after=0.4),
+    "supabase.read": Policy(timeout=4.0, retries=2),
+    "supabase.write": Policy(timeout=5.0),
+    "supabase.bulk": Policy(timeout=30.0),
+    "replicate.run": Policy(timeout=180.0),
+    "replicate.upload": Policy(timeout=30.0, retries=1),
+    "replicate.warmup": Policy(timeout=300.0),  # холодный старт модели бывает долгим
+}
+DEFAULT_POLICY = Policy(timeout=10.0)
+
+BREAKERS: Dict[str, CircuitBreaker] = {
+    "supabase": CircuitBreaker("supabase", failure_threshold=5, reset_timeout=15.0),
+    "replicate": CircuitBreaker("replicate", failure_threshold=5, reset_timeout=60.0),
+}
+
+
+def get_breaker(dependency: str) -> CircuitBreaker:
+    """
+    Breaker зависимости. "replicate/<model>" — отдельный breaker модели с параметрами
+    родительского "replicate": сбоящая модель не блокирует запасные (core.routing).
+    """
+    breaker = BREAKERS.get(dependency)
+    if breaker is None:
+        parent = BREAKERS[dependency.split("/", 1)[0]]
+        breaker = CircuitBreaker(dependency, parent.failure_threshold, parent.reset_timeout)
+        BREAKERS[dependency] = breaker
+    return breaker
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    return isinstance(
+        exc,
+        (RetryableStatusError, httpx.TransportError, asyncio.TimeoutError),
+    )
+
+
+def _backoff(policy: Policy, attempt: int) -> float:
+    return random.uniform(0, min(policy.backoff_max, policy.backoff_base * 2 ** attempt))
+
+
+async def _hedged(func: Callable[[float], Awaitable[T]], policy: Policy, timeout: float) -> T:
+    """Первая попытка; если молчит дольше hedge_after — параллельно вторая. Берём первый успех."""
+    first = asyncio.ensure_future(asyncio.wait_for(func(timeout), timeout))
+    done, _ = await asyncio.wait({first}, timeout=policy.hedge_after)
+    if done:
+        return first.result()
+
+    timeout = deadline.clamp_timeout(timeout - policy.hedge_after)
+    second = asyncio.ensure_future(asyncio.wait_for(func(timeout), timeout))
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def call(
+    endpoint: str,
+    func: Callable[[float], Awaitable[T]],
+    dependency: str,
+    idempotent: bool = False,
+) -> T:
+    """
+    Выполняет func(timeout) по политике endpoint'а.
+    Повторы и хеджирование — только для idempotent=True.
+    Сбои (таймауты, сетевые ошибки, 5xx) учитывает circuit breaker зависимости.
+    Таймаут каждой попытки ужимается до остатка дедлайна апдейта (core.deadline);
+    если бюджет кончился — DeadlineExceeded, без учёта в circuit breaker.
+    """
+    policy = POLICIES.get(endpoint, DEFAULT_POLICY)
+    breaker = get_breaker(dependency)
+    attempts = 1 + (policy.retries if idempotent else 0)
+
+    for attempt in range(attempts):
+        timeout = deadline.clamp_timeout(policy.timeout)
+        breaker.before_call()
+        try:
+            if idempotent and policy.hedge_after is not None and timeout > policy.hedge_after:
+                result = await _hedged(func, policy, timeout)
+            else:
+                result = await asyncio.wait_for(func(timeout), timeout)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            clamped = isinstance(e, asyncio.TimeoutError) and timeout < policy.timeout
+            if clamped or isinstance(e, deadline.DeadlineExceeded):
+                # Упёрлись в дедлайн апдейта, а не в таймаут зависимости
+                breaker.release_probe()
+                if isinstance(e, deadline.DeadlineExceeded):
+                    raise
+                raise deadline.DeadlineExceeded(f"{endpoint}: deadline exceeded") from e
+            if not _is_retryable(e):
+                # Зависимость ответила (4xx, ошибка модели и т.п.) — она жива
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise
+            delay = _backoff(policy, attempt)
+            left = deadline.remaining()
+            if left is not None and left <= delay:
+                raise
+            logger.warning(
+                "%s failed (%s), retry %s/%s in %.2fs",
+                endpoint, e.__class__.__name__, attempt + 1, attempts - 1, delay,
+            )
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+    raise RuntimeError("unreachable")
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import httpx
+
+from config import MODEL_INFO
+from .deadline import DeadlineExceeded
+from .resilience import CircuitOpenError, RetryableStatusError
+
+# ---------------------------------------------------------
+# MODEL HEALTH & ROUTING
+# ---------------------------------------------------------
+# По каждой модели — скользящее окно последних запусков (латентность, успех).
+# Если p95 или доля ошибок модели выше порогов из MODEL_INFO["routing"],
+# а у модели есть здоровый запасной вариант из MODEL_INFO["fallbacks"],
+# генерация сразу идёт в него. Если модель упала по инфраструктурной причине
+# (таймаут, 5xx, circuit breaker) — пробуем следующий вариант цепочки.
+# Пользователь платит по цене выбранной им модели.
+# Хеджирование (параллельный запуск двух моделей) не делаем: оба запуска платные.
+
+WINDOW_SIZE = 50
+WINDOW_SECONDS = 15 * 60.0   # старые замеры выпадают — модель «выздоравливает» сама
+MIN_SAMPLES = 5
+DEFAULT_P95_MAX = 90.0
+DEFAULT_ERROR_RATE_MAX = 0.3
+MIN_FALLBACK_BUDGET = 30.0   # сек: меньше — на запасную модель уже не переключаемся
+
+
+class ModelHealth:
+    def __init__(self) -> None:
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=WINDOW_SIZE)
+
+    def record(self, latency: float, ok: bool) -> None:
+        self._samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self) -> List[Tuple[float, float, bool]]:
+        cutoff = time.monotonic() - WINDOW_SECONDS
+        return [s for s in self._samples if s[0] >= cutoff]
+
+    def snapshot(self) -> Dict:
+        samples = self._recent()
+        latencies = sorted(lat for _, lat, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None
+        return {
+            "samples": len(samples),
+            "p95_s": p95,
+            "error_rate": errors / len(samples) if samples else 0.0,
+        }
+
+
+_health: Dict[str, ModelHealth] = {key: ModelHealth() for key in MODEL_INFO}
+
+
+def record(model_key: str, latency: float, ok: bool) -> None:
+    _health.setdefault(model_key, ModelHealth()).record(latency, ok)
+
+
+def degradation(model_key: str) -> Optional[str]:
+    """Причина, по которой модель сейчас считается деградировавшей, или None."""
+    snap = _health[model_key].snapshot()
+    if snap["samples"] < MIN_SAMPLES:
+        return None
+    limits = MODEL_INFO[model_key].get("routing", {})
+    error_rate_max = limits.get("error_rate_max", DEFAULT_ERROR_RATE_MAX)
+    p95_max = limits.get("p95_max", DEFAULT_P95_MAX)
+    if snap["error_rate"] > error_rate_max:
+        return f"error_rate {snap['error_rate']:.0%} > {error_rate_max:.0%}"
+    if snap["p95_s"] is not None and snap["p95_s"] > p95_max:
+        return f"p95 {snap['p95_s']:.0f}s > {p95_max:.0f}s"
+    return None
+
+
+def plan(model_key: str) -> Tuple[List[str], str, Optional[str]]:
+    """
+    Порядок попыток для model_key: (кандидаты, решение, причина).
+    Решение: "primary" — как выбрал пользователь, "routed" — сразу в запасную модель.
+    """
+    chain = [model_key] + [
+        k for k in MODEL_INFO[model_key].get("fallbacks", []) if k in MODEL_INFO
+    ]
+    reason = degradation(model_key)
+    if reason is None or len(chain) == 1:
+        return chain, "primary", None
+
+    for candidate in chain[1:]:
+        if degradation(candidate) is None:
+            rest = [k for k in chain if k != candidate]
+            return [candidate] + rest, "routed", f"{model_key}: {reason}"
+    return chain, "primary", None
+
+
+def is_failover_error(exc: BaseException) -> bool:
+    """Сбой инфраструктуры, а не ответ модели (фильтр контента и т.п.) — стоит пробовать другую."""
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    if isinstance(exc, (CircuitOpenError, RetryableStatusError, httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    status = getattr(exc, "status", None)  # replicate.exceptions.ReplicateError
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+def report() -> List[Dict]:
+    rows = []
+    for key in MODEL_INFO:
+        snap = _health[key].snapshot()
+        rows.append({"model": key, **snap, "degraded": degradation(key)})
+    return rows
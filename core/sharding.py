@@ -0,0 +1,50 @@
+import bisect
+import hashlib
+from typing import Any, Dict, List, Sequence
+
+# ---------------------------------------------------------
+# CONSISTENT HASH RING
+# ---------------------------------------------------------
+# Апдейт пользователя всегда уходит в один и тот же воркер: там его
+# context.user_data (настройки), кэш истории, кэш референсов и т.п.
+# Узлы кольца — номера слотов воркеров, а не процессы: перезапущенный
+# воркер занимает тот же слот, и ни один пользователь никуда не переезжает.
+# При изменении числа воркеров переезжает только ~1/N пользователей.
+
+VNODES_PER_NODE = 256
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes: Sequence[int], vnodes: int = VNODES_PER_NODE) -> None:
+        if not nodes:
+            raise ValueError("HashRing needs at least one node")
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self._keys: List[int] = [p for p, _ in points]
+        self._nodes: List[int] = [n for _, n in points]
+
+    def node_for(self, key: Any) -> int:
+        idx = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[idx]
+
+
+def routing_key(update: Dict) -> Any:
+    """
+    Ключ маршрутизации сырого апдейта Telegram: id пользователя (from),
+    иначе id чата, иначе update_id (такие апдейты ни к кому не привязаны).
+    """
+    for field, value in update.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return update.get("update_id")
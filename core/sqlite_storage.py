@@ -0,0 +1,812 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .storage import (
+    GENERATION_LIST_COLUMNS,
+    INFLIGHT_COLUMNS,
+    KEEPWARM_COLUMNS,
+    TELEMETRY_COLUMNS,
+    USAGE_COLUMNS,
+    USAGE_USER_COLUMNS,
+    USER_COLUMNS,
+    USER_LIST_COLUMNS,
+    USER_PROFILE_COLUMNS,
+    Page,
+    Storage,
+    decode_cursor,
+    page_cursors,
+)
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# SQLITE STORAGE
+# ---------------------------------------------------------
+# Та же схема, что в Supabase (migrations/), в одном файле SQLite:
+# - WAL: чтения не ждут записи, запись — одна транзакция без fsync на каждый коммит;
+# - все обращения идут через один поток-исполнитель: соединение не делится
+#   между потоками, event loop не блокируется, запись сериализована;
+# - баланс — как во view user_accounts: снимок + несвёрнутый хвост журнала.
+# Время хранится строкой ISO 8601 UTC с микросекундами — фиксированная ширина,
+# поэтому строковое сравнение совпадает с хронологическим.
+
+SCHEMA = """
+create table if not exists telegram_users (
+    id          integer primary key,
+    username    text,
+    first_name  text,
+    last_name   text,
+    balance     integer not null default 0,
+    created_at  text not null,
+    updated_at  text not null
+);
+create index if not exists telegram_users_created_at_id_idx
+    on telegram_users (created_at desc, id desc);
+create index if not exists telegram_users_username_lower_idx
+    on telegram_users (lower(username));
+
+create table if not exists token_ledger (
+    id                integer primary key autoincrement,
+    user_id           integer not null references telegram_users (id),
+    delta             integer not null,
+    reason            text    not null,
+    payment_charge_id text    unique,
+    generation_id     integer,
+    admin_action_id   integer,
+    inflight_id       integer,
+    compacted         integer not null default 0,
+    created_at        text    not null
+);
+create index if not exists token_ledger_user_id_idx on token_ledger (user_id, id);
+create index if not exists token_ledger_pending_idx on token_ledger (user_id) where not compacted;
+
+create view if not exists user_accounts as
+select u.id,
+       u.username,
+       lower(u.username) as username_lower,
+       u.first_name,
+       u.last_name,
+       u.balance + coalesce(
+           (select sum(l.delta) from token_ledger l where l.user_id = u.id and not l.compacted), 0
+       ) as balance,
+       u.created_at,
+       u.updated_at
+  from telegram_users u;
+
+create table if not exists generations (
+    id               integer primary key autoincrement,
+    user_id          integer not null,
+    prompt           text,
+    image_url        text,
+    tokens_spent     integer not null default 0,
+    model            text,
+    requested_model  text,
+    routing_decision text not null default 'primary',
+    routing_reason   text,
+    aspect_ratio     text,
+    resolution       text,
+    output_format    text,
+    inflight_id      integer,
+    created_at       text not null
+);
+create index if not exists generations_user_created_at_id_idx
+    on generations (user_id, created_at desc, id desc);
+create index if not exists generations_created_at_idx on generations (created_at);
+create index if not exists generations_model_created_at_idx on generations (model, created_at desc);
+
+-- Дневные сводки (migrations/007): model = '' — итог дня, день — UTC
+create table if not exists usage_daily_user (
+    day              text    not null,
+    model            text    not null,
+    user_id          integer not null,
+    generations      integer not null default 0,
+    tokens_spent     integer not null default 0,
+    purchases        integer not null default 0,
+    tokens_purchased integer not null default 0,
+    primary key (day, model, user_id)
+);
+create index if not exists usage_daily_user_top_idx
+    on usage_daily_user (day, model, tokens_spent desc);
+
+create table if not exists usage_daily (
+    day              text    not null,
+    model            text    not null,
+    users            integer not null default 0,
+    generations      integer not null default 0,
+    tokens_spent     integer not null default 0,
+    purchases        integer not null default 0,
+    tokens_purchased integer not null default 0,
+    primary key (day, model)
+);
+
+create trigger if not exists usage_on_generation after insert on generations
+begin
+    insert into usage_daily (day, model, users)
+    select substr(new.created_at, 1, 10), m.model, 1
+      from (select coalesce(new.model, '') as model union select '') m
+     where not exists (
+           select 1 from usage_daily_user u
+            where u.day = substr(new.created_at, 1, 10) and u.model = m.model and u.user_id = new.user_id
+     )
+    on conflict (day, model) do update set users = users + 1;
+
+    insert into usage_daily_user (day, model, user_id, generations, tokens_spent)
+    select substr(new.created_at, 1, 10), m.model, new.user_id, 1, new.tokens_spent
+      from (select coalesce(new.model, '') as model union select '') m
+     where true
+    on conflict (day, model, user_id) do update
+       set generations  = generations + excluded.generations,
+           tokens_spent = tokens_spent + excluded.tokens_spent;
+
+    insert into usage_daily (day, model, generations, tokens_spent)
+    select substr(new.created_at, 1, 10), m.model, 1, new.tokens_spent
+      from (select coalesce(new.model, '') as model union select '') m
+     where true
+    on conflict (day, model) do update
+       set generations  = generations + excluded.generations,
+           tokens_spent = tokens_spent + excluded.tokens_spent;
+end;
+
+create trigger if not exists usage_on_purchase after insert on token_ledger
+when new.reason = 'purchase'
+begin
+    insert into usage_daily (day, model, users)
+    select substr(new.created_at, 1, 10), '', 1
+     where not exists (
+           select 1 from usage_daily_user u
+            where u.day = substr(new.created_at, 1, 10) and u.model = '' and u.user_id = new.user_id
+     )
+    on conflict (day, model) do update set users = users + 1;
+
+    insert into usage_daily_user (day, model, user_id, purchases, tokens_purchased)
+    values (substr(new.created_at, 1, 10), '', new.user_id, 1, new.delta)
+    on conflict (day, model, user_id) do update
+       set purchases        = purchases + 1,
+           tokens_purchased = tokens_purchased + excluded.tokens_purchased;
+
+    insert into usage_daily (day, model, purchases, tokens_purchased)
+    values (substr(new.created_at, 1, 10), '', 1, new.delta)
+    on conflict (day, model) do update
+       set purchases        = purchases + 1,
+           tokens_purchased = tokens_purchased + excluded.tokens_purchased;
+end;
+
+create table if not exists inflight_predictions (
+    id            integer primary key autoincrement,
+    worker        integer not null default 0,
+    user_id       integer not null,
+    chat_id       integer not null,
+    prompt        text,
+    settings      text    not null,
+    cost          integer not null default 0,
+    model         text,
+    prediction_id text,
+    created_at    text    not null,
+    updated_at    text    not null
+);
+create index if not exists inflight_predictions_worker_idx on inflight_predictions (worker, id);
+
+-- Расход на прогрев моделей за день (migrations/013)
+create table if not exists keepwarm_spend (
+    day        text    not null primary key,
+    spent_usd  real    not null default 0,
+    warmups    integer not null default 0,
+    updated_at text    not null
+);
+
+create table if not exists model_telemetry (
+    day        text    not null,
+    worker     integer not null,
+    model      text    not null,
+    combo      text    not null,
+    status     text    not null default 'succeeded',
+    sketches   text    not null,
+    updated_at text    not null,
+    primary key (day, worker, model, combo, status)
+);
+
+create table if not exists admin_actions (
+    id             integer primary key autoincrement,
+    admin_id       integer not null,
+    target_user_id integer,
+    action         text not null,
+    amount         integer,
+    note           text,
+    created_at     text not null
+);
+
+create table if not exists api_tokens (
+    id           integer primary key autoincrement,
+    user_id      integer not null,
+    token        text,
+    token_hash   text,
+    token_prefix text,
+    scope        text,
+    expires_at   text,
+    revoked_at   text,
+    created_at   text not null
+);
+create index if not exists api_tokens_prefix_idx on api_tokens (token_prefix) where revoked_at is null;
+create index if not exists api_tokens_user_idx on api_tokens (user_id) where revoked_at is null;
+create index if not exists api_tokens_revoked_at_idx on api_tokens (revoked_at desc) where revoked_at is not null;
+"""
+
+# Колонки, добавленные после первой версии схемы: в старом файле их дописывает
+# _migrate, индексы по ним — после этого (migrations/012)
+ADDED_COLUMNS = [
+    ("generations", "inflight_id", "integer"),
+    ("token_ledger", "inflight_id", "integer"),
+]
+POST_SCHEMA = """
+create unique index if not exists generations_inflight_id_key on generations (inflight_id);
+create unique index if not exists token_ledger_inflight_id_key on token_ledger (inflight_id);
+"""
+
+GENERATION_COLUMNS = {
+    "id", "user_id", "prompt", "image_url", "tokens_spent", "model", "requested_model",
+    "routing_decision", "routing_reason", "aspect_ratio", "resolution", "output_format",
+    "inflight_id", "created_at",
+}
+USER_WRITE_COLUMNS = {"id", "username", "first_name", "last_name", "balance", "updated_at"}
+SEARCH_MIN_SUBSTRING_LEN = 3   # как TRGM_MIN_QUERY_LEN у Supabase: короче — только префикс
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _iso(value: str) -> str:
+    """Любой ISO 8601 -> формат хранения (UTC, микросекунды)."""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _placeholders(values: Sequence) -> str:
+    return ",".join("?" for _ in values)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SQLiteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    # ---------- connection ----------
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.execute("pragma foreign_keys=on")
+            conn.execute("pragma busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _columns(conn: sqlite3.Connection, table: str) -> set:
+        return {row["name"] for row in conn.execute(f"pragma table_info({table})")}
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        for table, column, decl in ADDED_COLUMNS:
+            if column not in self._columns(conn, table):
+                conn.execute(f"alter table {table} add column {column} {decl}")
+        if "status" not in self._columns(conn, "model_telemetry"):
+            # status входит в первичный ключ (migrations/015) — таблица пересобирается
+            conn.executescript(
+                "begin;"
+                "alter table model_telemetry rename to model_telemetry_old;"
+                + SCHEMA +
+                "insert into model_telemetry (day, worker, model, combo, sketches, updated_at) "
+                "select day, worker, model, combo, sketches, updated_at from model_telemetry_old;"
+                "drop table model_telemetry_old;"
+                "commit;"
+            )
+        conn.executescript(POST_SCHEMA)
+
+    async def _run(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(self._db()))
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, func: Callable[[], Any]) -> Any:
+        """Выполняет func одной транзакцией."""
+        conn.execute("begin immediate")
+        try:
+            result = func()
+        except BaseException:
+            conn.execute("rollback")
+            raise
+        conn.execute("commit")
+        return result
+
+    @staticmethod
+    def _rows(cursor: sqlite3.Cursor) -> List[Dict]:
+        return [dict(row) for row in cursor.fetchall()]
+
+    async def ping(self) -> None:
+        await self._run(lambda conn: conn.execute("select 1").fetchone())
+
+    async def close(self) -> None:
+        def close(conn: sqlite3.Connection) -> None:
+            conn.close()
+            self._conn = None
+
+        if self._conn is not None:
+            await self._run(close)
+        self._executor.shutdown(wait=True)
+
+    # ---------- users ----------
+
+    def _select_user(self, conn: sqlite3.Connection, user_id: int) -> Optional[Dict]:
+        row = conn.execute(
+            f"select {USER_COLUMNS} from user_accounts where id = ?", (user_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        return await self._run(lambda conn: self._select_user(conn, user_id))
+
+    @staticmethod
+    def _select_profile(conn: sqlite3.Connection, user_id: int) -> Optional[Dict]:
+        row = conn.execute(
+            f"select {USER_PROFILE_COLUMNS} from telegram_users where id = ?", (user_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    async def insert_user(self, payload: Dict, returning: bool = True) -> Optional[Dict]:
+        now = _now()
+        values = {k: v for k, v in payload.items() if k in USER_WRITE_COLUMNS}
+        values.setdefault("balance", 0)
+        values["created_at"] = now
+        values["updated_at"] = now
+
+        def insert(conn: sqlite3.Connection) -> Optional[Dict]:
+            conn.execute(
+                f"insert into telegram_users ({','.join(values)}) values ({_placeholders(values)})",
+                tuple(values.values()),
+            )
+            return self._select_profile(conn, values["id"]) if returning else None
+
+        return await self._run(insert)
+
+    async def update_user(self, user_id: int, payload: Dict, returning: bool = True) -> Optional[Dict]:
+        values = {k: v for k, v in payload.items() if k in USER_WRITE_COLUMNS and k != "id"}
+        if values.get("updated_at") in (None, "now()"):
+            values["updated_at"] = _now()
+
+        def update(conn: sqlite3.Connection) -> Optional[Dict]:
+            cur = conn.execute(
+                f"update telegram_users set {', '.join(f'{k} = ?' for k in values)} where id = ?",
+                (*values.values(), user_id),
+            )
+            if not returning or cur.rowcount == 0:
+                return None
+            return self._select_profile(conn, user_id)
+
+        return await self._run(update)
+
+    async def fetch_recent_users(self, limit: int = 20) -> List[Dict]:
+        return await self._run(lambda conn: self._rows(conn.execute(
+            f"select {USER_LIST_COLUMNS} from user_accounts "
+            "order by created_at desc, id desc limit ?",
+            (limit,),
+        )))
+
+    def _keyset_page(
+        self,
+        conn: sqlite3.Connection,
+        source: str,
+        columns: str,
+        where: str,
+        args: tuple,
+        cursor: Optional[str],
+        direction: str,
+        limit: int,
+    ) -> Page:
+        """Keyset-пагинация по (created_at desc, id desc), как _fetch_keyset_page у Supabase."""
+        backwards = cursor is not None and direction == "prev"
+        conditions = [where] if where else []
+        if cursor is not None:
+            created_at_iso, row_id = decode_cursor(cursor)
+            created_at_iso = _iso(created_at_iso)
+            op = ">" if backwards else "<"
+            conditions.append(f"(created_at {op} ? or (created_at = ? and id {op} ?))")
+            args = (*args, created_at_iso, created_at_iso, row_id)
+        order = "created_at asc, id asc" if backwards else "created_at desc, id desc"
+        sql = f"select {columns} from {source}"
+        if conditions:
+            sql += " where " + " and ".join(conditions)
+        sql += f" order by {order} limit ?"
+
+        rows = self._rows(conn.execute(sql, (*args, limit + 1)))
+        has_more = len(rows) > limit
+        return page_cursors(rows[:limit], cursor, backwards, has_more)
+
+    async def fetch_users_page(
+        self, cursor: Optional[str] = None, direction: str = "next", limit: int = 20
+    ) -> Page:
+        return await self._run(lambda conn: self._keyset_page(
+            conn, "user_accounts", USER_LIST_COLUMNS, "", (), cursor, direction, limit
+        ))
+
+    async def search_users(self, query: str, limit: int = 20) -> List[Dict]:
+        q = query.strip()
+        if q.isdigit():
+            where, args = "id = ?", (int(q),)
+        elif q.startswith("@"):
+            name = q[1:].strip().lower()
+            if not name:
+                return []
+            where, args = "username_lower like ? escape '\\'", (_escape_like(name) + "%",)
+        else:
+            if not q:
+                return []
+            pattern = _escape_like(q) + "%"
+            if len(q) >= SEARCH_MIN_SUBSTRING_LEN:
+                pattern = "%" + pattern
+            where = (
+                "(username like ? escape '\\' or first_name like ? escape '\\' "
+                "or last_name like ? escape '\\')"
+            )
+            args = (pattern, pattern, pattern)
+
+        return await self._run(lambda conn: self._rows(conn.execute(
+            f"select {USER_LIST_COLUMNS} from user_accounts where {where} "
+            "order by created_at desc, id desc limit ?",
+            (*args, limit),
+        )))
+
+    async def fetch_active_user_ids(self, since_iso: str) -> List[int]:
+        since = _iso(since_iso)
+        return await self._run(lambda conn: [
+            row[0] for row in conn.execute(
+                "select distinct user_id from generations where created_at >= ?", (since,)
+            )
+        ])
+
+    # ---------- token ledger ----------
+
+    async def ledger_append(self, entries: List[Dict]) -> List[Dict]:
+        now = _now()
+
+        def append(conn: sqlite3.Connection) -> List[Dict]:
+            # begin immediate в _write: проверка баланса и запись не пересекаются
+            # с другими писателями
+            def insert(e: Dict) -> Dict:
+                account = self._select_user(conn, e["user_id"])
+                if account is None:
+                    return {"status": "no_user", "account": None}
+                mode, delta = e.get("mode") or "add", e["delta"]
+                if mode == "set":
+                    delta -= account["balance"]
+                elif mode == "clamp":
+                    delta = max(delta, -account["balance"])
+                elif mode == "debit" and account["balance"] + delta < 0:
+                    return {"status": "insufficient", "account": account}
+                cur = conn.execute(
+                    "insert into token_ledger (user_id, delta, reason, payment_charge_id, "
+                    "generation_id, admin_action_id, inflight_id, created_at) "
+                    "values (?, ?, ?, ?, ?, ?, ?, ?) on conflict do nothing",
+                    (
+                        e["user_id"], delta, e["reason"], e.get("payment_charge_id"),
+                        e.get("generation_id"), e.get("admin_action_id"), e.get("inflight_id"), now,
+                    ),
+                )
+                return {
+                    "status": "ok" if cur.rowcount == 1 else "duplicate",
+                    "account": self._select_user(conn, e["user_id"]),
+                }
+
+            return self._write(conn, lambda: [insert(e) for e in entries])
+
+        return await self._run(append)
+
+    async def compact_ledger(self) -> int:
+        now = _now()
+
+        def compact(conn: sqlite3.Connection) -> int:
+            def move() -> int:
+                sums = conn.execute(
+                    "select user_id, sum(delta) from token_ledger where not compacted group by user_id"
+                ).fetchall()
+                conn.execute("update token_ledger set compacted = 1 where not compacted")
+                updated = 0
+                for user_id, delta in sums:
+                    cur = conn.execute(
+                        "update telegram_users set balance = balance + ?, updated_at = ? where id = ?",
+                        (delta, now, user_id),
+                    )
+                    updated += cur.rowcount
+                return updated
+
+            return self._write(conn, move)
+
+        return await self._run(compact)
+
+    async def bulk_add_tokens(
+        self, user_ids: List[int], amount: int, admin_action_id: Optional[int] = None
+    ) -> List[Dict]:
+        now = _now()
+
+        def grant(conn: sqlite3.Connection) -> List[Dict]:
+            self._write(conn, lambda: conn.execute(
+                "insert into token_ledger (user_id, delta, reason, admin_action_id, created_at) "
+                f"select id, ?, 'bulk_grant', ?, ? from telegram_users where id in ({_placeholders(user_ids)})",
+                (amount, admin_action_id, now, *user_ids),
+            ))
+            return self._rows(conn.execute(
+                f"select id, balance from user_accounts where id in ({_placeholders(user_ids)})",
+                user_ids,
+            ))
+
+        if not user_ids:
+            return []
+        return await self._run(grant)
+
+    # ---------- generations ----------
+
+    async def insert_generations(self, rows: List[Dict]) -> List[int]:
+        def insert(conn: sqlite3.Connection) -> List[int]:
+            def write() -> List[int]:
+                ids = []
+                for row in rows:
+                    values = {k: v for k, v in row.items() if k in GENERATION_COLUMNS}
+                    values["created_at"] = _now()
+                    cur = conn.execute(
+                        f"insert into generations ({','.join(values)}) values ({_placeholders(values)}) "
+                        "on conflict (inflight_id) do nothing",
+                        tuple(values.values()),
+                    )
+                    if cur.rowcount == 1:
+                        ids.append(cur.lastrowid)
+                    else:
+                        # повтор проведения той же записи журнала — id уже записанной строки
+                        ids.append(conn.execute(
+                            "select id from generations where inflight_id = ?", (values["inflight_id"],)
+                        ).fetchone()[0])
+                return ids
+
+            return self._write(conn, write)
+
+        return await self._run(insert)
+
+    async def count_generations_since(self, user_id: int, model: str, created_after_iso: str) -> int:
+        since = _iso(created_after_iso)
+        try:
+            return await self._run(lambda conn: conn.execute(
+                "select count(*) from generations where user_id = ? and model = ? and created_at >= ?",
+                (user_id, model, since),
+            ).fetchone()[0])
+        except sqlite3.Error as e:
+            logger.warning("Failed to count generations: %s", e)
+            return 0
+
+    async def fetch_generations_page(
+        self,
+        user_id: int,
+        cursor: Optional[str] = None,
+        direction: str = "next",
+        limit: int = 5,
+        columns: str = GENERATION_LIST_COLUMNS,
+    ) -> Page:
+        unknown = set(columns.split(",")) - GENERATION_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown generation columns: {', '.join(sorted(unknown))}")
+        return await self._run(lambda conn: self._keyset_page(
+            conn, "generations", columns, "user_id = ?", (user_id,), cursor, direction, limit
+        ))
+
+    async def fetch_generations(self, user_id: int, limit: int = 5) -> List[Dict]:
+        return await self._run(lambda conn: self._rows(conn.execute(
+            f"select {GENERATION_LIST_COLUMNS} from generations where user_id = ? "
+            "order by created_at desc, id desc limit ?",
+            (user_id, limit),
+        )))
+
+    # ---------- usage rollups ----------
+
+    async def fetch_usage_days(self, since_day: str) -> List[Dict]:
+        return await self._run(lambda conn: self._rows(conn.execute(
+            f"select {USAGE_COLUMNS} from usage_daily where day >= ? order by day desc, model asc",
+            (since_day,),
+        )))
+
+    async def fetch_top_users(self, day: str, limit: int = 5) -> List[Dict]:
+        return await self._run(lambda conn: self._rows(conn.execute(
+            f"select {USAGE_USER_COLUMNS} from usage_daily_user where day = ? and model = '' "
+            "order by tokens_spent desc limit ?",
+            (day, limit),
+        )))
+
+    # ---------- in-flight predictions ----------
+
+    async def insert_inflight(self, row: Dict) -> int:
+        now = _now()
+        values = {**row, "settings": json.dumps(row["settings"]), "created_at": now, "updated_at": now}
+        return await self._run(lambda conn: conn.execute(
+            f"insert into inflight_predictions ({','.join(values)}) values ({_placeholders(values)})",
+            tuple(values.values()),
+        ).lastrowid)
+
+    async def update_inflight(self, entry_id: int, fields: Dict) -> None:
+        values = {**fields, "updated_at": _now()}
+        await self._run(lambda conn: conn.execute(
+            f"update inflight_predictions set {', '.join(f'{k} = ?' for k in values)} where id = ?",
+            (*values.values(), entry_id),
+        ))
+
+    async def delete_inflight(self, entry_id: int) -> None:
+        await self._run(lambda conn: conn.execute(
+            "delete from inflight_predictions where id = ?", (entry_id,)
+        ))
+
+    async def fetch_inflight(self, worker: int) -> List[Dict]:
+        rows = await self._run(lambda conn: self._rows(conn.execute(
+            f"select {INFLIGHT_COLUMNS} from inflight_predictions where worker = ? order by id",
+            (worker,),
+        )))
+        for row in rows:
+            row["settings"] = json.loads(row["settings"])
+        return rows
+
+    # ---------- keep-warm ----------
+
+    async def last_generation_at(self, model: str) -> Optional[str]:
+        row = await self._run(lambda conn: conn.execute(
+            "select max(created_at) from generations where model = ?", (model,)
+        ).fetchone())
+        return row[0]
+
+    async def save_keepwarm_spend(self, row: Dict) -> None:
+        now = _now()
+        await self._run(lambda conn: conn.execute(
+            "insert into keepwarm_spend (day, spent_usd, warmups, updated_at) values (?, ?, ?, ?) "
+            "on conflict (day) do update set spent_usd = excluded.spent_usd, "
+            "warmups = excluded.warmups, updated_at = excluded.updated_at",
+            (row["day"], row["spent_usd"], row["warmups"], now),
+        ))
+
+    async def fetch_keepwarm_spend(self, day: str) -> Optional[Dict]:
+        rows = await self._run(lambda conn: self._rows(conn.execute(
+            f"select {KEEPWARM_COLUMNS} from keepwarm_spend where day = ?", (day,)
+        )))
+        return rows[0] if rows else None
+
+    # ---------- model telemetry ----------
+
+    async def save_telemetry(self, rows: List[Dict]) -> None:
+        now = _now()
+        await self._run(lambda conn: self._write(conn, lambda: conn.executemany(
+            "insert into model_telemetry (day, worker, model, combo, status, sketches, updated_at) "
+            "values (?, ?, ?, ?, ?, ?, ?) on conflict (day, worker, model, combo, status) do update "
+            "set sketches = excluded.sketches, updated_at = excluded.updated_at",
+            [
+                (
+                    r["day"], r["worker"], r["model"], r["combo"], r.get("status", "succeeded"),
+                    json.dumps(r["sketches"]), now,
+                )
+                for r in rows
+            ],
+        )))
+
+    async def fetch_telemetry(self, since_day: str) -> List[Dict]:
+        rows = await self._run(lambda conn: self._rows(conn.execute(
+            f"select {TELEMETRY_COLUMNS} from model_telemetry where day >= ?", (since_day,)
+        )))
+        for row in rows:
+            row["sketches"] = json.loads(row["sketches"])
+        return rows
+
+    # ---------- admin actions ----------
+
+    def _insert_admin_actions(self, conn: sqlite3.Connection, rows: List[Dict]) -> List[int]:
+        def write() -> List[int]:
+            ids = []
+            for row in rows:
+                cur = conn.execute(
+                    "insert into admin_actions (admin_id, target_user_id, action, amount, note, created_at) "
+                    "values (?, ?, ?, ?, ?, ?)",
+                    (
+                        row["admin_id"], row.get("target_user_id"), row["action"],
+                        row.get("amount"), row.get("note"), _now(),
+                    ),
+                )
+                ids.append(cur.lastrowid)
+            return ids
+
+        return self._write(conn, write)
+
+    async def log_admin_action(
+        self, admin_id: int, target_id: Optional[int], action: str, amount: int, note: Optional[str] = None
+    ) -> Optional[int]:
+        row = {
+            "admin_id": admin_id,
+            "target_user_id": target_id,
+            "action": action,
+            "amount": amount,
+            "note": note,
+        }
+        try:
+            ids = await self._run(lambda conn: self._insert_admin_actions(conn, [row]))
+        except sqlite3.Error as e:
+            logger.warning("Failed to log admin_action: %s", e)
+            return None
+        return ids[0]
+
+    async def log_admin_actions_bulk(self, rows: List[Dict]) -> None:
+        if not rows:
+            return
+        try:
+            await self._run(lambda conn: self._insert_admin_actions(conn, rows))
+        except sqlite3.Error as e:
+            logger.warning("Failed to bulk log %s admin_actions: %s", len(rows), e)
+
+    # ---------- api tokens ----------
+
+    async def insert_api_token(self, row: Dict) -> None:
+        values = {**row, "created_at": _now()}
+        await self._run(lambda conn: conn.execute(
+            f"insert into api_tokens ({','.join(values)}) values ({_placeholders(values)})",
+            tuple(values.values()),
+        ))
+
+    async def find_api_tokens(self, token_prefix: str) -> List[Dict]:
+        return await self._run(lambda conn: self._rows(conn.execute(
+            "select id, user_id, scope, expires_at, token_hash from api_tokens "
+            "where token_prefix = ? and revoked_at is null",
+            (token_prefix,),
+        )))
+
+    async def find_legacy_api_token(self, token: str) -> Optional[Dict]:
+        rows = await self._run(lambda conn: self._rows(conn.execute(
+            "select id, user_id, scope, expires_at from api_tokens "
+            "where token = ? and revoked_at is null limit 1",
+            (token,),
+        )))
+        return rows[0] if rows else None
+
+    async def update_api_token(self, token_id: int, fields: Dict) -> None:
+        await self._run(lambda conn: conn.execute(
+            f"update api_tokens set {', '.join(f'{k} = ?' for k in fields)} where id = ?",
+            (*fields.values(), token_id),
+        ))
+
+    async def list_api_tokens(self, user_id: int) -> List[Dict]:
+        return await self._run(lambda conn: self._rows(conn.execute(
+            "select token_prefix, scope, created_at, expires_at from api_tokens "
+            "where user_id = ? and revoked_at is null order by created_at desc",
+            (user_id,),
+        )))
+
+    async def revoke_api_tokens(self, user_id: int, token_prefix: Optional[str] = None) -> int:
+        sql = "update api_tokens set revoked_at = ? where user_id = ? and revoked_at is null"
+        args: tuple = (_now(), user_id)
+        if token_prefix:
+            sql += " and token_prefix = ?"
+            args = (*args, token_prefix)
+        return await self._run(lambda conn: conn.execute(sql, args).rowcount)
+
+    async def last_api_token_revocation(self) -> Optional[str]:
+        return await self._run(lambda conn: conn.execute(
+            "select max(revoked_at) from api_tokens where revoked_at is not null"
+        ).fetchone()[0])
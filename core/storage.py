@@ -0,0 +1,387 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from config import STORAGE_BACKEND, MODEL_INFO
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# STORAGE INTERFACE
+# ---------------------------------------------------------
+# Всё, что бот хранит: пользователи, журнал токенов (баланс), генерации,
+# действия админов и токены плагина. Реализации:
+# - "supabase" — PostgREST поверх HTTP (core/supabase.py), по умолчанию;
+# - "sqlite"   — встроенная база в файле SQLITE_PATH (core/sqlite_storage.py):
+#   локальная разработка, бенчмарки и небольшие инсталляции без Supabase.
+# Выбирается переменной STORAGE_BACKEND. Одинаковое поведение реализаций
+# проверяет python -m utils.storage_check.
+#
+# Строки — словари с теми же колонками, что в Supabase; created_at — ISO 8601.
+
+Page = Tuple[List[Dict], Optional[str], Optional[str]]
+
+USER_COLUMNS = "id,username,first_name,last_name,balance,created_at,updated_at"
+# Профиль без balance: telegram_users.balance — только снимок на момент компакции,
+# настоящий баланс — в user_accounts (get_user)
+USER_PROFILE_COLUMNS = "id,username,first_name,last_name,created_at,updated_at"
+USER_LIST_COLUMNS = "id,username,first_name,last_name,balance,created_at"
+GENERATION_LIST_COLUMNS = "id,prompt,image_url,tokens_spent,created_at"
+INFLIGHT_COLUMNS = "id,user_id,chat_id,prompt,settings,cost,model,prediction_id,created_at"
+TELEMETRY_COLUMNS = "day,worker,model,combo,status,sketches"
+KEEPWARM_COLUMNS = "day,spent_usd,warmups"
+USAGE_COLUMNS = "day,model,users,generations,tokens_spent,purchases,tokens_purchased"
+USAGE_USER_COLUMNS = "user_id,generations,tokens_spent,purchases,tokens_purchased"
+
+# Как запись журнала применяется к балансу (ledger_append, атомарно с проверкой):
+# add — delta как есть; debit — списание целиком или отказ ("insufficient");
+# clamp — списание не больше баланса; set — delta это целевой баланс.
+LEDGER_MODES = ("add", "debit", "clamp", "set")
+
+
+# --------- KEYSET CURSOR ---------
+# Курсор — пара (created_at, id) строки на границе страницы, упакованная
+# в короткую строку "<unix_micros>.<id>", чтобы влезать в callback_data (64 байта).
+
+def encode_cursor(row: Dict) -> Optional[str]:
+    created_at = row.get("created_at")
+    if not created_at:
+        return None
+    dt = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    micros = int(dt.timestamp()) * 1_000_000 + dt.microsecond
+    return f"{micros}.{row['id']}"
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """Возвращает (created_at в ISO, id). Бросает ValueError на мусоре."""
+    micros_str, id_str = cursor.split(".", 1)
+    micros = int(micros_str)
+    dt = datetime.fromtimestamp(micros // 1_000_000, tz=timezone.utc).replace(
+        microsecond=micros % 1_000_000
+    )
+    return dt.isoformat(), int(id_str)
+
+
+def page_cursors(rows: List[Dict], cursor: Optional[str], backwards: bool, has_more: bool) -> Page:
+    """
+    Курсоры страницы keyset-пагинации по (created_at desc, id desc).
+    rows — уже обрезанные до limit строки в порядке запроса.
+    """
+    if backwards:
+        rows.reverse()
+        prev_cursor = encode_cursor(rows[0]) if has_more and rows else None
+        next_cursor = encode_cursor(rows[-1]) if rows else None
+    else:
+        next_cursor = encode_cursor(rows[-1]) if has_more and rows else None
+        prev_cursor = encode_cursor(rows[0]) if cursor is not None and rows else None
+    return rows, next_cursor, prev_cursor
+
+
+def generation_row(
+    user_id: int,
+    prompt: str,
+    image_url: str,
+    settings: Dict,
+    tokens_spent: int,
+    route: Optional[Dict] = None,
+    inflight_id: Optional[int] = None,
+) -> Dict:
+    """
+    Строка generations. route — решение маршрутизации из run_model: model —
+    модель, которая реально отработала, requested — выбранная пользователем.
+    inflight_id — запись журнала генерации, ключ идемпотентности проведения.
+    """
+    def replicate_id(key: str) -> str:
+        return MODEL_INFO.get(key, MODEL_INFO.get("banana", {})).get("replicate", key)
+
+    route = route or {}
+    requested_key = route.get("requested") or settings.get("model", "banana")
+    return {
+        "user_id": user_id,
+        "prompt": prompt,
+        "image_url": image_url,
+        "tokens_spent": tokens_spent,
+        "model": replicate_id(route.get("model") or requested_key),
+        "requested_model": replicate_id(requested_key),
+        "routing_decision": route.get("decision", "primary"),
+        "routing_reason": route.get("reason"),
+        "aspect_ratio": settings.get("aspect_ratio"),
+        "resolution": settings.get("resolution"),
+        "output_format": settings.get("output_format"),
+        "inflight_id": inflight_id,
+    }
+
+
+class Storage:
+    """Базовый класс хранилища. Ошибки бэкенда пробрасываются, если не сказано иное."""
+
+    name = "base"
+
+    async def ping(self) -> None:
+        """Дешёвый запрос: прогрев соединения / проверка доступности."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    # ---------- users ----------
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        """Пользователь с актуальным балансом (снимок + хвост журнала) или None."""
+        raise NotImplementedError
+
+    async def insert_user(self, payload: Dict, returning: bool = True) -> Optional[Dict]:
+        """Созданный профиль (USER_PROFILE_COLUMNS, без balance)."""
+        raise NotImplementedError
+
+    async def update_user(self, user_id: int, payload: Dict, returning: bool = True) -> Optional[Dict]:
+        """Обновлённый профиль (без balance) или None, если пользователя нет."""
+        raise NotImplementedError
+
+    async def fetch_recent_users(self, limit: int = 20) -> List[Dict]:
+        raise NotImplementedError
+
+    async def fetch_users_page(
+        self, cursor: Optional[str] = None, direction: str = "next", limit: int = 20
+    ) -> Page:
+        """Keyset-страница пользователей, новые сверху: (rows, next_cursor, prev_cursor)."""
+        raise NotImplementedError
+
+    async def search_users(self, query: str, limit: int = 20) -> List[Dict]:
+        """Поиск по id, @username (префикс) или части имени / username."""
+        raise NotImplementedError
+
+    async def fetch_active_user_ids(self, since_iso: str) -> List[int]:
+        """ID пользователей, у которых есть генерации начиная с since_iso."""
+        raise NotImplementedError
+
+    # ---------- token ledger ----------
+
+    async def ledger_append(self, entries: List[Dict]) -> List[Dict]:
+        """
+        Пачка записей журнала токенов; каждая проводится отдельно, и чужая
+        ошибочная запись не роняет остальные. mode записи (LEDGER_MODES) —
+        как delta применяется к балансу; проверка и запись атомарны.
+        Возвращает по строке на запись, в том же порядке: {"status", "account"},
+        где status — "ok" / "duplicate" (повтор payment_charge_id) / "no_user" /
+        "insufficient" (debit без нужного баланса), account — строка
+        user_accounts после записи (None, если пользователя нет).
+        """
+        raise NotImplementedError
+
+    async def compact_ledger(self) -> int:
+        """Сворачивает хвост журнала в снимок баланса. Возвращает число пользователей."""
+        raise NotImplementedError
+
+    async def bulk_add_tokens(
+        self, user_ids: List[int], amount: int, admin_action_id: Optional[int] = None
+    ) -> List[Dict]:
+        """
+        Начисление пачке пользователей; [{"id", "balance"}] только для найденных.
+        admin_action_id — действие админа, на которое ссылаются записи журнала.
+        """
+        raise NotImplementedError
+
+    # ---------- generations ----------
+
+    async def insert_generations(self, rows: List[Dict]) -> List[int]:
+        """Пишет строки generation_row и возвращает их id в том же порядке."""
+        raise NotImplementedError
+
+    async def log_generations(self, entries: List[Dict]) -> List[int]:
+        """
+        Пишет несколько генераций одним запросом. entries — словари с аргументами
+        log_generation. Возвращает id записей в том же порядке ([] — не записалось).
+        """
+        if not entries:
+            return []
+        rows = [generation_row(**entry) for entry in entries]
+        try:
+            ids = await self.insert_generations(rows)
+        except Exception as e:
+            logger.warning("Failed to log %s generations: %s", len(rows), e)
+            return []
+
+        from .history import invalidate_history  # локальный импорт, чтобы избежать циклов
+
+        for user_id in {row["user_id"] for row in rows}:
+            invalidate_history(user_id)
+        return ids
+
+    async def log_generation(
+        self,
+        user_id: int,
+        prompt: str,
+        image_url: str,
+        settings: Dict,
+        tokens_spent: int,
+        route: Optional[Dict] = None,
+        inflight_id: Optional[int] = None,
+    ) -> Optional[int]:
+        """
+        Пишет генерацию и возвращает её id (для ссылки из журнала токенов).
+        Повтор с тем же inflight_id возвращает id уже записанной строки.
+        """
+        ids = await self.log_generations([{
+            "user_id": user_id,
+            "prompt": prompt,
+            "image_url": image_url,
+            "settings": settings,
+            "tokens_spent": tokens_spent,
+            "route": route,
+            "inflight_id": inflight_id,
+        }])
+        return ids[0] if ids else None
+
+    async def count_generations_since(self, user_id: int, model: str, created_after_iso: str) -> int:
+        """Количество генераций по модели с указанной даты (0 при ошибке)."""
+        raise NotImplementedError
+
+    async def fetch_generations_page(
+        self,
+        user_id: int,
+        cursor: Optional[str] = None,
+        direction: str = "next",
+        limit: int = 5,
+        columns: str = GENERATION_LIST_COLUMNS,
+    ) -> Page:
+        """Keyset-страница истории генераций пользователя, новые сверху."""
+        raise NotImplementedError
+
+    async def fetch_generations(self, user_id: int, limit: int = 5) -> List[Dict]:
+        raise NotImplementedError
+
+    # ---------- usage rollups ----------
+    # Дневные сводки (migrations/007) обновляются триггерами при записи
+    # генераций и покупок; model = '' — итог дня по всем моделям.
+
+    async def fetch_usage_days(self, since_day: str) -> List[Dict]:
+        """Сводки дней начиная с since_day (YYYY-MM-DD) по всем моделям, новые сверху."""
+        raise NotImplementedError
+
+    async def fetch_top_users(self, day: str, limit: int = 5) -> List[Dict]:
+        """Итоги пользователей за день, больше всего потратившие сверху."""
+        raise NotImplementedError
+
+    # ---------- in-flight predictions ----------
+    # Журнал запущенных генераций (core/inflight.py, migrations/008).
+
+    async def insert_inflight(self, row: Dict) -> int:
+        """Пишет запись журнала и возвращает её id."""
+        raise NotImplementedError
+
+    async def update_inflight(self, entry_id: int, fields: Dict) -> None:
+        raise NotImplementedError
+
+    async def delete_inflight(self, entry_id: int) -> None:
+        raise NotImplementedError
+
+    async def fetch_inflight(self, worker: int) -> List[Dict]:
+        """Незакрытые записи воркера, старые сверху."""
+        raise NotImplementedError
+
+    # ---------- keep-warm ----------
+    # Дневной расход на прогрев и последний запуск модели (core/keepwarm.py, migrations/013).
+
+    async def last_generation_at(self, model: str) -> Optional[str]:
+        """created_at последней генерации модели (replicate id) или None."""
+        raise NotImplementedError
+
+    async def save_keepwarm_spend(self, row: Dict) -> None:
+        """Upsert по day: строка {"day", "spent_usd", "warmups"} заменяется целиком."""
+        raise NotImplementedError
+
+    async def fetch_keepwarm_spend(self, day: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    # ---------- model telemetry ----------
+    # Квантильные скетчи по моделям (core/telemetry.py, migrations/009).
+
+    async def save_telemetry(self, rows: List[Dict]) -> None:
+        """Upsert по (day, worker, model, combo, status): строка заменяется целиком."""
+        raise NotImplementedError
+
+    async def fetch_telemetry(self, since_day: str) -> List[Dict]:
+        """Строки всех воркеров начиная с since_day (YYYY-MM-DD)."""
+        raise NotImplementedError
+
+    # ---------- admin actions ----------
+
+    async def log_admin_action(
+        self, admin_id: int, target_id: Optional[int], action: str, amount: int, note: Optional[str] = None
+    ) -> Optional[int]:
+        """Пишет admin_action и возвращает его id; ошибки только логируются."""
+        raise NotImplementedError
+
+    async def log_admin_actions_bulk(self, rows: List[Dict]) -> None:
+        """Пачка admin_actions одной записью; ошибки только логируются."""
+        raise NotImplementedError
+
+    # ---------- api tokens ----------
+
+    async def insert_api_token(self, row: Dict) -> None:
+        raise NotImplementedError
+
+    async def find_api_tokens(self, token_prefix: str) -> List[Dict]:
+        """Активные (не отозванные) токены с этим префиксом."""
+        raise NotImplementedError
+
+    async def find_legacy_api_token(self, token: str) -> Optional[Dict]:
+        """Активный токен, сохранённый в открытом виде (до migrations/006)."""
+        raise NotImplementedError
+
+    async def update_api_token(self, token_id: int, fields: Dict) -> None:
+        raise NotImplementedError
+
+    async def list_api_tokens(self, user_id: int) -> List[Dict]:
+        raise NotImplementedError
+
+    async def revoke_api_tokens(self, user_id: int, token_prefix: Optional[str] = None) -> int:
+        """Помечает токены отозванными. Возвращает их число."""
+        raise NotImplementedError
+
+    async def last_api_token_revocation(self) -> Optional[str]:
+        """revoked_at самого свежего отзыва (любого пользователя) или None."""
+        raise NotImplementedError
+
+
+# ---------------------------------------------------------
+# BACKEND SELECTION
+# ---------------------------------------------------------
+
+_storage: Optional[Storage] = None
+
+
+def _create(backend: str) -> Storage:
+    if backend == "supabase":
+        from .supabase import SupabaseStorage
+
+        return SupabaseStorage()
+    if backend == "sqlite":
+        from config import SQLITE_PATH
+        from .sqlite_storage import SQLiteStorage
+
+        return SQLiteStorage(SQLITE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        _storage = _create(STORAGE_BACKEND)
+    return _storage
+
+
+def set_storage(storage: Optional[Storage]) -> None:
+    """Подменяет хранилище процесса (проверка реализаций, утилиты)."""
+    global _storage
+    _storage = storage
+
+
+async def close_storage() -> None:
+    global _storage
+    if _storage is not None:
+        await _storage.close()
+    _storage = None
@@ -1,216 +1,721 @@
-from typing import Optional, Dict, List
+from datetime import datetime, timezone
+from typing import Any, Optional, Dict, List
 import httpx
 import logging
 
 from config import SUPABASE_REST_URL, SUPABASE_HEADERS_BASE
+from . import resilience
+from .http import get_http_client
+from .storage import (
+    GENERATION_LIST_COLUMNS,
+    INFLIGHT_COLUMNS,
+    KEEPWARM_COLUMNS,
+    TELEMETRY_COLUMNS,
+    USAGE_COLUMNS,
+    USAGE_USER_COLUMNS,
+    USER_COLUMNS,
+    USER_LIST_COLUMNS,
+    USER_PROFILE_COLUMNS,
+    Page,
+    Storage,
+    decode_cursor,
+    page_cursors,
+)
 
 logger = logging.getLogger(__name__)
 
-# --------- USERS ---------
-async def supabase_get_user(user_id: int) -> Optional[Dict]:
-    params = {
-        "id": f"eq.{user_id}",
-        "select": "id,username,first_name,last_name,balance,created_at,updated_at",
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_REST_URL}/telegram_users",
-            headers=SUPABASE_HEADERS_BASE,
+
+# --------- TRANSPORT ---------
+async def supabase_request(
+    method: str,
+    path: str,
+    *,
+    params: Optional[Dict] = None,
+    json: Any = None,
+    headers: Optional[Dict] = None,
+    endpoint: Optional[str] = None,
+    idempotent: Optional[bool] = None,
+) -> httpx.Response:
+    """
+    Единая точка HTTP-вызовов PostgREST: общий пул соединений и политика
+    из core.resilience (таймаут эндпоинта, повторы чтений, circuit breaker).
+    endpoint по умолчанию — supabase.read для GET и supabase.write для остального.
+    Ответы 4xx/5xx возвращаются как есть — решение о raise принимает вызывающий.
+    Бросает httpx.TransportError / asyncio.TimeoutError / CircuitOpenError.
+    """
+    if endpoint is None:
+        endpoint = "supabase.read" if method == "GET" else "supabase.write"
+    if idempotent is None:
+        idempotent = method == "GET"
+
+    client = get_http_client()
+
+    async def attempt(timeout: float) -> httpx.Response:
+        resp = await client.request(
+            method,
+            f"{SUPABASE_REST_URL}/{path}",
+            headers=headers or SUPABASE_HEADERS_BASE,
             params=params,
-            timeout=10.0,
+            json=json,
+            timeout=timeout,
         )
-    resp.raise_for_status()
-    data = resp.json()
-    return data[0] if data else None
+        if resp.status_code >= 500 or resp.status_code == 429:
+            raise resilience.RetryableStatusError(resp)
+        return resp
 
-
-async def supabase_insert_user(payload: Dict) -> None:
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{SUPABASE_REST_URL}/telegram_users",
-            headers=SUPABASE_HEADERS_BASE,
-            params={"select": "id"},
-            json=[payload],
-            timeout=10.0,
+    try:
+        return await resilience.call(
+            endpoint, attempt, dependency="supabase", idempotent=idempotent
         )
+    except resilience.RetryableStatusError as e:
+        return e.response
+
+
+# --------- USERS ---------
+# Чтения идут через view user_accounts (migrations/003_token_ledger.sql):
+# те же колонки, что у telegram_users, но balance — с учётом журнала токенов.
+USERS_VIEW = "user_accounts"
+
+
+def _write_headers(returning: bool) -> Dict:
+    """
+    Заголовки для мутаций PostgREST.
+    returning=True — "Prefer: return=representation": изменённые строки приходят
+    в том же ответе, перечитывать их отдельным GET не нужно.
+    """
+    return {
+        **SUPABASE_HEADERS_BASE,
+        "Prefer": "return=representation" if returning else "return=minimal",
+    }
+
+
+# --------- KEYSET PAGINATION ---------
+
+def _keyset_filter(op: str, created_at_iso: str, row_id: int) -> str:
+    return (
+        f'(created_at.{op}."{created_at_iso}",'
+        f'and(created_at.eq."{created_at_iso}",id.{op}.{row_id}))'
+    )
+
+
+async def _fetch_keyset_page(
+    path: str,
+    params: Dict,
+    cursor: Optional[str],
+    direction: str,
+    limit: int,
+) -> Page:
+    """
+    Общая keyset-пагинация по (created_at desc, id desc) поверх params с фильтрами.
+    direction="next" — строки старше курсора, "prev" — новее курсора.
+    Возвращает (rows, next_cursor, prev_cursor); курсор None — дальше страниц нет.
+    """
+    params = {**params, "limit": str(limit + 1)}
+
+    backwards = cursor is not None and direction == "prev"
+    if cursor is not None:
+        created_at_iso, row_id = decode_cursor(cursor)
+        params["or"] = _keyset_filter("gt" if backwards else "lt", created_at_iso, row_id)
+    params["order"] = "created_at.asc,id.asc" if backwards else "created_at.desc,id.desc"
+
+    resp = await supabase_request(
+        "GET",
+        path,
+        params=params,
+    )
     resp.raise_for_status()
+    rows = resp.json()
 
+    has_more = len(rows) > limit
+    return page_cursors(rows[:limit], cursor, backwards, has_more)
 
-async def supabase_update_user(user_id: int, payload: Dict) -> None:
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(
-            f"{SUPABASE_REST_URL}/telegram_users",
-            headers=SUPABASE_HEADERS_BASE,
-            params={"id": f"eq.{user_id}", "select": "id"},
-            json=payload,
-            timeout=10.0,
+
+# --------- SEARCH ---------
+# Индексы под эти запросы — migrations/001_admin_users_browser.sql и 011:
+# - id: первичный ключ
+# - @username: префиксный btree по username_lower (text_pattern_ops)
+# - имя / username от 3 символов: pg_trgm GIN, ILIKE '%q%'
+# - имя / username короче: префиксные btree по *_lower (text_pattern_ops), LIKE 'q%'
+
+_SEARCH_STRIP_CHARS = str.maketrans("", "", ',()*%"\\:')
+TRGM_MIN_QUERY_LEN = 3
+
+
+class SupabaseStorage(Storage):
+    """Хранилище в Supabase: PostgREST + rpc-функции из migrations/."""
+
+    name = "supabase"
+
+    async def ping(self) -> None:
+        resp = await supabase_request("GET", USERS_VIEW, params={"select": "id", "limit": "1"})
+        resp.raise_for_status()
+
+    # ---------- users ----------
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        params = {
+            "id": f"eq.{user_id}",
+            "select": USER_COLUMNS,
+        }
+        resp = await supabase_request(
+            "GET",
+            USERS_VIEW,
+            params=params,
+            endpoint="supabase.get_user",
         )
-    resp.raise_for_status()
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
 
+    async def insert_user(self, payload: Dict, returning: bool = True) -> Optional[Dict]:
+        """
+        Создаёт пользователя. При returning=True возвращает созданный профиль —
+        без balance: строка telegram_users не знает о журнале токенов.
+        """
+        resp = await supabase_request(
+            "POST",
+            "telegram_users",
+            headers=_write_headers(returning),
+            params={"select": USER_PROFILE_COLUMNS} if returning else None,
+            json=[payload],
+        )
+        resp.raise_for_status()
+        if not returning:
+            return None
+        data = resp.json()
+        return data[0] if data else None
 
-async def supabase_fetch_recent_users(limit: int = 20) -> List[Dict]:
-    params = {
-        "select": "id,username,first_name,last_name,balance,created_at",
-        "order": "created_at.desc",
-        "limit": str(limit),
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_REST_URL}/telegram_users",
-            headers=SUPABASE_HEADERS_BASE,
+    async def update_user(
+        self, user_id: int, payload: Dict, returning: bool = True
+    ) -> Optional[Dict]:
+        """
+        Обновляет пользователя. При returning=True возвращает обновлённый профиль
+        (без balance: в telegram_users — снимок до компакции, баланс — get_user)
+        или None, если пользователя с таким id нет.
+        """
+        params = {"id": f"eq.{user_id}"}
+        if returning:
+            params["select"] = USER_PROFILE_COLUMNS
+        resp = await supabase_request(
+            "PATCH",
+            "telegram_users",
+            headers=_write_headers(returning),
             params=params,
-            timeout=10.0,
+            json=payload,
         )
-    resp.raise_for_status()
-    return resp.json()
+        resp.raise_for_status()
+        if not returning:
+            return None
+        data = resp.json()
+        return data[0] if data else None
 
+    async def fetch_recent_users(self, limit: int = 20) -> List[Dict]:
+        params = {
+            "select": USER_LIST_COLUMNS,
+            "order": "created_at.desc,id.desc",
+            "limit": str(limit),
+        }
+        resp = await supabase_request(
+            "GET",
+            USERS_VIEW,
+            params=params,
+        )
+        resp.raise_for_status()
+        return resp.json()
 
-async def supabase_search_users(query: str, limit: int = 20) -> List[Dict]:
-    params = {
-        "select": "id,username,first_name,last_name,balance,created_at",
-        "limit": str(limit),
-    }
+    async def fetch_users_page(
+        self,
+        cursor: Optional[str] = None,
+        direction: str = "next",
+        limit: int = 20,
+    ) -> Page:
+        """Страница пользователей, новые сверху (см. _fetch_keyset_page)."""
+        return await _fetch_keyset_page(
+            USERS_VIEW, {"select": USER_LIST_COLUMNS}, cursor, direction, limit
+        )
 
-    if query.isdigit():
-        params["id"] = f"eq.{int(query)}"
-    else:
+    async def search_users(self, query: str, limit: int = 20) -> List[Dict]:
         q = query.strip()
-        or_param = f"(username.ilike.*{q}*,first_name.ilike.*{q}*,last_name.ilike.*{q}*)"
-        params["or"] = or_param
+        params = {
+            "select": USER_LIST_COLUMNS,
+            "order": "created_at.desc,id.desc",
+            "limit": str(limit),
+        }
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_REST_URL}/telegram_users",
-            headers=SUPABASE_HEADERS_BASE,
+        if q.isdigit():
+            params["id"] = f"eq.{int(q)}"
+        elif q.startswith("@"):
+            name = q[1:].translate(_SEARCH_STRIP_CHARS).strip().lower()
+            if not name:
+                return []
+            params["username_lower"] = f"like.{name}*"
+        else:
+            q = q.translate(_SEARCH_STRIP_CHARS).strip()
+            if not q:
+                return []
+            if len(q) >= TRGM_MIN_QUERY_LEN:
+                pattern = f"*{q}*"
+                params["or"] = (
+                    f"(username.ilike.{pattern},"
+                    f"first_name.ilike.{pattern},"
+                    f"last_name.ilike.{pattern})"
+                )
+            else:
+                # Короткие запросы триграммы не ускоряют — префикс по *_lower
+                pattern = f"{q.lower()}*"
+                params["or"] = (
+                    f"(username_lower.like.{pattern},"
+                    f"first_name_lower.like.{pattern},"
+                    f"last_name_lower.like.{pattern})"
+                )
+
+        resp = await supabase_request(
+            "GET",
+            USERS_VIEW,
             params=params,
-            timeout=10.0,
         )
-    resp.raise_for_status()
-    return resp.json()
-
-
-# --------- ADMIN ACTIONS ---------
-async def log_admin_action(
-    admin_id: int,
-    target_id: int,
-    action: str,
-    amount: int,
-    note: Optional[str] = None,
-) -> None:
-    payload = {
-        "admin_id": admin_id,
-        "target_user_id": target_id,
-        "action": action,
-        "amount": amount,
-        "note": note,
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{SUPABASE_REST_URL}/admin_actions",
-            headers=SUPABASE_HEADERS_BASE,
-            json=[payload],
-            timeout=10.0,
-        )
-    if resp.status_code >= 300:
-        logger.warning("Failed to log admin_action: %s %s", resp.status_code, resp.text)
-
-
-# --------- GENERATIONS ---------
-async def log_generation(
-    user_id: int,
-    prompt: str,
-    image_url: str,
-    settings: Dict,
-    tokens_spent: int,
-) -> None:
-    model_key = settings.get("model", "banana")
-    from config import MODEL_INFO  # локальный импорт, чтобы избежать циклов
-
-    model_cfg = MODEL_INFO.get(model_key, MODEL_INFO.get("banana", {}))
-    replicate_id = model_cfg.get("replicate", model_key)
-    payload = {
-        "user_id": user_id,
-        "prompt": prompt,
-        "image_url": image_url,
-        "tokens_spent": tokens_spent,
-        "model": replicate_id,
-        "aspect_ratio": settings.get("aspect_ratio"),
-        "resolution": settings.get("resolution"),
-        "output_format": settings.get("output_format"),
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{SUPABASE_REST_URL}/generations",
-            headers=SUPABASE_HEADERS_BASE,
-            json=[payload],
-            timeout=10.0,
+        resp.raise_for_status()
+        return resp.json()
+
+    async def fetch_active_user_ids(self, since_iso: str) -> List[int]:
+        """ID пользователей, у которых есть генерации начиная с since_iso."""
+        resp = await supabase_request(
+            "POST",
+            "rpc/users_active_since",
+            json={"since": since_iso},
+            endpoint="supabase.bulk",
+            idempotent=True,
         )
-    if resp.status_code >= 300:
-        logger.warning("Failed to log generation: %s %s", resp.status_code, resp.text)
+        resp.raise_for_status()
+        return [row["user_id"] for row in resp.json()]
 
+    # ---------- token ledger ----------
 
-async def count_generations_since(
-    user_id: int,
-    model: str,
-    created_after_iso: str,
-) -> int:
-    """Возвращает количество генераций по модели с указанной даты."""
-    headers = {
-        **SUPABASE_HEADERS_BASE,
-        "Prefer": "count=exact",
-    }
-    params = {
-        "user_id": f"eq.{user_id}",
-        "model": f"eq.{model}",
-        "created_at": f"gte.{created_after_iso}",
-        "select": "id",
-    }
+    async def ledger_append(self, entries: List[Dict]) -> List[Dict]:
+        """
+        Добавляет пачку записей в token_ledger одним запросом (rpc ledger_append,
+        migrations/010). Возвращает [{"status", "account"}] по записи на каждую.
+        """
+        resp = await supabase_request(
+            "POST",
+            "rpc/ledger_append",
+            json={"entries": entries},
+        )
+        resp.raise_for_status()
+        return resp.json()
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_REST_URL}/generations",
+    async def compact_ledger(self) -> int:
+        """Сворачивает хвост журнала в telegram_users.balance. Возвращает число пользователей."""
+        resp = await supabase_request(
+            "POST",
+            "rpc/compact_token_ledger",
+            json={},
+            endpoint="supabase.bulk",
+        )
+        resp.raise_for_status()
+        return int(resp.json() or 0)
+
+    async def bulk_add_tokens(
+        self, user_ids: List[int], amount: int, admin_action_id: Optional[int] = None
+    ) -> List[Dict]:
+        """
+        Начисляет amount каждому из user_ids одним запросом на стороне базы
+        (rpc bulk_add_tokens, migrations/014_bulk_grant_admin_action.sql).
+        Возвращает [{"id": ..., "balance": ...}] только для найденных пользователей.
+        """
+        resp = await supabase_request(
+            "POST",
+            "rpc/bulk_add_tokens",
+            json={"user_ids": user_ids, "amount": amount, "admin_action_id": admin_action_id},
+            endpoint="supabase.bulk",
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    # ---------- generations ----------
+
+    async def insert_generations(self, rows: List[Dict]) -> List[int]:
+        # Повтор проведения той же записи журнала (inflight_id, migrations/012)
+        # не пишет вторую строку, а возвращает id уже записанной
+        resp = await supabase_request(
+            "POST",
+            "generations",
+            headers={
+                **_write_headers(returning=True),
+                "Prefer": "return=representation,resolution=merge-duplicates",
+            },
+            params={"select": "id", "on_conflict": "inflight_id"},
+            json=rows,
+        )
+        if resp.status_code >= 300:
+            raise RuntimeError(f"{resp.status_code} {resp.text}")
+        return [item["id"] for item in resp.json()]
+
+    async def count_generations_since(
+        self,
+        user_id: int,
+        model: str,
+        created_after_iso: str,
+    ) -> int:
+        """Возвращает количество генераций по модели с указанной даты."""
+        headers = {
+            **SUPABASE_HEADERS_BASE,
+            "Prefer": "count=exact",
+        }
+        params = {
+            "user_id": f"eq.{user_id}",
+            "model": f"eq.{model}",
+            "created_at": f"gte.{created_after_iso}",
+            "select": "id",
+        }
+
+        resp = await supabase_request(
+            "GET",
+            "generations",
             headers=headers,
             params=params,
-            timeout=10.0,
         )
 
-    if resp.status_code >= 300:
-        logger.warning(
-            "Failed to count generations: %s %s", resp.status_code, resp.text
+        if resp.status_code >= 300:
+            logger.warning(
+                "Failed to count generations: %s %s", resp.status_code, resp.text
+            )
+            return 0
+
+        content_range = resp.headers.get("content-range") or resp.headers.get(
+            "Content-Range"
         )
-        return 0
+        if content_range and "/" in content_range:
+            try:
+                return int(content_range.split("/")[-1])
+            except ValueError:
+                pass
 
-    content_range = resp.headers.get("content-range") or resp.headers.get(
-        "Content-Range"
-    )
-    if content_range and "/" in content_range:
         try:
-            return int(content_range.split("/")[-1])
-        except ValueError:
-            pass
+            data = resp.json()
+            return len(data)
+        except Exception:
+            return 0
 
-    try:
+    async def fetch_generations_page(
+        self,
+        user_id: int,
+        cursor: Optional[str] = None,
+        direction: str = "next",
+        limit: int = 5,
+        columns: str = GENERATION_LIST_COLUMNS,
+    ) -> Page:
+        """
+        Страница истории генераций пользователя, новые сверху.
+        Индекс: generations (user_id, created_at desc, id desc), migrations/004.
+        """
+        params = {
+            "select": columns,
+            "user_id": f"eq.{user_id}",
+        }
+        return await _fetch_keyset_page("generations", params, cursor, direction, limit)
+
+    async def fetch_generations(self, user_id: int, limit: int = 5) -> List[Dict]:
+        params = {
+            "select": GENERATION_LIST_COLUMNS,
+            "user_id": f"eq.{user_id}",
+            "order": "created_at.desc",
+            "limit": str(limit),
+        }
+        resp = await supabase_request(
+            "GET",
+            "generations",
+            params=params,
+        )
+        if resp.status_code >= 300:
+            logger.warning("Failed to fetch generations: %s %s", resp.status_code, resp.text)
+            return []
+        return resp.json()
+
+    # ---------- usage rollups ----------
+
+    async def fetch_usage_days(self, since_day: str) -> List[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "usage_daily",
+            params={
+                "select": USAGE_COLUMNS,
+                "day": f"gte.{since_day}",
+                "order": "day.desc,model.asc",
+            },
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    async def fetch_top_users(self, day: str, limit: int = 5) -> List[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "usage_daily_user",
+            params={
+                "select": USAGE_USER_COLUMNS,
+                "day": f"eq.{day}",
+                "model": "eq.",
+                "order": "tokens_spent.desc",
+                "limit": str(limit),
+            },
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    # ---------- in-flight predictions ----------
+
+    async def insert_inflight(self, row: Dict) -> int:
+        resp = await supabase_request(
+            "POST",
+            "inflight_predictions",
+            params={"select": "id"},
+            headers=_write_headers(returning=True),
+            json=row,
+        )
+        resp.raise_for_status()
+        return resp.json()[0]["id"]
+
+    async def update_inflight(self, entry_id: int, fields: Dict) -> None:
+        resp = await supabase_request(
+            "PATCH",
+            "inflight_predictions",
+            params={"id": f"eq.{entry_id}"},
+            headers=_write_headers(returning=False),
+            json={**fields, "updated_at": datetime.now(timezone.utc).isoformat()},
+        )
+        resp.raise_for_status()
+
+    async def delete_inflight(self, entry_id: int) -> None:
+        resp = await supabase_request(
+            "DELETE",
+            "inflight_predictions",
+            params={"id": f"eq.{entry_id}"},
+            headers=_write_headers(returning=False),
+        )
+        resp.raise_for_status()
+
+    async def fetch_inflight(self, worker: int) -> List[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "inflight_predictions",
+            params={
+                "select": INFLIGHT_COLUMNS,
+                "worker": f"eq.{worker}",
+                "order": "id.asc",
+            },
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    # ---------- keep-warm ----------
+
+    async def last_generation_at(self, model: str) -> Optional[str]:
+        resp = await supabase_request(
+            "GET",
+            "generations",
+            params={
+                "select": "created_at",
+                "model": f"eq.{model}",
+                "order": "created_at.desc",
+                "limit": 1,
+            },
+        )
+        resp.raise_for_status()
+        rows = resp.json()
+        return rows[0]["created_at"] if rows else None
+
+    async def save_keepwarm_spend(self, row: Dict) -> None:
+        resp = await supabase_request(
+            "POST",
+            "keepwarm_spend",
+            params={"on_conflict": "day"},
+            headers={
+                **SUPABASE_HEADERS_BASE,
+                "Prefer": "resolution=merge-duplicates,return=minimal",
+            },
+            json={**row, "updated_at": datetime.now(timezone.utc).isoformat()},
+        )
+        resp.raise_for_status()
+
+    async def fetch_keepwarm_spend(self, day: str) -> Optional[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "keepwarm_spend",
+            params={"select": KEEPWARM_COLUMNS, "day": f"eq.{day}"},
+        )
+        resp.raise_for_status()
+        rows = resp.json()
+        return rows[0] if rows else None
+
+    # ---------- model telemetry ----------
+
+    async def save_telemetry(self, rows: List[Dict]) -> None:
+        now = datetime.now(timezone.utc).isoformat()
+        resp = await supabase_request(
+            "POST",
+            "model_telemetry",
+            params={"on_conflict": "day,worker,model,combo,status"},
+            headers={
+                **SUPABASE_HEADERS_BASE,
+                "Prefer": "resolution=merge-duplicates,return=minimal",
+            },
+            json=[{**row, "updated_at": now} for row in rows],
+        )
+        resp.raise_for_status()
+
+    async def fetch_telemetry(self, since_day: str) -> List[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "model_telemetry",
+            params={"select": TELEMETRY_COLUMNS, "day": f"gte.{since_day}"},
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    # ---------- admin actions ----------
+
+    async def log_admin_action(
+        self,
+        admin_id: int,
+        target_id: Optional[int],
+        action: str,
+        amount: int,
+        note: Optional[str] = None,
+    ) -> Optional[int]:
+        """Пишет admin_action и возвращает его id (для ссылки из журнала токенов)."""
+        payload = {
+            "admin_id": admin_id,
+            "target_user_id": target_id,
+            "action": action,
+            "amount": amount,
+            "note": note,
+        }
+        try:
+            resp = await supabase_request(
+                "POST",
+                "admin_actions",
+                headers=_write_headers(returning=True),
+                params={"select": "id"},
+                json=[payload],
+            )
+        except Exception as e:
+            logger.warning("Failed to log admin_action: %s", e)
+            return None
+        if resp.status_code >= 300:
+            logger.warning("Failed to log admin_action: %s %s", resp.status_code, resp.text)
+            return None
         data = resp.json()
-        return len(data)
-    except Exception:
-        return 0
+        return data[0]["id"] if data else None
 
+    async def log_admin_actions_bulk(self, rows: List[Dict]) -> None:
+        """Пишет пачку admin_actions одним INSERT (строки в формате log_admin_action)."""
+        if not rows:
+            return
+        try:
+            resp = await supabase_request(
+                "POST",
+                "admin_actions",
+                headers=_write_headers(returning=False),
+                json=rows,
+                endpoint="supabase.bulk",
+            )
+        except Exception as e:
+            logger.warning("Failed to bulk log %s admin_actions: %s", len(rows), e)
+            return
+        if resp.status_code >= 300:
+            logger.warning(
+                "Failed to bulk log %s admin_actions: %s %s", len(rows), resp.status_code, resp.text
+            )
 
-async def fetch_generations(user_id: int, limit: int = 5) -> List[Dict]:
-    params = {
-        "select": "id,prompt,image_url,tokens_spent,created_at",
-        "user_id": f"eq.{user_id}",
-        "order": "created_at.desc",
-        "limit": str(limit),
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_REST_URL}/generations",
-            headers=SUPABASE_HEADERS_BASE,
+    # ---------- api tokens ----------
+
+    async def insert_api_token(self, row: Dict) -> None:
+        resp = await supabase_request(
+            "POST",
+            "api_tokens",
+            headers=_write_headers(returning=False),
+            json=row,
+        )
+        # если что-то пошло не так — пусть упадёт, чтобы мы увидели ошибку в логах
+        resp.raise_for_status()
+
+    async def find_api_tokens(self, token_prefix: str) -> List[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "api_tokens",
+            params={
+                "select": "id,user_id,scope,expires_at,token_hash",
+                "token_prefix": f"eq.{token_prefix}",
+                "revoked_at": "is.null",
+            },
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    async def find_legacy_api_token(self, token: str) -> Optional[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "api_tokens",
+            params={
+                "select": "id,user_id,scope,expires_at",
+                "token": f"eq.{token}",
+                "revoked_at": "is.null",
+                "limit": "1",
+            },
+        )
+        resp.raise_for_status()
+        rows = resp.json()
+        return rows[0] if rows else None
+
+    async def update_api_token(self, token_id: int, fields: Dict) -> None:
+        resp = await supabase_request(
+            "PATCH",
+            "api_tokens",
+            params={"id": f"eq.{token_id}"},
+            headers=_write_headers(returning=False),
+            json=fields,
+        )
+        resp.raise_for_status()
+
+    async def list_api_tokens(self, user_id: int) -> List[Dict]:
+        resp = await supabase_request(
+            "GET",
+            "api_tokens",
+            params={
+                "select": "token_prefix,scope,created_at,expires_at",
+                "user_id": f"eq.{user_id}",
+                "revoked_at": "is.null",
+                "order": "created_at.desc",
+            },
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    async def revoke_api_tokens(self, user_id: int, token_prefix: Optional[str] = None) -> int:
+        params = {"user_id": f"eq.{user_id}", "revoked_at": "is.null", "select": "id"}
+        if token_prefix:
+            params["token_prefix"] = f"eq.{token_prefix}"
+        resp = await supabase_request(
+            "PATCH",
+            "api_tokens",
             params=params,
-            timeout=10.0,
+            headers=_write_headers(returning=True),
+            json={"revoked_at": datetime.now(timezone.utc).isoformat()},
+        )
+        resp.raise_for_status()
+        return len(resp.json())
+
+    async def last_api_token_revocation(self) -> Optional[str]:
+        resp = await supabase_request(
+            "GET",
+            "api_tokens",
+            params={
+                "select": "revoked_at",
+                "revoked_at": "not.is.null",
+                "order": "revoked_at.desc",
+                "limit": 1,
+            },
         )
-    if resp.status_code >= 300:
-        logger.warning("Failed to fetch generations: %s %s", resp.status_code, resp.text)
-        return []
-    return resp.json()
+        resp.raise_for_status()
+        rows = resp.json()
+        return rows[0]["revoked_at"] if rows else None
@@ -0,0 +1,323 @@
+import asyncio
+import logging
+import math
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from . import deadline
+from .http import get_http_client
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# MODEL TELEMETRY
+# ---------------------------------------------------------
+# По каждому предсказанию Replicate (core.generators) — в разрезе модели и
+# комбинации настроек (разрешение, формат, число референсов):
+# - predict_s — predict_time из metrics Replicate, за что платим;
+# - queue_s   — от создания предсказания до старта (очередь, холодный старт);
+# - total_s   — сколько ждал бот от создания до результата;
+# - output_mb — размер результата (HEAD по ссылке, в фоне).
+# Значения копятся в квантильных скетчах: память не растёт с числом запусков,
+# скетчи разных воркеров и дней сливаются сложением.
+# Раз в PERSIST_INTERVAL скетчи текущего дня пишутся в хранилище (model_telemetry,
+# migrations/009) — /admin_perf собирает p50/p95/p99 за несколько дней по всем воркерам.
+# Неудавшиеся и отменённые предсказания копятся отдельно — status в ключе
+# (migrations/015): за них Replicate тоже выставляет счёт.
+# Запись строки заменяет её целиком, поэтому пока сохранённые скетчи не
+# прочитаны (load), persist ничего не пишет — иначе затёр бы накопленное за день.
+
+PERSIST_INTERVAL = 300.0
+REPORT_DAYS = 7
+PROBE_TIMEOUT = 5.0
+METRICS = ("predict_s", "queue_s", "total_s", "output_mb")
+
+# ---------------------------------------------------------
+# QUANTILE SKETCH
+# ---------------------------------------------------------
+
+RELATIVE_ACCURACY = 0.01      # квантиль с точностью ±1%
+MAX_BINS = 2048               # лишнее — сливается в нижние корзины
+MIN_TRACKED = 1e-6            # меньше — считается нулём
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+class QuantileSketch:
+    """
+    Логарифмические корзины (как DDSketch): значение x попадает в корзину
+    ceil(log_gamma(x)), квантиль восстанавливается с относительной ошибкой
+    не больше RELATIVE_ACCURACY. Только неотрицательные значения.
+    """
+
+    def __init__(self) -> None:
+        self.bins: Dict[int, int] = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        value = max(0.0, float(value))
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value < MIN_TRACKED:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / _LOG_GAMMA)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        if len(self.bins) > MAX_BINS:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        lowest, second = sorted(self.bins)[:2]
+        self.bins[second] += self.bins.pop(lowest)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        for index, n in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self.bins) > MAX_BINS:
+            self._collapse()
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                value = 2 * _GAMMA ** index / (_GAMMA + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            "bins": {str(index): n for index, n in self.bins.items()},
+            "zeros": self.zeros,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "QuantileSketch":
+        sketch = cls()
+        sketch.bins = {int(index): n for index, n in data.get("bins", {}).items()}
+        sketch.zeros = data.get("zeros", 0)
+        sketch.count = data.get("count", 0)
+        sketch.total = data.get("total", 0.0)
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+# ---------------------------------------------------------
+# COLLECTOR
+# ---------------------------------------------------------
+
+Key = Tuple[str, str, str]   # (модель, комбинация настроек, статус предсказания)
+
+_FRACTION_RE = re.compile(r"(\.\d{6})\d+")
+
+
+def _parse_ts(value: Optional[str]) -> Optional[datetime]:
+    """Время Replicate ("...T12:00:00.123456789Z") -> datetime; None, если нет."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(_FRACTION_RE.sub(r"\1", value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def settings_combo(payload: Dict) -> str:
+    """Настройки, от которых зависят время и размер результата: "2K · png · refs 1"."""
+    refs = len(payload.get("image_input") or [])
+    if payload.get("image_prompt") or payload.get("image"):
+        refs += 1
+    parts = [payload.get("resolution"), payload.get("output_format"), f"refs {refs}"]
+    return " · ".join(str(p) for p in parts if p)
+
+
+class Telemetry:
+    def __init__(self) -> None:
+        self.worker = 0
+        self._day = self._today()
+        self._sketches: Dict[Key, Dict[str, QuantileSketch]] = {}
+        self._dirty = False
+        self._closed: List[Tuple[str, Dict[Key, Dict[str, QuantileSketch]]]] = []
+        self._loaded = False
+        self._probes: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(timezone.utc).date().isoformat()
+
+    def _sketch(self, key: Key, metric: str) -> QuantileSketch:
+        return self._sketches.setdefault(key, {}).setdefault(metric, QuantileSketch())
+
+    def _roll_day(self) -> None:
+        """Новый день UTC: скетчи прошлого ждут записи, копим заново."""
+        today = self._today()
+        if today == self._day:
+            return
+        if self._dirty:
+            self._closed.append((self._day, self._sketches))
+        self._day, self._sketches, self._dirty = today, {}, False
+
+    def record(
+        self,
+        model_key: str,
+        payload: Dict,
+        prediction,
+        total_s: float,
+        output_url: Optional[str],
+        status: str = "succeeded",
+    ) -> None:
+        """
+        Учитывает завершённое предсказание (status — succeeded / failed / canceled).
+        Размер результата дописывается в фоне.
+        """
+        self._roll_day()
+        key = (model_key, settings_combo(payload), status)
+        self._sketch(key, "total_s").add(total_s)
+
+        predict_time = (getattr(prediction, "metrics", None) or {}).get("predict_time")
+        if predict_time is not None:
+            self._sketch(key, "predict_s").add(predict_time)
+        created = _parse_ts(getattr(prediction, "created_at", None))
+        started = _parse_ts(getattr(prediction, "started_at", None))
+        if created and started:
+            self._sketch(key, "queue_s").add((started - created).total_seconds())
+        self._dirty = True
+
+        if output_url:
+            task = deadline.spawn_detached(self._probe_size(key, self._day, output_url))
+            self._probes.add(task)
+            task.add_done_callback(self._probes.discard)
+
+    async def _probe_size(self, key: Key, day: str, url: str) -> None:
+        try:
+            resp = await get_http_client().head(url, timeout=PROBE_TIMEOUT, follow_redirects=True)
+            resp.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.debug("Output size probe failed for %s: %s", url, e)
+            return
+        length = resp.headers.get("content-length")
+        if length and length.isdigit() and day == self._day:
+            self._sketch(key, "output_mb").add(int(length) / (1024 * 1024))
+            self._dirty = True
+
+    # ---------- persistence ----------
+
+    @staticmethod
+    def _rows(day: str, worker: int, sketches: Dict[Key, Dict[str, QuantileSketch]]) -> List[Dict]:
+        return [
+            {
+                "day": day,
+                "worker": worker,
+                "model": model,
+                "combo": combo,
+                "status": status,
+                "sketches": {metric: sketch.to_dict() for metric, sketch in metrics.items()},
+            }
+            for (model, combo, status), metrics in sketches.items()
+        ]
+
+    async def load(self) -> None:
+        """
+        Подхватывает уже сохранённые скетчи этого воркера (после рестарта) —
+        за сегодня и за ещё не записанные прошедшие дни. До успешного load
+        persist не пишет.
+        """
+        if self._loaded:
+            return
+        self._roll_day()
+        targets = {day: sketches for day, sketches in self._closed}
+        targets[self._day] = self._sketches
+        rows = await get_storage().fetch_telemetry(min(targets))
+        for row in rows:
+            sketches = targets.get(row["day"])
+            if row["worker"] != self.worker or sketches is None:
+                continue
+            key = (row["model"], row["combo"], row["status"])
+            for metric, data in row["sketches"].items():
+                sketches.setdefault(key, {}).setdefault(metric, QuantileSketch()).merge(
+                    QuantileSketch.from_dict(data)
+                )
+        self._loaded = True
+
+    async def persist(self) -> None:
+        """Пишет изменившиеся скетчи (и прошлого дня, если он только что закончился)."""
+        await self.load()
+        self._roll_day()
+        closed, self._closed = self._closed, []
+        rows = [row for day, sketches in closed for row in self._rows(day, self.worker, sketches)]
+        dirty, self._dirty = self._dirty, False
+        if dirty:
+            rows += self._rows(self._day, self.worker, self._sketches)
+        if not rows:
+            return
+        try:
+            await get_storage().save_telemetry(rows)
+        except Exception:
+            self._closed = closed + self._closed
+            self._dirty = self._dirty or dirty
+            raise
+
+    # ---------- report ----------
+
+    async def report(self, days: int = REPORT_DAYS) -> Dict[Key, Dict[str, QuantileSketch]]:
+        """Скетчи за days дней по всем воркерам; свои сегодняшние — из памяти, они свежее."""
+        since = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+        merged: Dict[Key, Dict[str, QuantileSketch]] = {}
+
+        def add(key: Key, metric: str, sketch: QuantileSketch) -> None:
+            merged.setdefault(key, {}).setdefault(metric, QuantileSketch()).merge(sketch)
+
+        for row in await get_storage().fetch_telemetry(since):
+            if row["worker"] == self.worker and row["day"] == self._day:
+                continue
+            for metric, data in row["sketches"].items():
+                add((row["model"], row["combo"]), metric, QuantileSketch.from_dict(data))
+        for key, metrics in self._sketches.items():
+            for metric, sketch in metrics.items():
+                add(key, metric, sketch)
+        return merged
+
+
+telemetry = Telemetry()
+
+
+async def run_telemetry_loop(interval: float = PERSIST_INTERVAL) -> None:
+    """
+    Периодически сохраняет скетчи; при старте подхватывает сохранённые за сегодня.
+    Не прочиталось — persist повторит чтение перед записью.
+    """
+    try:
+        await telemetry.load()
+    except Exception as e:
+        logger.warning("Telemetry load failed: %s", e)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await telemetry.persist()
+        except Exception as e:
+            logger.warning("Telemetry persist failed: %s", e)
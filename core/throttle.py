@@ -0,0 +1,115 @@
+import functools
+import logging
+import math
+from typing import Awaitable, Callable, Dict, Iterable, Tuple
+
+from telegram import Update
+
+from config import RATE_LIMITS, ADMIN_IDS
+from .cache import TTLCache
+from .outbound import outbound, PRIORITY_INTERACTIVE
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# PER-USER FLOOD CONTROL
+# ---------------------------------------------------------
+# Token bucket на (класс действия, user_id). Проверка идёт до любого I/O
+# хендлера: лишний апдейт не трогает ни Supabase, ни Replicate.
+# Сверх лимита — одно сообщение «помедленнее» на период ожидания,
+# остальное молча отбрасывается (без очереди, которая разгребалась бы потом);
+# нажатие кнопки получает answer() всегда.
+
+
+class UserRateLimiter:
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[int, float]],
+        exempt: Iterable[int] = (),
+        maxsize: int = 100_000,
+    ) -> None:
+        self.limits = limits
+        self.exempt = set(exempt)
+        # Простаивающее ведро через period снова полное — его можно выбросить
+        idle_ttl = max(period for _, period in limits.values())
+        self._buckets = TTLCache(maxsize=maxsize, ttl=idle_ttl)
+        self._notified = TTLCache(maxsize=maxsize, ttl=idle_ttl)
+        self.rejected: Dict[str, int] = {action: 0 for action in limits}
+
+    def hit(self, action: str, user_id: int) -> float:
+        """0.0 — действие разрешено, иначе сколько секунд ждать."""
+        if user_id in self.exempt or action not in self.limits:
+            return 0.0
+        key = (action, user_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            count, period = self.limits[action]
+            bucket = TokenBucket(count / period, count)
+        # set продлевает TTL: иначе ведро активного пользователя истекает
+        # через period от создания и сменяется полным — лишний burst
+        self._buckets.set(key, bucket)
+        wait = bucket.try_consume()
+        if wait > 0:
+            self.rejected[action] += 1
+        return wait
+
+    def should_notify(self, action: str, user_id: int, wait: float) -> bool:
+        """Предупреждаем один раз, пока лимит не отпустит."""
+        key = (action, user_id)
+        if key in self._notified:
+            return False
+        self._notified.set(key, True, ttl=wait)
+        return True
+
+
+user_limiter = UserRateLimiter(RATE_LIMITS, exempt=ADMIN_IDS)
+
+
+async def allow(update: Update, action: str) -> bool:
+    """
+    True — апдейт можно обрабатывать. Иначе (лимит исчерпан) при необходимости
+    отвечает «помедленнее» и возвращает False.
+    """
+    user = update.effective_user
+    if user is None:
+        return True
+    wait = user_limiter.hit(action, user.id)
+    if wait <= 0:
+        return True
+
+    # pre_checkout без ответа подвесит оплату у пользователя — отвечаем всегда
+    if update.pre_checkout_query:
+        await update.pre_checkout_query.answer(
+            ok=False, error_message="Слишком много попыток оплаты, попробуйте через минуту."
+        )
+        return False
+
+    text = f"🐢 Слишком часто. Подождите {math.ceil(wait)} с и попробуйте снова."
+    notify = user_limiter.should_notify(action, user.id, wait)
+    if notify:
+        logger.info("Rate limit %s hit by %s, wait %.1fs", action, user.id, wait)
+
+    # Неотвеченная кнопка крутит «часики» до таймаута клиента — отвечаем на каждое
+    # нажатие; всплывающая подсказка в чат не пишет, её можно показывать всегда
+    if update.callback_query:
+        await update.callback_query.answer(text)
+    elif notify and update.effective_message:
+        message = update.effective_message
+        outbound.submit(message.chat_id, lambda: message.reply_text(text), PRIORITY_INTERACTIVE)
+    return False
+
+
+def rate_limited(action: str) -> Callable:
+    """Декоратор хендлера PTB: класс действия action, проверка до всего остального."""
+
+    def decorator(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if not await allow(update, action):
+                return None
+            return await handler(update, context)
+
+        return wrapper
+
+    return decorator
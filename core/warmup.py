@@ -0,0 +1,45 @@
+import asyncio
+import logging
+
+from config import MODEL_INFO
+from .generators import get_replicate_client
+from .imaging import warm_pool
+from .storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# PRE-WARM (post_init)
+# ---------------------------------------------------------
+# Первый апдейт после деплоя не должен платить за DNS, TLS-рукопожатия,
+# создание клиента Replicate и запуск процессов пула картинок.
+# Пул Telegram прогревает сам PTB: Application.initialize() делает getMe до post_init.
+
+PREWARM_TIMEOUT = 10.0
+
+
+async def _warm_storage() -> None:
+    await get_storage().ping()
+
+
+async def _warm_replicate() -> None:
+    client = get_replicate_client()
+    # Заодно проверяем, что все модели из MODEL_INFO доступны под нашим токеном
+    names = {cfg["replicate"].split(":", 1)[0] for cfg in MODEL_INFO.values()}
+    await asyncio.gather(*(client.models.async_get(name) for name in names))
+
+
+async def prewarm() -> None:
+    """Прогревает соединения и тяжёлые объекты. Ошибки только логируются."""
+    warmers = {
+        "storage": _warm_storage,
+        "replicate": _warm_replicate,
+        "imaging": warm_pool,
+    }
+    results = await asyncio.gather(
+        *(asyncio.wait_for(w(), PREWARM_TIMEOUT) for w in warmers.values()),
+        return_exceptions=True,
+    )
+    for name, result in zip(warmers, results):
+        if isinstance(result, BaseException):
+            logger.warning("Prewarm %s failed: %r", name, result)
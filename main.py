@@ -1,18 +1,157 @@
-from telegram.ext import ApplicationBuilder
+from utils import startup  # первым: отсчёт времени запуска
 
-from config import TELEGRAM_BOT_TOKEN
-from utils.logging_config import setup_logging
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+from telegram import Update
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    BasePersistence,
+    ContextTypes,
+    TypeHandler,
+)
+
+from config import TELEGRAM_BOT_TOKEN, API_PORT, validate_config
+from core import inflight
+from core.http import close_http_client
+from core.imaging import shutdown_pool
+from core.keepwarm import run_keepwarm_loop
+from core.ledger import ledger, run_compaction_loop
+from core.outbound import outbound
+from core.storage import close_storage
+from core.telemetry import telemetry, run_telemetry_loop
+from core.deadline import DeadlineExceeded
+from core.resilience import CircuitOpenError
+from core.warmup import prewarm
+from utils.logging_config import bind_log_context, setup_logging
 from user.handlers import register_user_handlers
 from admin.handlers import register_admin_handlers
 
+logger = logging.getLogger(__name__)
+
+startup.mark("imports")
+
+
+_background_tasks: list[asyncio.Task] = []
+# В кластере фоновые задачи (компакция журнала, прогрев моделей) крутит только один воркер
+_background_jobs_enabled = True
+_api_runner = None
+
+
+async def post_init(application: Application) -> None:
+    global _api_runner
+    await outbound.start()
+    if _background_jobs_enabled:
+        _background_tasks.append(asyncio.create_task(run_compaction_loop()))
+        _background_tasks.append(asyncio.create_task(run_keepwarm_loop()))
+    if API_PORT and _background_jobs_enabled:
+        # aiohttp нужен только API — импортируем, если оно включено
+        from api.server import start_api_server
+
+        _api_runner = await start_api_server(API_PORT)
+    # Телеметрию моделей каждый воркер копит и сохраняет сам
+    _background_tasks.append(asyncio.create_task(run_telemetry_loop()))
+    # Генерации, прерванные прошлым запуском этого воркера
+    _background_tasks.append(asyncio.create_task(inflight.recover(application.bot)))
+    await prewarm()
+    startup.mark("ready")
+    startup.report()
+
+
+async def post_shutdown(application: Application) -> None:
+    global _api_runner
+    if _api_runner is not None:
+        await _api_runner.cleanup()
+        _api_runner = None
+
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+    await ledger.flush()
+    try:
+        await telemetry.persist()
+    except Exception as e:
+        logger.warning("Telemetry persist on shutdown failed: %s", e)
+    await outbound.stop()
+    await close_storage()
+    await close_http_client()
+    shutdown_pool()
 
-def main() -> None:
-    setup_logging()
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
 
+async def bind_update_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Группа -2: user_id и update_id попадают во все логи обработки апдейта."""
+    user = update.effective_user
+    bind_log_context(user_id=user.id if user else None, update_id=update.update_id)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    err = context.error
+
+    if isinstance(err, DeadlineExceeded):
+        logger.warning("Update cancelled by deadline: %s", err)
+        if isinstance(update, Update) and update.effective_message:
+            try:
+                await update.effective_message.reply_text(
+                    "⏱ Не успел ответить вовремя, попробуйте ещё раз."
+                )
+            except Exception:
+                pass
+        return
+
+    dependency_down = isinstance(
+        err, (CircuitOpenError, httpx.TransportError, asyncio.TimeoutError)
+    )
+    if dependency_down:
+        logger.warning("Dependency failure while handling update: %r", err)
+    else:
+        logger.error("Unhandled error while handling update", exc_info=err)
+
+    if dependency_down and isinstance(update, Update) and update.effective_message:
+        try:
+            await update.effective_message.reply_text(
+                "⚠️ Сервис временно недоступен, попробуйте через минуту."
+            )
+        except Exception:
+            pass
+
+
+def build_application(
+    persistence: Optional[BasePersistence] = None,
+    background_jobs: bool = True,
+) -> Application:
+    global _background_jobs_enabled
+    _background_jobs_enabled = background_jobs
+
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
+
+    # Своя группа: в группе срабатывает только первый подошедший хендлер,
+    # а в -1 стоит поиск админа (register_admin_handlers)
+    application.add_handler(TypeHandler(Update, bind_update_context), group=-2)
     # Админские и пользовательские хендлеры
     register_admin_handlers(application)
     register_user_handlers(application)
+    application.add_error_handler(error_handler)
+    return application
+
+
+def main() -> None:
+    setup_logging()
+    validate_config()
+    application = build_application()
+    startup.mark("build")
 
     application.run_polling()
 
@@ -0,0 +1,25 @@
+-- Админ-панель: keyset-пагинация и поиск пользователей без seq scan.
+
+create extension if not exists pg_trgm;
+
+-- Keyset-пагинация списка: order by created_at desc, id desc
+create index if not exists telegram_users_created_at_id_idx
+    on telegram_users (created_at desc, id desc);
+
+-- Поиск по @username: префиксный btree по нормализованному username
+alter table telegram_users
+    add column if not exists username_lower text
+    generated always as (lower(username)) stored;
+
+create index if not exists telegram_users_username_lower_prefix_idx
+    on telegram_users (username_lower text_pattern_ops);
+
+-- Поиск по части имени / username: ILIKE '%q%' через триграммы
+create index if not exists telegram_users_username_trgm_idx
+    on telegram_users using gin (username gin_trgm_ops);
+
+create index if not exists telegram_users_first_name_trgm_idx
+    on telegram_users using gin (first_name gin_trgm_ops);
+
+create index if not exists telegram_users_last_name_trgm_idx
+    on telegram_users using gin (last_name gin_trgm_ops);
@@ -0,0 +1,27 @@
+-- Массовые начисления токенов из админки (/bulk_grant).
+
+-- Начисление пачке пользователей одним UPDATE; возвращает новые балансы
+create or replace function bulk_add_tokens(user_ids bigint[], amount integer)
+returns table (id bigint, balance integer)
+language sql
+as $$
+    update telegram_users u
+       set balance = greatest(0, u.balance + amount),
+           updated_at = now()
+     where u.id = any(user_ids)
+ returning u.id, u.balance;
+$$;
+
+-- Пользователи, у которых были генерации начиная с указанного момента
+create or replace function users_active_since(since timestamptz)
+returns table (user_id bigint)
+language sql
+stable
+as $$
+    select distinct g.user_id
+      from generations g
+     where g.created_at >= since;
+$$;
+
+create index if not exists generations_created_at_idx
+    on generations (created_at);
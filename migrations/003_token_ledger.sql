@@ -0,0 +1,119 @@
+-- Append-only журнал токенов вместо перезаписи telegram_users.balance.
+--
+-- telegram_users.balance теперь — материализованный снимок: в него периодически
+-- сворачиваются (compact_token_ledger) ещё не учтённые записи журнала.
+-- Актуальный баланс = снимок + хвост несвёрнутых записей пользователя
+-- (view user_accounts: одна строка пользователя + частичный индекс по хвосту).
+-- Запись никогда не трогает строку пользователя, поэтому конкурентные
+-- списания/начисления не упираются в блокировку одной горячей строки.
+
+create table if not exists token_ledger (
+    id                bigserial primary key,
+    user_id           bigint      not null references telegram_users (id),
+    delta             integer     not null,
+    reason            text        not null,  -- purchase / generation / admin / bulk_grant / ...
+    payment_charge_id text        unique,    -- telegram_payment_charge_id, защищает от двойного зачисления
+    generation_id     bigint,
+    admin_action_id   bigint,
+    compacted         boolean     not null default false,
+    created_at        timestamptz not null default now()
+);
+
+create index if not exists token_ledger_user_id_idx
+    on token_ledger (user_id, id);
+
+-- Хвост, который ещё не свёрнут в снимок, — маленький, индекс по нему тоже
+create index if not exists token_ledger_pending_idx
+    on token_ledger (user_id)
+    where not compacted;
+
+-- Пользователь с актуальным балансом
+create or replace view user_accounts as
+select u.id,
+       u.username,
+       u.username_lower,
+       u.first_name,
+       u.last_name,
+       u.balance + coalesce(p.pending, 0) as balance,
+       u.created_at,
+       u.updated_at
+  from telegram_users u
+  left join lateral (
+        select sum(l.delta)::integer as pending
+          from token_ledger l
+         where l.user_id = u.id
+           and not l.compacted
+  ) p on true;
+
+-- Пачка записей одним запросом; возвращает актуальные строки затронутых пользователей.
+-- Повтор записи с тем же payment_charge_id игнорируется.
+create or replace function ledger_append(entries jsonb)
+returns setof user_accounts
+language plpgsql
+as $$
+begin
+    insert into token_ledger (user_id, delta, reason, payment_charge_id, generation_id, admin_action_id)
+    select e.user_id, e.delta, e.reason, e.payment_charge_id, e.generation_id, e.admin_action_id
+      from jsonb_to_recordset(entries) as e(
+            user_id bigint,
+            delta integer,
+            reason text,
+            payment_charge_id text,
+            generation_id bigint,
+            admin_action_id bigint
+           )
+    on conflict (payment_charge_id) do nothing;
+
+    return query
+        select a.*
+          from user_accounts a
+         where a.id in (select (e ->> 'user_id')::bigint from jsonb_array_elements(entries) e);
+end;
+$$;
+
+-- Сворачивание хвоста журнала в снимок: одно обновление строки пользователя
+-- на период компакции, а не на каждую операцию.
+create or replace function compact_token_ledger()
+returns integer
+language sql
+as $$
+    with moved as (
+        update token_ledger
+           set compacted = true
+         where not compacted
+     returning user_id, delta
+    ),
+    sums as (
+        select user_id, sum(delta)::integer as delta
+          from moved
+         group by user_id
+    ),
+    applied as (
+        update telegram_users u
+           set balance = u.balance + s.delta,
+               updated_at = now()
+          from sums s
+         where u.id = s.user_id
+     returning u.id
+    )
+    select count(*)::integer from applied;
+$$;
+
+-- Массовое начисление (migrations/002) тоже пишет в журнал
+create or replace function bulk_add_tokens(user_ids bigint[], amount integer)
+returns table (id bigint, balance integer)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    insert into token_ledger (user_id, delta, reason)
+    select u.id, amount, 'bulk_grant'
+      from telegram_users u
+     where u.id = any(user_ids);
+
+    return query
+        select a.id, a.balance
+          from user_accounts a
+         where a.id = any(user_ids);
+end;
+$$;
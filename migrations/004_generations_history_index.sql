@@ -0,0 +1,3 @@
+-- /history: keyset-пагинация генераций пользователя, новые сверху.
+create index if not exists generations_user_created_at_id_idx
+    on generations (user_id, created_at desc, id desc);
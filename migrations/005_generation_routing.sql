@@ -0,0 +1,10 @@
+-- Маршрутизация моделей (core/routing.py): какая модель реально отработала и почему.
+-- model — фактическая модель, requested_model — выбранная пользователем.
+alter table generations
+    add column if not exists requested_model text,
+    add column if not exists routing_decision text not null default 'primary',
+    add column if not exists routing_reason text;
+
+create index if not exists generations_routed_idx
+    on generations (created_at desc)
+    where routing_decision <> 'primary';
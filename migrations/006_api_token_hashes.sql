@@ -0,0 +1,16 @@
+-- Токены Photoshop-плагина хранятся как HMAC-SHA256 (core/api_tokens.py).
+-- token_prefix — первые 8 символов после "ps_", по нему ищется строка.
+-- Старые строки с открытым token переводятся на хеш при первой проверке.
+alter table api_tokens
+    alter column token drop not null,
+    add column if not exists token_hash text,
+    add column if not exists token_prefix text,
+    add column if not exists revoked_at timestamptz;
+
+create index if not exists api_tokens_prefix_idx
+    on api_tokens (token_prefix)
+    where revoked_at is null;
+
+create index if not exists api_tokens_user_idx
+    on api_tokens (user_id)
+    where revoked_at is null;
@@ -0,0 +1,134 @@
+-- Дневные сводки для /admin_stats: сколько сгенерировано, сколько потрачено
+-- токенов, сколько куплено — без сканирования generations и token_ledger.
+--
+-- Сводки обновляются триггерами в той же транзакции, что и запись генерации
+-- (log_generation) или покупки (ledger_append с reason = 'purchase'), поэтому
+-- не расходятся с исходными таблицами; повтор payment_charge_id отбрасывается
+-- до триггера и покупку дважды не считает.
+--
+-- model = '' — итог дня по всем моделям; покупки считаются только в нём.
+-- День — по UTC.
+
+create table if not exists usage_daily_user (
+    day              date    not null,
+    model            text    not null,
+    user_id          bigint  not null,
+    generations      integer not null default 0,
+    tokens_spent     bigint  not null default 0,
+    purchases        integer not null default 0,
+    tokens_purchased bigint  not null default 0,
+    primary key (day, model, user_id)
+);
+
+-- Топ пользователей дня
+create index if not exists usage_daily_user_top_idx
+    on usage_daily_user (day, model, tokens_spent desc);
+
+create table if not exists usage_daily (
+    day              date    not null,
+    model            text    not null,
+    users            integer not null default 0,  -- разных пользователей за день
+    generations      integer not null default 0,
+    tokens_spent     bigint  not null default 0,
+    purchases        integer not null default 0,
+    tokens_purchased bigint  not null default 0,
+    primary key (day, model)
+);
+
+-- Одно событие в сводках пользователя и дня. Новая строка пользователя
+-- за день (xmax = 0 — вставка, а не обновление) добавляет его в users.
+create or replace function usage_add(
+    p_day date,
+    p_model text,
+    p_user_id bigint,
+    p_generations integer,
+    p_tokens_spent bigint,
+    p_purchases integer,
+    p_tokens_purchased bigint
+)
+returns void
+language plpgsql
+as $$
+declare
+    is_new boolean;
+begin
+    insert into usage_daily_user as u
+           (day, model, user_id, generations, tokens_spent, purchases, tokens_purchased)
+    values (p_day, p_model, p_user_id, p_generations, p_tokens_spent, p_purchases, p_tokens_purchased)
+    on conflict (day, model, user_id) do update
+       set generations      = u.generations + excluded.generations,
+           tokens_spent     = u.tokens_spent + excluded.tokens_spent,
+           purchases        = u.purchases + excluded.purchases,
+           tokens_purchased = u.tokens_purchased + excluded.tokens_purchased
+    returning (xmax = 0) into is_new;
+
+    insert into usage_daily as d
+           (day, model, users, generations, tokens_spent, purchases, tokens_purchased)
+    values (p_day, p_model, case when is_new then 1 else 0 end,
+            p_generations, p_tokens_spent, p_purchases, p_tokens_purchased)
+    on conflict (day, model) do update
+       set users            = d.users + excluded.users,
+           generations      = d.generations + excluded.generations,
+           tokens_spent     = d.tokens_spent + excluded.tokens_spent,
+           purchases        = d.purchases + excluded.purchases,
+           tokens_purchased = d.tokens_purchased + excluded.tokens_purchased;
+end;
+$$;
+
+create or replace function usage_on_generation()
+returns trigger
+language plpgsql
+as $$
+declare
+    d date := (new.created_at at time zone 'utc')::date;
+begin
+    perform usage_add(d, coalesce(new.model, ''), new.user_id, 1, new.tokens_spent, 0, 0);
+    perform usage_add(d, '', new.user_id, 1, new.tokens_spent, 0, 0);
+    return null;
+end;
+$$;
+
+create or replace function usage_on_purchase()
+returns trigger
+language plpgsql
+as $$
+begin
+    perform usage_add((new.created_at at time zone 'utc')::date, '', new.user_id, 0, 0, 1, new.delta);
+    return null;
+end;
+$$;
+
+drop trigger if exists usage_on_generation on generations;
+create trigger usage_on_generation
+    after insert on generations
+    for each row execute function usage_on_generation();
+
+drop trigger if exists usage_on_purchase on token_ledger;
+create trigger usage_on_purchase
+    after insert on token_ledger
+    for each row when (new.reason = 'purchase')
+    execute function usage_on_purchase();
+
+-- Разовое заполнение по уже накопленной истории (повторный запуск миграции
+-- начинает с чистых сводок)
+truncate usage_daily_user, usage_daily;
+
+insert into usage_daily_user (day, model, user_id, generations, tokens_spent)
+select (created_at at time zone 'utc')::date, m.model, user_id, count(*), coalesce(sum(tokens_spent), 0)
+  from generations
+ cross join lateral (values (coalesce(model, '')), ('')) as m (model)
+ group by 1, 2, 3;
+
+insert into usage_daily_user as u (day, model, user_id, purchases, tokens_purchased)
+select (created_at at time zone 'utc')::date, '', user_id, count(*), sum(delta)
+  from token_ledger
+ where reason = 'purchase'
+ group by 1, 3
+on conflict (day, model, user_id) do update
+   set purchases        = excluded.purchases,
+       tokens_purchased = excluded.tokens_purchased;
+
+insert into usage_daily (day, model, users, generations, tokens_spent, purchases, tokens_purchased)
+select day, model, count(*), sum(generations), sum(tokens_spent), sum(purchases), sum(tokens_purchased)
+  from usage_daily_user
+ group by day, model;
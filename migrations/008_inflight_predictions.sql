@@ -0,0 +1,24 @@
+-- Журнал запущенных генераций (core/inflight.py).
+--
+-- Запись появляется до запуска предсказания в Replicate, prediction_id
+-- дописывается сразу после его создания, а удаляется запись, когда генерация
+-- проведена (списание + лог) или пользователю сказано, что токены не списаны.
+-- Всё, что осталось после падения процесса, разбирается при следующем старте
+-- того же воркера (worker — слот cluster.py, 0 без кластера).
+
+create table if not exists inflight_predictions (
+    id            bigserial primary key,
+    worker        integer     not null default 0,
+    user_id       bigint      not null,
+    chat_id       bigint      not null,
+    prompt        text,
+    settings      jsonb       not null,
+    cost          integer     not null default 0,
+    model         text,                  -- ключ MODEL_INFO, который реально запущен
+    prediction_id text,                  -- null — упали до создания предсказания
+    created_at    timestamptz not null default now(),
+    updated_at    timestamptz not null default now()
+);
+
+create index if not exists inflight_predictions_worker_idx
+    on inflight_predictions (worker, id);
@@ -0,0 +1,14 @@
+-- Телеметрия моделей (core/telemetry.py): квантильные скетчи predict_time,
+-- очереди, полного времени и размера результата по модели и комбинации
+-- настроек. Каждый воркер раз в несколько минут перезаписывает свои строки
+-- за текущий день; /admin_perf сливает скетчи всех воркеров за последние дни.
+
+create table if not exists model_telemetry (
+    day        date        not null,
+    worker     integer     not null,
+    model      text        not null,
+    combo      text        not null,   -- "2K · png · refs 1"
+    sketches   jsonb       not null,   -- {"predict_s": {...}, "queue_s": {...}, ...}
+    updated_at timestamptz not null default now(),
+    primary key (day, worker, model, combo)
+);
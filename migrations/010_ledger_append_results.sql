@@ -0,0 +1,93 @@
+-- ledger_append: результат на каждую запись пачки вместо одного общего.
+--
+-- Раньше пачка вставлялась одним insert: запись для несуществующего
+-- пользователя (внешний ключ на telegram_users) роняла всю пачку, и вместе
+-- с ней терялись покупки и списания других пользователей из того же окна.
+-- Теперь записи проводятся по одной; на каждую — строка (status, account)
+-- в порядке пачки:
+--   ok           — записано, account — строка user_accounts с новым балансом;
+--   duplicate    — повтор payment_charge_id, ничего не записано;
+--   no_user      — пользователя нет, account = null;
+--   insufficient — списанию (mode = 'debit') не хватило токенов, ничего не записано.
+--
+-- Проверка баланса и запись — под транзакционной advisory-блокировкой
+-- пользователя (ключ — user_id), поэтому параллельные списания не уводят
+-- баланс в минус. Строку telegram_users запись по-прежнему не трогает:
+-- ни горячей строки, ни ожидания компакции. Блокировки берутся до записей,
+-- по возрастанию user_id — пачки разных воркеров с общими пользователями
+-- не взаимоблокируются.
+-- mode записи:
+--   add   — delta как есть (по умолчанию);
+--   debit — списание целиком или отказ;
+--   clamp — списание не больше текущего баланса;
+--   set   — delta — целевой баланс, пишется разница с текущим.
+
+drop function if exists ledger_append(jsonb);
+
+create function ledger_append(entries jsonb)
+returns table (status text, account jsonb)
+language plpgsql
+as $$
+declare
+    item            jsonb;
+    uid             bigint;
+    mode            text;
+    amount          integer;
+    current_balance integer;
+    inserted        integer;
+begin
+    for uid in
+        select distinct (e ->> 'user_id')::bigint
+          from jsonb_array_elements(entries) e
+         order by 1
+    loop
+        perform pg_advisory_xact_lock(uid);
+    end loop;
+
+    for item in
+        select t.value
+          from jsonb_array_elements(entries) with ordinality as t (value, n)
+         order by t.n
+    loop
+        uid := (item ->> 'user_id')::bigint;
+
+        perform 1 from telegram_users u where u.id = uid;
+        if not found then
+            status := 'no_user';
+            account := null;
+            return next;
+            continue;
+        end if;
+
+        select a.balance into current_balance from user_accounts a where a.id = uid;
+        mode := coalesce(item ->> 'mode', 'add');
+        amount := (item ->> 'delta')::integer;
+        if mode = 'set' then
+            amount := amount - current_balance;
+        elsif mode = 'clamp' then
+            amount := greatest(amount, -current_balance);
+        elsif mode = 'debit' and current_balance + amount < 0 then
+            status := 'insufficient';
+            select to_jsonb(a) into account from user_accounts a where a.id = uid;
+            return next;
+            continue;
+        end if;
+
+        insert into token_ledger (user_id, delta, reason, payment_charge_id, generation_id, admin_action_id)
+        values (
+            uid,
+            amount,
+            item ->> 'reason',
+            item ->> 'payment_charge_id',
+            (item ->> 'generation_id')::bigint,
+            (item ->> 'admin_action_id')::bigint
+        )
+        on conflict (payment_charge_id) do nothing;
+        get diagnostics inserted = row_count;
+
+        status := case when inserted = 1 then 'ok' else 'duplicate' end;
+        select to_jsonb(a) into account from user_accounts a where a.id = uid;
+        return next;
+    end loop;
+end;
+$$;
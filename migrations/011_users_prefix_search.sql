@@ -0,0 +1,42 @@
+-- Короткий поиск пользователей (1–2 символа) без seq scan.
+--
+-- Триграммы (migrations/001) ускоряют ILIKE '%q%' только от 3 символов,
+-- а короче поиск идёт по префиксу. Префиксный ILIKE по трём колонкам ни
+-- один индекс не поддерживал. Теперь короткий запрос — lower(col) LIKE 'q%'
+-- по нормализованным колонкам с btree text_pattern_ops, по индексу на колонку
+-- (Postgres объединяет их через BitmapOr).
+
+alter table telegram_users
+    add column if not exists first_name_lower text
+    generated always as (lower(first_name)) stored;
+
+alter table telegram_users
+    add column if not exists last_name_lower text
+    generated always as (lower(last_name)) stored;
+
+-- username_lower с префиксным индексом уже есть (migrations/001)
+create index if not exists telegram_users_first_name_lower_prefix_idx
+    on telegram_users (first_name_lower text_pattern_ops);
+
+create index if not exists telegram_users_last_name_lower_prefix_idx
+    on telegram_users (last_name_lower text_pattern_ops);
+
+-- Новые колонки — в конец view (create or replace не меняет порядок старых)
+create or replace view user_accounts as
+select u.id,
+       u.username,
+       u.username_lower,
+       u.first_name,
+       u.last_name,
+       u.balance + coalesce(p.pending, 0) as balance,
+       u.created_at,
+       u.updated_at,
+       u.first_name_lower,
+       u.last_name_lower
+  from telegram_users u
+  left join lateral (
+        select sum(l.delta)::integer as pending
+          from token_ledger l
+         where l.user_id = u.id
+           and not l.compacted
+  ) p on true;
@@ -0,0 +1,88 @@
+-- Идемпотентное проведение генерации (core/balance.py settle_generation).
+--
+-- Процесс может упасть между логом/списанием и удалением записи
+-- inflight_predictions, а старый экземпляр при деплое — ещё проводить ту же
+-- генерацию, пока новый её восстанавливает. Тогда recover() проводил бы её
+-- второй раз: второй лог и второе списание. Теперь ключ проведения — id
+-- записи журнала: он пишется в generations и token_ledger с уникальностью,
+-- как payment_charge_id у покупок. Повтор лога возвращает уже записанную
+-- строку, повтор списания — статус duplicate (уже проведено).
+
+alter table generations add column if not exists inflight_id bigint;
+create unique index if not exists generations_inflight_id_key on generations (inflight_id);
+
+alter table token_ledger add column if not exists inflight_id bigint;
+create unique index if not exists token_ledger_inflight_id_key on token_ledger (inflight_id);
+
+-- ledger_append из migrations/010: пишет inflight_id, duplicate — по любому
+-- уникальному ключу (payment_charge_id или inflight_id)
+create or replace function ledger_append(entries jsonb)
+returns table (status text, account jsonb)
+language plpgsql
+as $$
+declare
+    item            jsonb;
+    uid             bigint;
+    mode            text;
+    amount          integer;
+    current_balance integer;
+    inserted        integer;
+begin
+    for uid in
+        select distinct (e ->> 'user_id')::bigint
+          from jsonb_array_elements(entries) e
+         order by 1
+    loop
+        perform pg_advisory_xact_lock(uid);
+    end loop;
+
+    for item in
+        select t.value
+          from jsonb_array_elements(entries) with ordinality as t (value, n)
+         order by t.n
+    loop
+        uid := (item ->> 'user_id')::bigint;
+
+        perform 1 from telegram_users u where u.id = uid;
+        if not found then
+            status := 'no_user';
+            account := null;
+            return next;
+            continue;
+        end if;
+
+        select a.balance into current_balance from user_accounts a where a.id = uid;
+        mode := coalesce(item ->> 'mode', 'add');
+        amount := (item ->> 'delta')::integer;
+        if mode = 'set' then
+            amount := amount - current_balance;
+        elsif mode = 'clamp' then
+            amount := greatest(amount, -current_balance);
+        elsif mode = 'debit' and current_balance + amount < 0 then
+            status := 'insufficient';
+            select to_jsonb(a) into account from user_accounts a where a.id = uid;
+            return next;
+            continue;
+        end if;
+
+        insert into token_ledger (
+            user_id, delta, reason, payment_charge_id, generation_id, admin_action_id, inflight_id
+        )
+        values (
+            uid,
+            amount,
+            item ->> 'reason',
+            item ->> 'payment_charge_id',
+            (item ->> 'generation_id')::bigint,
+            (item ->> 'admin_action_id')::bigint,
+            (item ->> 'inflight_id')::bigint
+        )
+        on conflict do nothing;
+        get diagnostics inserted = row_count;
+
+        status := case when inserted = 1 then 'ok' else 'duplicate' end;
+        select to_jsonb(a) into account from user_accounts a where a.id = uid;
+        return next;
+    end loop;
+end;
+$$;
@@ -0,0 +1,19 @@
+-- Прогрев моделей (core/keepwarm.py).
+--
+-- keepwarm_spend — потраченное на прогрев за день (UTC). Раньше сумма жила
+-- только в памяти, и после рестарта дневной бюджет начинался заново.
+-- Планировщик перезаписывает строку текущего дня после каждого прогрева
+-- и читает её при старте и смене дня.
+--
+-- Индекс по (model, created_at) — для последней генерации модели: планировщик
+-- работает в одном воркере кластера и о чужих запусках узнаёт из generations.
+
+create table if not exists keepwarm_spend (
+    day        date             not null primary key,
+    spent_usd  double precision not null default 0,
+    warmups    integer          not null default 0,
+    updated_at timestamptz      not null default now()
+);
+
+create index if not exists generations_model_created_at_idx
+    on generations (model, created_at desc);
@@ -0,0 +1,26 @@
+-- Массовое начисление ссылается на admin_actions.
+--
+-- Раньше строки admin_actions писались только после всех пачек: если
+-- начисление падало посреди, применённые пачки оставались без следа, а записи
+-- bulk_grant в token_ledger не ссылались ни на какое действие. Теперь /bulk_grant
+-- сначала пишет одно действие bulk_grant, и его id получают все записи журнала.
+
+drop function if exists bulk_add_tokens(bigint[], integer);
+
+create function bulk_add_tokens(user_ids bigint[], amount integer, admin_action_id bigint default null)
+returns table (id bigint, balance integer)
+language plpgsql
+as $$
+#variable_conflict use_column
+begin
+    insert into token_ledger (user_id, delta, reason, admin_action_id)
+    select u.id, amount, 'bulk_grant', bulk_add_tokens.admin_action_id
+      from telegram_users u
+     where u.id = any(user_ids);
+
+    return query
+        select a.id, a.balance
+          from user_accounts a
+         where a.id = any(user_ids);
+end;
+$$;
@@ -0,0 +1,11 @@
+-- Телеметрия неудавшихся и отменённых предсказаний (core/telemetry.py).
+--
+-- Раньше в model_telemetry попадали только успешные предсказания, хотя
+-- Replicate считает и упавшие, и отменённые. status — succeeded / failed /
+-- canceled — входит в ключ строки; старые строки — succeeded.
+
+alter table model_telemetry
+    add column if not exists status text not null default 'succeeded';
+
+alter table model_telemetry drop constraint if exists model_telemetry_pkey;
+alter table model_telemetry add primary key (day, worker, model, combo, status);
@@ -0,0 +1,9 @@
+-- Последний отзыв токенов плагина (core/api_tokens.py).
+--
+-- API работает в одном воркере кластера, а /ps_revoke — в воркере
+-- пользователя. Кэш проверенных токенов раз в несколько секунд сверяет
+-- самый свежий revoked_at и после нового отзыва сбрасывается.
+
+create index if not exists api_tokens_revoked_at_idx
+    on api_tokens (revoked_at desc)
+    where revoked_at is not null;
@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+# config читает окружение при импорте — задаём до него
+_tmp = tempfile.mkdtemp(prefix="nano_bot_tests_")
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:test")
+os.environ.setdefault("REPLICATE_API_TOKEN", "test")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_tmp, "tests.sqlite3")
+os.environ["STATE_DIR"] = _tmp
+os.environ.setdefault("API_TOKEN_SECRET", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+from core.sqlite_storage import SQLiteStorage  # noqa: E402
+from core.storage import close_storage, set_storage  # noqa: E402
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """Свежая SQLite-база на тест, подставленная как хранилище процесса."""
+    db = SQLiteStorage(str(tmp_path / "bot.sqlite3"))
+    set_storage(db)
+    yield db
+    asyncio.run(close_storage())
+
+
+@pytest.fixture
+def run():
+    """Запускает корутину теста в собственном цикле событий."""
+    return asyncio.run
+
+
+@pytest.fixture
+def new_user(storage):
+    """new_user(id, balance=0) — корутина, заводящая пользователя в тестовой базе."""
+    async def create(user_id: int, balance: int = 0):
+        return await storage.insert_user({"id": user_id, "username": f"user{user_id}", "balance": balance})
+    return create
@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+from admin import handlers
+from core import balance
+
+
+class FakeMessage:
+    def __init__(self):
+        self.texts = []
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+def test_interrupted_bulk_grant_is_traceable(storage, new_user, run, monkeypatch):
+    """Вторая пачка упала: первая уже применена и ссылается на действие bulk_grant."""
+    bulk_add_tokens = storage.bulk_add_tokens
+    calls = []
+
+    async def failing_second_batch(user_ids, amount, admin_action_id=None):
+        calls.append(len(user_ids))
+        if len(calls) == 2:
+            raise RuntimeError("connection reset")
+        return await bulk_add_tokens(user_ids, amount, admin_action_id)
+
+    monkeypatch.setattr(storage, "bulk_add_tokens", failing_second_batch)
+    message = FakeMessage()
+    # две пачки: 80 — в первой, 81 — во второй
+    user_ids = [80, *range(1000, 1000 + balance.BULK_BATCH_SIZE - 1), 81]
+    context = SimpleNamespace(
+        user_data={handlers.BULK_GRANT_KEY: {"user_ids": user_ids, "amount": 10, "source": "test"}},
+    )
+
+    async def scenario():
+        await new_user(80)
+        await new_user(81)
+        await handlers._run_bulk_grant(SimpleNamespace(message=message), context, admin_id=1)
+        actions = await storage._run(lambda conn: storage._rows(conn.execute(
+            "select id, action, target_user_id, amount from admin_actions"
+        )))
+        ledger = await storage._run(lambda conn: storage._rows(conn.execute(
+            "select user_id, admin_action_id from token_ledger where reason = 'bulk_grant'"
+        )))
+        return actions, ledger, await balance.get_balance(80), await balance.get_balance(81)
+
+    actions, ledger, granted, skipped = run(scenario())
+    assert calls == [balance.BULK_BATCH_SIZE, 1]
+    assert [(a["action"], a["target_user_id"], a["amount"]) for a in actions] == [("bulk_grant", None, 10)]
+    assert ledger == [{"user_id": 80, "admin_action_id": actions[0]["id"]}]
+    assert (granted, skipped) == (10, 0)
+    assert f"admin_action_id={actions[0]['id']}" in message.texts[-1]
@@ -0,0 +1,62 @@
+import pytest
+
+from core import api_tokens
+
+
+@pytest.fixture(autouse=True)
+def clean_cache(monkeypatch):
+    """Кэш проверок — модульный: у каждого теста свой."""
+    monkeypatch.setattr(api_tokens, "_verified", api_tokens.TTLCache(maxsize=100, ttl=api_tokens.POSITIVE_TTL))
+    monkeypatch.setattr(api_tokens, "_cached_hashes", {})
+    monkeypatch.setattr(api_tokens, "_last_revocation", None)
+    monkeypatch.setattr(api_tokens, "_revocations_checked_at", -api_tokens.REVOCATION_POLL)
+
+
+def test_token_is_stored_hashed(storage, run):
+    async def scenario():
+        token = await api_tokens.create_api_token_for_user(90)
+        rows = await storage.find_api_tokens(api_tokens.token_lookup_prefix(token))
+        return token, rows, await api_tokens.verify_api_token(token), await api_tokens.verify_api_token(token + "x")
+
+    token, rows, owner, forged = run(scenario())
+    assert token.startswith(api_tokens.TOKEN_PREFIX)
+    assert len(rows) == 1 and rows[0]["token_hash"] == api_tokens._hash_token(token) != token
+    assert (owner, forged) == (90, None)
+
+
+def test_legacy_plaintext_token_is_upgraded(storage, run):
+    token = "ps_legacyplaintexttoken000000000"
+
+    async def scenario():
+        await storage.insert_api_token({"user_id": 91, "token": token, "scope": "photoshop"})
+        owner = await api_tokens.verify_api_token(token)
+        rows = await storage._run(lambda conn: storage._rows(conn.execute(
+            "select token, token_hash, token_prefix from api_tokens where user_id = 91"
+        )))
+        api_tokens._verified.clear()
+        return owner, rows[0], await api_tokens.verify_api_token(token)
+
+    owner, row, again = run(scenario())
+    assert owner == again == 91
+    assert row == {
+        "token": None,
+        "token_hash": api_tokens._hash_token(token),
+        "token_prefix": api_tokens.token_lookup_prefix(token),
+    }
+
+
+def test_revocation_in_other_worker_drops_cached_token(storage, run, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(api_tokens.time, "monotonic", lambda: now[0])
+
+    async def scenario():
+        token = await api_tokens.create_api_token_for_user(92)
+        first = await api_tokens.verify_api_token(token)
+        await api_tokens.verify_api_token(token)  # попадание в кэш: первая сверка отзывов
+        # /ps_revoke в другом воркере: пишет в хранилище, кэш этого процесса не трогает
+        await storage.revoke_api_tokens(92)
+        cached = await api_tokens.verify_api_token(token)
+        now[0] += api_tokens.REVOCATION_POLL
+        return first, cached, await api_tokens.verify_api_token(token)
+
+    assert run(scenario()) == (92, 92, None)
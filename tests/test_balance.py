@@ -0,0 +1,59 @@
+import asyncio
+
+from core import balance
+from core.batch import reserve_batch, _batches_in_progress
+
+
+def test_concurrent_debits_do_not_overdraw(storage, new_user, run):
+    async def scenario():
+        await new_user(40, balance=100)
+        return await asyncio.gather(*(
+            balance.deduct_tokens(40, {}, override_cost=30) for _ in range(5)
+        ))
+
+    results = run(scenario())
+    assert sorted(ok for ok, _, _ in results) == [False, False, True, True, True]
+    assert run(balance.get_balance(40)) == 10
+    # отказ сообщает баланс на момент проверки
+    assert all(left == 10 for ok, _, left in results if not ok)
+
+
+def test_deduct_unknown_user(storage, run):
+    assert run(balance.deduct_tokens(41, {}, override_cost=10)) == (False, 10, 0)
+
+
+def test_set_balance_applies_to_pending_entries(storage, new_user, run):
+    async def scenario():
+        await new_user(42, balance=10)
+        # начисление и обнуление в одной пачке: обнуление видит начисление
+        await asyncio.gather(
+            balance.add_tokens(42, 500, reason="purchase", payment_charge_id="charge-42"),
+            balance.set_balance(42, 0),
+        )
+        return await balance.get_balance(42)
+
+    assert run(scenario()) == 0
+
+
+def test_change_balance_does_not_go_negative(storage, new_user, run):
+    async def scenario():
+        await new_user(43, balance=25)
+        first, second = await asyncio.gather(
+            balance.change_balance(43, -20), balance.change_balance(43, -20)
+        )
+        return first["balance"], second["balance"]
+
+    assert run(scenario()) == (5, 0)
+
+
+def test_batch_reserve_insufficient(storage, new_user, run):
+    async def scenario():
+        await new_user(44, balance=50)
+        refused = await reserve_batch(44, 44, 60)
+        journal = await storage.fetch_inflight(0)
+        balance_after, _ = await reserve_batch(44, 44, 50)
+        return refused, journal, balance_after
+
+    assert run(scenario()) == (None, [], 0)
+    assert 44 in _batches_in_progress
+    _batches_in_progress.discard(44)
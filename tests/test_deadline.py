@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from core import deadline, inflight
+from core.balance import get_balance, settle_generation
+
+SETTINGS = {"model": "banana", "output_format": "png"}
+
+
+def test_run_to_completion_outlives_deadline(run):
+    async def handler():
+        async def committed():
+            await asyncio.sleep(0.1)
+            return "delivered"
+        return await deadline.run_to_completion(committed())
+
+    assert run(deadline.run_with_deadline(0.02, handler())) == "delivered"
+
+
+def test_run_to_completion_propagates_errors(run):
+    async def failing():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        run(deadline.run_with_deadline(1.0, deadline.run_to_completion(failing())))
+
+
+def test_deadline_during_settle_is_not_a_failure(storage, new_user, run):
+    during_settle = []
+
+    async def scenario():
+        await new_user(90, balance=200)
+
+        async def handler():
+            async with inflight.track(90, 90, "cat", SETTINGS, 50):
+                async def finish():
+                    await asyncio.sleep(0.1)  # бюджет апдейта истекает здесь
+                    during_settle.append(await storage.fetch_inflight(0))
+                    return await settle_generation(90, "cat", "https://x/cat.png", SETTINGS, 50)
+                return await deadline.run_to_completion(finish())
+
+        result = await deadline.run_with_deadline(0.02, handler())
+        return result, await storage.fetch_inflight(0), await get_balance(90)
+
+    result, left, balance_after = run(scenario())
+    assert result == (50, 150)
+    assert [len(entries) for entries in during_settle] == [1]  # запись жива до проведения
+    assert left == [] and balance_after == 150
+
+
+def test_deadline_before_settle_closes_entry(storage, new_user, run):
+    async def scenario():
+        await new_user(91, balance=200)
+
+        async def handler():
+            async with inflight.track(91, 91, "cat", SETTINGS, 50):
+                await asyncio.sleep(1)  # ожидание Replicate
+
+        with pytest.raises(deadline.DeadlineExceeded):
+            await deadline.run_with_deadline(0.02, handler())
+        return await storage.fetch_inflight(0), await get_balance(91)
+
+    assert run(scenario()) == ([], 200)
@@ -0,0 +1,50 @@
+from telegram import Message, Update, User
+from telegram.ext import ExtBot
+
+from main import build_application
+from utils import logging_config
+
+ADMIN_ID = 1  # ADMIN_IDS из conftest
+
+
+def _text_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Admin"},
+            "text": text,
+        },
+    }
+
+
+def test_admin_search_text_dispatches(storage, new_user, run, monkeypatch):
+    replies = []
+
+    async def reply_text(self, text, *args, **kwargs):
+        replies.append((text, logging_config._user_id.get()))
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=999, is_bot=True, first_name="Bot", username="nano_test_bot")
+        return self._bot_user
+
+    monkeypatch.setattr(Message, "reply_text", reply_text)
+    monkeypatch.setattr(ExtBot, "get_me", get_me)
+    application = build_application(background_jobs=False)
+
+    async def scenario():
+        await new_user(70)
+        application.user_data[ADMIN_ID]["admin_search_mode"] = True
+        update = Update.de_json(_text_update(100, ADMIN_ID, "user70"), application.bot)
+        await application.initialize()
+        try:
+            await application.process_update(update)
+        finally:
+            await application.shutdown()
+
+    run(scenario())
+    # поиск ответил (и не ушёл в генерацию), контекст логов привязан
+    assert replies == [("Найдено пользователей: 1 (запрос: user70)", ADMIN_ID)]
+    assert application.user_data[ADMIN_ID]["admin_search_mode"] is False
@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+
+import pytest
+
+from config import MODEL_INFO
+from core import deadline, generators, inflight
+from core.telemetry import telemetry
+
+SLOW_MODEL = MODEL_INFO["banana"]["replicate"]
+
+
+class FakePrediction:
+    def __init__(self, prediction_id, model, client):
+        self.id = prediction_id
+        self.model = model
+        self.status = "starting"
+        self.output = None
+        self.error = None
+        self._client = client
+
+    async def async_wait(self):
+        if self.model == SLOW_MODEL:
+            await asyncio.sleep(60)
+        self.status = "succeeded"
+        self.output = f"https://replicate.example/{self.id}.png"
+
+
+class FakeReplicate:
+    """Клиент Replicate: banana отвечает «никогда», остальные модели — сразу."""
+
+    def __init__(self):
+        self.created = []
+        self.cancelled = []
+        self._ids = itertools.count(1)
+        self.models = self
+        self.predictions = self
+
+    async def async_create(self, model=None, version=None, input=None):
+        prediction = FakePrediction(f"pred-{next(self._ids)}", model or version, self)
+        self.created.append(prediction)
+        return prediction
+
+    async def async_cancel(self, prediction_id):
+        self.cancelled.append(prediction_id)
+
+
+@pytest.fixture
+def replicate(monkeypatch):
+    client = FakeReplicate()
+    monkeypatch.setattr(generators, "_replicate_client", client)
+    monkeypatch.setattr(telemetry, "record", lambda *args, **kwargs: None)
+    return client
+
+
+def test_fallback_cancels_abandoned_prediction(replicate, run, monkeypatch):
+    monkeypatch.setitem(MODEL_INFO["banana"]["routing"], "fail_after", 0.05)
+    route = {}
+
+    image_url = run(generators.run_model("cat", {"model": "banana"}, route=route))
+
+    slow, fallback = replicate.created
+    assert replicate.cancelled == [slow.id]
+    assert image_url == f"https://replicate.example/{fallback.id}.png"
+    assert route["model"] == "banana_pro" and route["decision"] == "fallback"
+
+
+def test_deadline_cancels_prediction(replicate, run):
+    with pytest.raises(deadline.DeadlineExceeded):
+        run(deadline.run_with_deadline(0.05, generators.run_model("cat", {"model": "banana"})))
+
+    assert replicate.cancelled == [replicate.created[0].id]
+
+
+def test_shutdown_keeps_journaled_prediction(storage, new_user, replicate, run):
+    async def scenario():
+        await new_user(80, balance=100)
+
+        async def generation():
+            async with inflight.track(80, 80, "cat", {"model": "banana"}, 50):
+                await generators.run_model("cat", {"model": "banana"})
+
+        task = asyncio.create_task(generation())
+        await asyncio.sleep(0.05)
+        task.cancel()  # остановка процесса: дедлайна нет
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await storage.fetch_inflight(0)
+
+    entries = run(scenario())
+    assert replicate.cancelled == []
+    assert [entry["prediction_id"] for entry in entries] == [replicate.created[0].id]
+
+
+def test_completed_prediction_is_not_cancelled(replicate, run):
+    image_url = run(generators.run_model("cat", {"model": "banana_pro"}))
+
+    assert image_url.endswith(".png")
+    assert replicate.cancelled == []
+
+
+def test_failed_and_abandoned_predictions_are_recorded(replicate, run, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        telemetry, "record",
+        lambda model_key, payload, prediction, total_s, url, status="succeeded": recorded.append(
+            (model_key, status)
+        ),
+    )
+    monkeypatch.setitem(MODEL_INFO["banana"]["routing"], "fail_after", 0.05)
+
+    run(generators.run_model("cat", {"model": "banana"}))
+    assert recorded == [("banana", "canceled"), ("banana_pro", "succeeded")]
+
+    async def fail(self):
+        self.status = "failed"
+
+    monkeypatch.setattr(FakePrediction, "async_wait", fail)
+    recorded.clear()
+    with pytest.raises(Exception):
+        run(generators.run_model("cat", {"model": "banana_pro"}))
+    assert recorded[0] == ("banana_pro", "failed")
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from core import balance, delivery, generators, inflight
+from core.batch import _batches_in_progress, refund_reservation, reserve_batch
+from core.outbound import outbound
+
+SETTINGS = {"model": "banana", "output_format": "png"}
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+@pytest.fixture
+def replicate(monkeypatch):
+    """Подменяет Replicate, доставку и очередь отправки; возвращает список доставленного."""
+    delivered = []
+
+    async def resume_prediction(prediction_id, timeout):
+        return f"https://replicate.example/{prediction_id}.png"
+
+    async def deliver_image_to_chat(bot, chat_id, image_url, output_format="png"):
+        delivered.append((chat_id, image_url))
+
+    async def send(chat_id, factory, **kwargs):
+        return await factory()
+
+    monkeypatch.setattr(generators, "resume_prediction", resume_prediction)
+    monkeypatch.setattr(delivery, "deliver_image_to_chat", deliver_image_to_chat)
+    monkeypatch.setattr(outbound, "send", send)
+    return delivered
+
+
+async def _crash_during_generation(user_id, prompt, prediction_id=None):
+    """Генерация под track(), прерванная остановкой процесса (отмена без дедлайна)."""
+    with pytest.raises(asyncio.CancelledError):
+        async with inflight.track(user_id, user_id, prompt, SETTINGS, 50):
+            if prediction_id:
+                await inflight.dispatched("banana", prediction_id)
+            raise asyncio.CancelledError()
+
+
+def test_recover_settles_and_delivers(storage, new_user, replicate, run):
+    bot = FakeBot()
+
+    async def scenario():
+        await new_user(60, balance=200)
+        await _crash_during_generation(60, "cat", prediction_id="pred-60")
+        kept = await storage.fetch_inflight(0)
+        await inflight.recover(bot)
+        return kept, await storage.fetch_inflight(0), await balance.get_balance(60)
+
+    kept, left, balance_after = run(scenario())
+    assert [(r["prompt"], r["prediction_id"]) for r in kept] == [("cat", "pred-60")]
+    assert left == []
+    assert balance_after == 150
+    assert replicate == [(60, "https://replicate.example/pred-60.png")]
+    assert bot.messages[0][0] == 60 and "Списано 50 токенов" in bot.messages[0][1]
+
+
+def test_recover_without_prediction_does_not_charge(storage, new_user, replicate, run):
+    bot = FakeBot()
+
+    async def scenario():
+        await new_user(61, balance=200)
+        await _crash_during_generation(61, "dog")
+        await inflight.recover(bot)
+        return await storage.fetch_inflight(0), await balance.get_balance(61)
+
+    assert run(scenario()) == ([], 200)
+    assert replicate == []
+    assert bot.messages == [(61, inflight.NOT_RECOVERED_TEXT)]
+
+
+def test_failed_generation_closes_entry(storage, new_user, run):
+    async def scenario():
+        await new_user(62, balance=200)
+        with pytest.raises(ValueError):
+            async with inflight.track(62, 62, "bad", SETTINGS, 50):
+                raise ValueError("boom")
+        return await storage.fetch_inflight(0)
+
+    assert run(scenario()) == []
+
+
+def test_repeated_recovery_settles_once(storage, new_user, replicate, run, monkeypatch):
+    """Падение между проведением и закрытием записи: повторный recover() не списывает второй раз."""
+    bot = FakeBot()
+
+    async def scenario():
+        await new_user(63, balance=200)
+        await _crash_during_generation(63, "owl", prediction_id="pred-63")
+
+        delete_inflight = storage.delete_inflight
+
+        async def crash(entry_id):
+            raise RuntimeError("process died")
+
+        monkeypatch.setattr(storage, "delete_inflight", crash)
+        await inflight.recover(bot)
+        kept = await storage.fetch_inflight(0)
+
+        monkeypatch.setattr(storage, "delete_inflight", delete_inflight)
+        await inflight.recover(bot)
+        generations = await storage.fetch_generations(63, limit=10)
+        return kept, await storage.fetch_inflight(0), generations, await balance.get_balance(63)
+
+    kept, left, generations, balance_after = run(scenario())
+    assert len(kept) == 1 and left == []
+    assert len(generations) == 1
+    assert balance_after == 150
+
+
+def test_recover_refunds_interrupted_batch(storage, new_user, replicate, run):
+    """Пакет прервался после первого альбома: recover() возвращает непроведённый остаток резерва."""
+    bot = FakeBot()
+
+    async def scenario():
+        await new_user(64, balance=200)
+        _, entry_id = await reserve_batch(64, 64, 100)
+        await inflight.reservation_left(entry_id, 70)
+        _batches_in_progress.discard(64)  # процесс упал посреди пакета
+
+        await inflight.recover(bot)
+        return await storage.fetch_inflight(0), await balance.get_balance(64)
+
+    assert run(scenario()) == ([], 170)
+    assert bot.messages == [(64, inflight.BATCH_REFUNDED_TEXT.format(refund=70, balance=170))]
+
+
+def test_batch_refund_is_idempotent(storage, new_user, run):
+    async def scenario():
+        await new_user(65, balance=100)
+        _, entry_id = await reserve_batch(65, 65, 100)
+        _batches_in_progress.discard(65)
+        await refund_reservation(65, entry_id, 40)
+        await refund_reservation(65, entry_id, 40)
+        return await balance.get_balance(65)
+
+    assert run(scenario()) == 40
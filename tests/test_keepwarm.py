@@ -0,0 +1,45 @@
+import pytest
+
+from config import MODEL_INFO
+from core import keepwarm as keepwarm_module, resilience
+from core.keepwarm import KeepWarm
+
+MODELS = {"remove_bg": {**MODEL_INFO["remove_bg"], "keepwarm": {"idle_after": 240, "cost_usd": 0.3}}}
+
+
+@pytest.fixture
+def warmups(monkeypatch):
+    """Прогрев без Replicate, всегда в активные часы; возвращает список прогретых моделей."""
+    calls = []
+
+    async def call(name, attempt, **kwargs):
+        calls.append(name)
+
+    monkeypatch.setattr(resilience, "call", call)
+    monkeypatch.setattr(KeepWarm, "_in_active_hours", staticmethod(lambda: True))
+    monkeypatch.setattr(keepwarm_module, "KEEPWARM_DAILY_BUDGET_USD", 0.5)
+    return calls
+
+
+def test_daily_spend_survives_restart(storage, warmups, run):
+    async def scenario():
+        first = KeepWarm(MODELS)
+        await first.tick()
+        # рестарт: новый планировщик читает расход дня, второй прогрев не влезает в бюджет
+        second = KeepWarm(MODELS)
+        await second.tick()
+        return first.spent_today_usd, second.spent_today_usd
+
+    assert run(scenario()) == (0.3, 0.3)
+    assert len(warmups) == 1
+
+
+def test_recent_run_in_other_worker_skips_warmup(storage, new_user, warmups, run):
+    async def scenario():
+        await new_user(70)
+        # генерацию записал другой воркер — этот планировщик её не видел
+        await storage.log_generation(70, "cat", "https://example.com/c.png", {"model": "remove_bg"}, 0)
+        await KeepWarm(MODELS).tick()
+
+    run(scenario())
+    assert warmups == []
@@ -0,0 +1,121 @@
+import asyncio
+
+from core.ledger import LedgerWriter
+
+
+def test_concurrent_appends_share_one_batch(storage, new_user, run):
+    calls = []
+    original = storage.ledger_append
+
+    async def counting(entries):
+        calls.append(len(entries))
+        return await original(entries)
+
+    storage.ledger_append = counting
+
+    async def scenario():
+        await new_user(10, balance=100)
+        await new_user(11, balance=0)
+        writer = LedgerWriter(flush_delay=0.01)
+        return await asyncio.gather(
+            writer.append(10, -30, "generation"),
+            writer.append(11, 50, "purchase", payment_charge_id="charge-1"),
+            writer.append(10, 5, "admin"),
+        )
+
+    first, second, third = run(scenario())
+    assert calls == [3]
+    assert second["id"] == 11 and second["balance"] == 50
+    # строка пользователя — состояние после записи вызывающего
+    assert first["balance"] == 70
+    assert third["balance"] == 75
+
+
+def test_unknown_user_does_not_fail_batch(storage, new_user, run):
+    async def scenario():
+        await new_user(20)
+        await new_user(21, balance=40)
+        writer = LedgerWriter(flush_delay=0.01)
+        results = await asyncio.gather(
+            writer.append(20, 500, "purchase", payment_charge_id="charge-2"),
+            writer.append(999, 100, "admin"),
+            writer.append(21, -10, "generation"),
+        )
+        return results, await storage.get_user(20), await storage.get_user(21)
+
+    (bought, unknown, spent), user20, user21 = run(scenario())
+    assert unknown is None
+    assert bought["balance"] == 500 and user20["balance"] == 500
+    assert spent["balance"] == 30 and user21["balance"] == 30
+
+
+def test_flush_on_max_batch(storage, new_user, run):
+    async def scenario():
+        await new_user(30)
+        writer = LedgerWriter(flush_delay=60, max_batch=2)
+        return await asyncio.wait_for(
+            asyncio.gather(writer.append(30, 1, "admin"), writer.append(30, 1, "admin")),
+            timeout=5,
+        )
+
+    _, last = run(scenario())
+    assert last["balance"] == 2
+
+
+def test_compaction_keeps_user_accounts_balance(storage, new_user, run):
+    def snapshot(conn):
+        row = conn.execute("select balance from telegram_users where id = 50").fetchone()
+        pending = conn.execute(
+            "select count(*) from token_ledger where user_id = 50 and not compacted"
+        ).fetchone()
+        return row[0], pending[0]
+
+    async def scenario():
+        await new_user(50, balance=10)
+        await storage.ledger_append([
+            {"user_id": 50, "delta": 100, "reason": "purchase"},
+            {"user_id": 50, "delta": -30, "reason": "generation"},
+        ])
+        before = await storage._run(snapshot)
+        compacted = await storage.compact_ledger()
+        after = await storage._run(snapshot)
+        balance_after = (await storage.get_user(50))["balance"]
+        await storage.ledger_append([{"user_id": 50, "delta": -5, "reason": "generation"}])
+        again = await storage.compact_ledger()
+        return before, compacted, after, balance_after, again, await storage._run(snapshot)
+
+    before, compacted, after, balance_after, again, final = run(scenario())
+    assert before == (10, 2)
+    assert compacted == 1
+    assert after == (80, 0)
+    assert balance_after == 80
+    assert again == 1 and final == (75, 0)
+
+
+def test_compaction_without_pending_entries(storage, new_user, run):
+    async def scenario():
+        await new_user(51, balance=10)
+        return await storage.compact_ledger(), (await storage.get_user(51))["balance"]
+
+    assert run(scenario()) == (0, 10)
+
+
+def test_payment_charge_id_is_idempotent(storage, new_user, run):
+    from core.balance import add_tokens
+
+    async def scenario():
+        await new_user(52)
+        # повтор в той же пачке и в следующей
+        first, second = await asyncio.gather(
+            add_tokens(52, 300, reason="purchase", payment_charge_id="charge-52"),
+            add_tokens(52, 300, reason="purchase", payment_charge_id="charge-52"),
+        )
+        third = await add_tokens(52, 300, reason="purchase", payment_charge_id="charge-52")
+        today = (await storage.get_user(52))["created_at"][:10]
+        usage = await storage.fetch_usage_days(today)
+        return first, second, third, usage
+
+    first, second, third, usage = run(scenario())
+    assert (first, second, third) == (300, 300, 300)
+    total = [r for r in usage if r["model"] == ""]
+    assert total[0]["purchases"] == 1 and total[0]["tokens_purchased"] == 300
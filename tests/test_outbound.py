@@ -0,0 +1,79 @@
+import asyncio
+
+from core.outbound import OutboundQueue
+
+
+async def _never():
+    await asyncio.Event().wait()
+
+
+async def _instant():
+    return "sent"
+
+
+def test_stop_cancels_queued_sends(run):
+    async def scenario():
+        queue = OutboundQueue(workers=1)
+        await queue.start()
+
+        # единственный воркер занят — остальные отправки ждут в очереди
+        first = asyncio.ensure_future(queue.send(1, _never))
+        await asyncio.sleep(0)
+        waiting = [asyncio.ensure_future(queue.send(2, _instant)) for _ in range(6)]
+        await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(queue.stop(), timeout=1)
+        results = await asyncio.wait_for(
+            asyncio.gather(first, *waiting, return_exceptions=True), timeout=1
+        )
+        return results, queue.metrics()
+
+    results, metrics = run(scenario())
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert metrics["depth"] == 0 and metrics["deferred"] == 0
+
+
+def test_stop_cancels_deferred_sends(run):
+    async def scenario():
+        queue = OutboundQueue(workers=1)
+        await queue.start()
+        # всплеск личного чата — 3, остальные откладываются по лимиту чата
+        sends = [asyncio.ensure_future(queue.send(2, _instant)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        deferred = queue.metrics()["deferred"]
+
+        await asyncio.wait_for(queue.stop(), timeout=1)
+        results = await asyncio.wait_for(asyncio.gather(*sends, return_exceptions=True), timeout=1)
+        return deferred, results
+
+    deferred, results = run(scenario())
+    assert deferred == 2
+    assert results[:3] == ["sent"] * 3
+    assert all(isinstance(result, asyncio.CancelledError) for result in results[3:])
+
+
+def test_send_after_stop_goes_direct(run):
+    async def scenario():
+        queue = OutboundQueue(workers=1)
+        await queue.start()
+        await queue.stop()
+
+        return await queue.send(1, _instant)
+
+    assert run(scenario()) == "sent"
+
+
+def test_deferred_send_is_delivered(run):
+    async def scenario():
+        queue = OutboundQueue(workers=2)
+        await queue.start()
+
+        try:
+            # всплеск личного чата — 3, четвёртое сообщение ждёт ~1 с
+            return await asyncio.wait_for(
+                asyncio.gather(*(queue.send(3, _instant) for _ in range(4))), timeout=3
+            )
+        finally:
+            await queue.stop()
+
+    assert run(scenario()) == ["sent"] * 4
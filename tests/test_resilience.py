@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from core import resilience
+from core.resilience import CircuitBreaker, CircuitOpenError, Policy, RetryableStatusError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """Зависимость "svc" со своим breaker и политиками без пауз между повторами."""
+    breaker = CircuitBreaker("svc", failure_threshold=2, reset_timeout=10.0)
+    monkeypatch.setitem(resilience.BREAKERS, "svc", breaker)
+    monkeypatch.setitem(resilience.POLICIES, "svc.retry", Policy(timeout=1.0, retries=2))
+    monkeypatch.setitem(resilience.POLICIES, "svc.hedge", Policy(timeout=1.0, hedge_after=0.05))
+    monkeypatch.setattr(resilience, "_backoff", lambda policy, attempt: 0.0)
+    return breaker
+
+
+def test_breaker_opens_probes_and_closes(clock):
+    breaker = CircuitBreaker("t", failure_threshold=2, reset_timeout=10.0)
+    breaker.record_failure()
+    breaker.before_call()  # одного сбоя мало
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # через reset_timeout — одна пробная попытка, параллельные отбиваются
+    clock[0] += 10.0
+    breaker.before_call()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # проба упала — снова open на reset_timeout
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock[0] += 10.0
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+
+def test_open_breaker_skips_call(service, run):
+    calls = []
+
+    async def failing(timeout):
+        calls.append(timeout)
+        raise httpx.ConnectError("refused")
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(httpx.ConnectError):
+                await resilience.call("svc.write", failing, dependency="svc")
+        with pytest.raises(CircuitOpenError):
+            await resilience.call("svc.write", failing, dependency="svc")
+
+    run(scenario())
+    assert len(calls) == 2 and service.state == "open"
+
+
+def test_non_retryable_error_is_not_retried(service, run):
+    calls = []
+
+    async def bad_request(timeout):
+        calls.append(timeout)
+        raise ValueError("400 bad request")
+
+    with pytest.raises(ValueError):
+        run(resilience.call("svc.retry", bad_request, dependency="svc", idempotent=True))
+    # зависимость ответила — она жива, breaker сбой не считает
+    assert len(calls) == 1
+    assert service.state == "closed" and service._failures == 0
+
+
+def test_retryable_error_is_retried_only_when_idempotent(service, run):
+    service.failure_threshold = 5  # повторы не должны упереться в breaker
+    calls = []
+
+    async def flaky(timeout):
+        calls.append(timeout)
+        if len(calls) < 3:
+            raise RetryableStatusError(httpx.Response(503))
+        return "ok"
+
+    assert run(resilience.call("svc.retry", flaky, dependency="svc", idempotent=True)) == "ok"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(RetryableStatusError):
+        run(resilience.call("svc.retry", flaky, dependency="svc"))
+    assert len(calls) == 1
+
+
+def test_hedge_returns_first_success_and_cancels_loser(service, run):
+    started, cancelled = [], []
+
+    async def attempt(timeout):
+        n = len(started)
+        started.append(n)
+        try:
+            # первая попытка «зависла», дублирующая отвечает сразу
+            await asyncio.sleep(10 if n == 0 else 0)
+        except asyncio.CancelledError:
+            cancelled.append(n)
+            raise
+        return f"attempt {n}"
+
+    async def scenario():
+        result = await resilience.call("svc.hedge", attempt, dependency="svc", idempotent=True)
+        await asyncio.sleep(0)  # отмена проигравшей попытки доходит до неё
+        return result
+
+    assert run(scenario()) == "attempt 1"
+    assert started == [0, 1]
+    assert cancelled == [0]
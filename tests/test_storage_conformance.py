@@ -0,0 +1,33 @@
+import os
+import random
+
+import pytest
+
+from core.storage import _create, close_storage, set_storage
+from utils.storage_check import CHECKS, SYNTHETIC_USER_BASE
+
+# Набор utils.storage_check — по тесту на проверку. Supabase — только по явному
+# STORAGE_CHECK_SUPABASE=1 (и SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY):
+# проверки пишут тестовые строки, на боевой базе не запускать.
+SUPABASE_ENABLED = os.getenv("STORAGE_CHECK_SUPABASE") == "1"
+
+checks = pytest.mark.parametrize("func", [func for _, func in CHECKS], ids=[name for name, _ in CHECKS])
+
+
+@checks
+def test_sqlite(storage, run, func):
+    run(func(storage, SYNTHETIC_USER_BASE))
+
+
+@pytest.mark.skipif(not SUPABASE_ENABLED, reason="STORAGE_CHECK_SUPABASE=1 не задан")
+@checks
+def test_supabase(run, func):
+    async def scenario():
+        storage = _create("supabase")
+        set_storage(storage)
+        try:
+            await func(storage, SYNTHETIC_USER_BASE + random.randrange(1_000_000) * 100)
+        finally:
+            await close_storage()
+
+    run(scenario())
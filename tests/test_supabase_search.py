@@ -0,0 +1,35 @@
+import httpx
+import pytest
+
+from core import supabase
+from core.supabase import SupabaseStorage
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    sent = []
+
+    async def supabase_request(method, path, params=None, **kwargs):
+        sent.append(params)
+        return httpx.Response(200, json=[], request=httpx.Request(method, f"http://test/{path}"))
+
+    monkeypatch.setattr(supabase, "supabase_request", supabase_request)
+    return sent
+
+
+@pytest.mark.parametrize("query", ["И", "iv", "Iv"])
+def test_short_query_uses_lowercase_prefix_columns(requests, run, query):
+    run(SupabaseStorage().search_users(query))
+
+    prefix = query.lower()
+    assert requests[0]["or"] == (
+        f"(username_lower.like.{prefix}*,"
+        f"first_name_lower.like.{prefix}*,"
+        f"last_name_lower.like.{prefix}*)"
+    )
+
+
+def test_long_query_uses_trigram_substring(requests, run):
+    run(SupabaseStorage().search_users("Ivan"))
+
+    assert requests[0]["or"] == "(username.ilike.*Ivan*,first_name.ilike.*Ivan*,last_name.ilike.*Ivan*)"
@@ -0,0 +1,88 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from core.telemetry import RELATIVE_ACCURACY, QuantileSketch, Telemetry
+
+PAYLOAD = {"resolution": "2K", "output_format": "png"}
+
+
+def _exact(values, q):
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def _sketch(values):
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def test_sketch_quantiles_within_relative_accuracy():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(2.0, 0.8) for _ in range(20_000)]
+    sketch = _sketch(values)
+
+    for q in (0.0, 0.5, 0.9, 0.95, 0.99, 1.0):
+        exact = _exact(values, q)
+        assert abs(sketch.quantile(q) - exact) <= exact * RELATIVE_ACCURACY
+        assert min(values) <= sketch.quantile(q) <= max(values)
+    assert sketch.count == len(values)
+
+
+def test_sketch_merge_equals_single_sketch():
+    rng = random.Random(11)
+    values = [rng.uniform(0, 120) for _ in range(5_000)] + [0.0] * 10
+    merged = _sketch(values[:2_000])
+    merged.merge(_sketch(values[2_000:]))
+    single = _sketch(values)
+
+    assert merged.bins == single.bins and merged.zeros == single.zeros == 10
+    assert (merged.count, merged.min, merged.max) == (single.count, single.min, single.max)
+    assert merged.total == pytest.approx(single.total)
+    restored = QuantileSketch.from_dict(merged.to_dict())
+    assert [restored.quantile(q) for q in (0.5, 0.99)] == [single.quantile(q) for q in (0.5, 0.99)]
+
+
+def test_empty_sketch_merge_keeps_bounds():
+    sketch = _sketch([3.0, 5.0])
+    sketch.merge(QuantileSketch.from_dict(QuantileSketch().to_dict()))
+    assert (sketch.count, sketch.min, sketch.max) == (2, 3.0, 5.0)
+
+
+def test_persist_waits_for_successful_load(storage, run, monkeypatch):
+    """Сохранённые за день скетчи не затираются, если при старте их не удалось прочитать."""
+    prediction = SimpleNamespace(metrics={}, created_at=None, started_at=None)
+
+    async def scenario():
+        before = Telemetry()
+        for _ in range(100):
+            before.record("banana", PAYLOAD, prediction, 10.0, None)
+        await before.persist()
+
+        # рестарт, хранилище на чтение недоступно
+        after = Telemetry()
+        fetch_telemetry = storage.fetch_telemetry
+
+        async def unavailable(since_day):
+            raise RuntimeError("storage down")
+
+        monkeypatch.setattr(storage, "fetch_telemetry", unavailable)
+        with pytest.raises(RuntimeError):
+            await after.load()
+        after.record("banana", PAYLOAD, prediction, 20.0, None)
+        after.record("banana", PAYLOAD, prediction, 30.0, None, status="failed")
+        with pytest.raises(RuntimeError):
+            await after.persist()
+        unchanged = await fetch_telemetry(after._day)
+
+        monkeypatch.setattr(storage, "fetch_telemetry", fetch_telemetry)
+        await after.persist()
+        return unchanged, await storage.fetch_telemetry(after._day)
+
+    unchanged, rows = run(scenario())
+    assert [QuantileSketch.from_dict(r["sketches"]["total_s"]).count for r in unchanged] == [100]
+    counts = {r["status"]: QuantileSketch.from_dict(r["sketches"]["total_s"]).count for r in rows}
+    assert counts == {"succeeded": 101, "failed": 1}
@@ -0,0 +1,48 @@
+import time
+from types import SimpleNamespace
+
+from core import throttle
+from core.throttle import UserRateLimiter
+
+
+class FakeQuery:
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def test_every_dropped_callback_is_answered(run, monkeypatch):
+    monkeypatch.setattr(throttle, "user_limiter", UserRateLimiter({"callback": (1, 60.0)}))
+    query = FakeQuery()
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=5),
+        pre_checkout_query=None,
+        callback_query=query,
+        effective_message=None,
+    )
+
+    async def scenario():
+        return [await throttle.allow(update, "callback") for _ in range(4)]
+
+    assert run(scenario()) == [True, False, False, False]
+    # первое нажатие прошло в хендлер, остальные три отвечены здесь
+    assert len(query.answers) == 3
+    assert all(text.startswith("🐢") for text in query.answers)
+
+
+def test_bucket_drained_near_expiry_is_not_replaced(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    limiter = UserRateLimiter({"generate": (2, 10.0)})
+
+    assert [limiter.hit("generate", 7) for _ in range(2)] == [0.0, 0.0]
+    # перед истечением TTL ведра: накопился почти один токен — он и расходуется
+    now[0] += 9.9
+    assert limiter.hit("generate", 7) == 0.0
+    assert limiter.hit("generate", 7) > 0
+    # сразу после отметки TTL ведро то же: набежал один токен, а не полный burst
+    now[0] += 0.2
+    assert limiter.hit("generate", 7) == 0.0
+    assert limiter.hit("generate", 7) > 0
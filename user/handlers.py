@@ -1,6 +1,4 @@
-from io import BytesIO
 import logging
-from datetime import datetime, timezone
 
 from telegram import (
     Update,
@@ -18,18 +16,51 @@ from telegram.ext import (
     filters,
 )
 
-from config import MODEL_INFO
+from config import MODEL_INFO, PS_API_BASE_URL
 from core.registry import register_user
 from core.balance import (
     get_balance,
-    deduct_tokens,
     add_tokens,
-    get_generation_cost_tokens,
+    get_effective_cost,
+    settle_generation,
+    FREE_REMOVE_BG_PER_DAY,
 )
 from core.settings import get_user_settings, format_settings_text, build_settings_keyboard
-from core.supabase import fetch_generations, log_generation, count_generations_since
+from core.history import get_history_page, HISTORY_PAGE_SIZE
+from core.export import parse_export_args, send_export, ExportInProgress, ExportTooLarge
 from core.generators import run_model
-from core.api_tokens import create_api_token_for_user
+from core.batch import (
+    BATCH_MAX_FILE_BYTES,
+    BATCH_MAX_PROMPTS,
+    BatchFileError,
+    BatchInProgress,
+    parse_prompt_file,
+    quote_batch,
+    reserve_batch,
+    run_batch,
+)
+from core.api_tokens import (
+    create_api_token_for_user,
+    list_api_tokens,
+    revoke_api_tokens,
+    token_lookup_prefix,
+)
+from core.outbound import outbound
+from core import throttle
+from core.throttle import rate_limited
+from core.delivery import deliver_image, send_original
+from core.references import prepare_reference
+from core.http import DownloadTooLarge
+from core import deadline, inflight
+from core.deadline import (
+    with_deadline,
+    DEADLINE_CALLBACK,
+    DEADLINE_COMMAND,
+    DEADLINE_DELIVERY,
+    DEADLINE_EXPORT,
+    DEADLINE_GENERATION,
+    DEADLINE_PRECHECKOUT,
+)
 from .keyboards import build_reply_keyboard
 
 logger = logging.getLogger(__name__)
@@ -43,8 +74,6 @@ PAYLOAD_PREFIX = "buy_tokens:"
 TOKEN_PACKS = [500, 1000, 1500]
 CUSTOM_TOKENS_KEY = "awaiting_custom_tokens"
 FLUX_INPUT_KEY = "awaiting_flux_input"  # seed / safety / strength
-API_BASE_URL_FOR_PS = "https://nanobot.glebmishin72.workers.dev"
-FREE_REMOVE_BG_PER_DAY = 5
 
 
 def tokens_to_stars(tokens: int) -> int:
@@ -97,12 +126,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     lines.append(
         "\nПополнение токенов через Telegram Stars: /buy\n"
-        "Токен для Photoshop-плагина: /ps_token\n\n"
+        "Токен для Photoshop-плагина: /ps_token (отозвать — /ps_revoke)\n\n"
         "Команды:\n"
         "/menu — настройки генерации\n"
         "/model — выбор модели\n"
         "/balance — баланс токенов\n"
         "/history — последние генерации\n"
+        "/export [csv|jsonl] [zip] — вся история генераций файлом\n\n"
+        f"Пакет: пришлите .txt (промт на строку) или .csv (колонка prompt) — до {BATCH_MAX_PROMPTS} промтов.\n"
+        "Настройки строки в .txt — после « | »: кот | aspect_ratio=16:9, model=banana_pro\n"
     )
 
     await update.message.reply_text("\n".join(lines))
@@ -130,16 +162,13 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text("\n".join(lines))
 
 
-async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await register_user(update.effective_user)
-    user_id = update.effective_user.id
-    gens = await fetch_generations(user_id, limit=5)
-
-    if not gens:
-        await update.message.reply_text("Пока нет сохранённой истории генераций.")
-        return
-
-    lines = ["Ваши последние генерации (до 5):", ""]
+def build_history_view(
+    gens: list, next_cursor: str | None, prev_cursor: str | None
+) -> tuple[str, InlineKeyboardMarkup | None]:
+    if prev_cursor:
+        lines = ["Ваши генерации (более ранние):", ""]
+    else:
+        lines = [f"Ваши последние генерации (до {HISTORY_PAGE_SIZE}):", ""]
     for g in gens:
         prompt = g.get("prompt") or ""
         ts = g.get("created_at") or ""
@@ -152,7 +181,78 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             lines.append(f"  {image_url}")
         lines.append("")
 
-    await update.message.reply_text("\n".join(lines))
+    nav_row = []
+    if prev_cursor:
+        nav_row.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"hist|p|{prev_cursor}"))
+    if next_cursor:
+        nav_row.append(InlineKeyboardButton("Старее ➡️", callback_data=f"hist|n|{next_cursor}"))
+    markup = InlineKeyboardMarkup([nav_row]) if nav_row else None
+
+    return "\n".join(lines), markup
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await register_user(update.effective_user)
+    user_id = update.effective_user.id
+    gens, next_cursor, prev_cursor = await get_history_page(user_id)
+
+    if not gens:
+        await update.message.reply_text("Пока нет сохранённой истории генераций.")
+        return
+
+    text, markup = build_history_view(gens, next_cursor, prev_cursor)
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not query:
+        return
+
+    await query.answer()
+    try:
+        _, direction_flag, cursor = (query.data or "").split("|", 2)
+        gens, next_cursor, prev_cursor = await get_history_page(
+            query.from_user.id, cursor, "prev" if direction_flag == "p" else "next"
+        )
+    except ValueError:
+        return
+
+    if not gens:
+        await query.message.edit_text("Больше генераций нет.")
+        return
+
+    text, markup = build_history_view(gens, next_cursor, prev_cursor)
+    await query.message.edit_text(text, reply_markup=markup)
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await register_user(update.effective_user)
+    user_id = update.effective_user.id
+
+    try:
+        fmt, zipped = parse_export_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "Использование: /export [csv|jsonl] [zip]\n"
+            "Пример: /export jsonl zip"
+        )
+        return
+
+    await update.message.reply_text("⏳ Готовлю файл с историей генераций…")
+    try:
+        total = await send_export(context.bot, update.effective_chat.id, user_id, fmt, zipped)
+    except ExportInProgress:
+        await update.message.reply_text("Выгрузка уже идёт, дождитесь файла.")
+        return
+    except ExportTooLarge:
+        await update.message.reply_text(
+            "Файл получился слишком большим для Telegram. Попробуйте /export csv zip."
+        )
+        return
+
+    if total == 0:
+        await update.message.reply_text("Пока нет сохранённой истории генераций.")
 
 
 async def ps_token_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -166,13 +266,39 @@ async def ps_token_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         "🔑 Токен для Photoshop-плагина Nano Bot:\n\n"
         f"`{token}`\n\n"
         "1. Скопируйте этот токен и вставьте его в настройках плагина в поле *NanoBot Token*.\n"
-        f"2. В поле *API Base URL* укажите:\n`{API_BASE_URL_FOR_PS}`\n\n"
-        "Храните токен как пароль — по нему считается ваш баланс токенов."
+        f"2. В поле *API Base URL* укажите:\n`{PS_API_BASE_URL}`\n\n"
+        "Храните токен как пароль — по нему считается ваш баланс токенов.\n"
+        f"Мы храним только его хеш. Отозвать: `/ps_revoke {token_lookup_prefix(token)}`, "
+        "все токены сразу — /ps\\_revoke."
     )
 
     await update.message.reply_text(text, parse_mode="Markdown")
 
 
+async def ps_revoke_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/ps_revoke [префикс] — отзывает токены плагина (все или один)."""
+    await register_user(update.effective_user)
+    user_id = update.effective_user.id
+    prefix = context.args[0].strip() if context.args else None
+
+    revoked = await revoke_api_tokens(user_id, prefix)
+    if revoked == 0:
+        active = await list_api_tokens(user_id)
+        if not active:
+            await update.message.reply_text("У вас нет активных токенов плагина.")
+            return
+        prefixes = ", ".join(row.get("token_prefix") or "—" for row in active)
+        await update.message.reply_text(
+            f"Токен с префиксом {prefix} не найден. Активные токены: {prefixes}."
+        )
+        return
+
+    await update.message.reply_text(
+        f"Отозвано токенов: {revoked}. Плагин с ними больше не работает — "
+        "новый токен выдаст /ps_token."
+    )
+
+
 # ---------------------------------------------------------
 # MODEL MENU
 # ---------------------------------------------------------
@@ -223,30 +349,6 @@ async def model_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ---------------------------------------------------------
 
 
-def _today_utc_iso() -> str:
-    today = datetime.now(timezone.utc).replace(
-        hour=0, minute=0, second=0, microsecond=0
-    )
-    return today.isoformat()
-
-
-async def get_remove_bg_free_left(user_id: int) -> int:
-    model_id = MODEL_INFO["remove_bg"]["replicate"]
-    used = await count_generations_since(user_id, model_id, _today_utc_iso())
-    return max(0, FREE_REMOVE_BG_PER_DAY - used)
-
-
-async def get_effective_cost(user_id: int, settings: dict) -> tuple[int, int | None]:
-    model_key = settings.get("model", "banana")
-    if model_key == "remove_bg":
-        free_left = await get_remove_bg_free_left(user_id)
-        if free_left > 0:
-            return 0, free_left
-        return MODEL_INFO["remove_bg"]["base_cost"], 0
-
-    return get_generation_cost_tokens(settings), None
-
-
 def build_run_message(model_key: str, cost: int, free_left: int | None) -> str:
     if model_key == "remove_bg":
         if cost == 0:
@@ -295,55 +397,56 @@ async def generate_with_nano_banana(
         await update.message.reply_text("Пришлите фото, чтобы удалить фон.")
         return
 
-    await update.message.reply_text(build_run_message(model_key, cost, free_left))
+    chat_id = update.effective_chat.id
+    message = update.message
+    await outbound.send(
+        chat_id, lambda: message.reply_text(build_run_message(model_key, cost, free_left))
+    )
 
     try:
-        image_url, img_bytes = await run_model(
-            prompt,
-            settings,
-            image_urls=image_urls,
-        )
-
-        used_cost = 0
-        new_balance = balance
-        if cost > 0:
-            ok, used_cost, new_balance = await deduct_tokens(
-                user_id, settings, override_cost=cost
+        # Запись в журнале генераций: упадём до проведения — доведёт core.inflight
+        async with inflight.track(user_id, chat_id, prompt, settings, cost):
+            route: dict = {}
+            image_url = await run_model(
+                prompt,
+                settings,
+                image_urls=image_urls,
+                route=route,
             )
-            if not ok:
-                logger.error(
-                    "Не удалось списать токены после успешной генерации "
-                    f"(user_id={user_id}, expected_cost={cost})"
-                )
-                used_cost = 0
-                new_balance = await get_balance(user_id)
-
-        if img_bytes:
-            bio = BytesIO(img_bytes)
-            bio.name = f"nano-bot.{settings.get('output_format', 'png')}"
-            bio.seek(0)
-            await update.message.reply_photo(photo=bio)
-        else:
-            await update.message.reply_photo(photo=image_url)
 
-        if used_cost > 0:
-            await update.message.reply_text(
-                f"Списано {used_cost} токенов. Новый баланс: {new_balance}."
-            )
-        else:
-            await update.message.reply_text(
-                free_run_message(model_key, free_left)
-                or "Картинка сгенерирована без списания токенов."
-            )
+            # Replicate уже отработал (и выставил счёт) — списание, отправка и лог
+            # должны завершиться, даже если бюджет апдейта истёк; истёкший бюджет
+            # после этого не считается ошибкой (ответ пользователю уже отправлен).
+            async def finish() -> None:
+                used_cost, new_balance = await settle_generation(
+                    user_id, prompt, image_url, settings, cost, route=route, balance=balance
+                )
 
-        await log_generation(
-            user_id=user_id,
-            prompt=prompt,
-            image_url=image_url,
-            settings=settings,
-            tokens_spent=used_cost or cost,
+                await deliver_image(message, image_url, settings.get("output_format", "png"))
+
+                if used_cost > 0:
+                    done_text = f"Списано {used_cost} токенов. Новый баланс: {new_balance}."
+                else:
+                    done_text = (
+                        free_run_message(model_key, free_left)
+                        or "Картинка сгенерирована без списания токенов."
+                    )
+                served = route.get("model", model_key)
+                if served != model_key:
+                    done_text += (
+                        f"\n\n{MODEL_INFO[model_key]['label']} сейчас перегружена — "
+                        f"картинку сделала {MODEL_INFO[served]['label']} по той же цене."
+                    )
+                await outbound.send(chat_id, lambda: message.reply_text(done_text))
+
+            await deadline.run_to_completion(finish())
+
+    except deadline.DeadlineExceeded:
+        logger.warning("Генерация не уложилась в бюджет времени (user_id=%s)", user_id)
+        await update.message.reply_text(
+            "⏱ Генерация заняла слишком много времени и была остановлена, токены не списаны.\n"
+            "Попробуйте ещё раз чуть позже."
         )
-
     except Exception as e:
         logger.exception("Ошибка при генерации/отправке")
         await update.message.reply_text(
@@ -378,12 +481,118 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not message or not message.photo:
         return
 
-    photo = message.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
-    image_url = file.file_path
+    settings = get_user_settings(context)
+    try:
+        image_input = await prepare_reference(
+            context.bot, message.photo, settings.get("model", "banana")
+        )
+    except deadline.DeadlineExceeded:
+        raise
+    except Exception:
+        logger.exception("Не удалось подготовить референс")
+        await message.reply_text("Не удалось обработать фото, попробуйте отправить его ещё раз.")
+        return
 
     prompt = (message.caption or "").strip() or "image to image"
-    await generate_with_nano_banana(update, context, prompt, image_urls=[image_url])
+    await generate_with_nano_banana(update, context, prompt, image_urls=[image_input])
+
+
+# ---------------------------------------------------------
+# BATCH FILES
+# ---------------------------------------------------------
+
+BATCH_PENDING_KEY = "batch_pending"
+
+
+async def handle_batch_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await register_user(update.effective_user)
+    message = update.message
+    document = message.document if message else None
+    if not document:
+        return
+
+    if document.file_size and document.file_size > BATCH_MAX_FILE_BYTES:
+        await message.reply_text(f"Файл слишком большой: максимум {BATCH_MAX_FILE_BYTES // 1024} КБ.")
+        return
+
+    tg_file = await document.get_file()
+    data = bytes(await tg_file.download_as_bytearray())
+    settings = get_user_settings(context)
+    try:
+        items = parse_prompt_file(data, document.file_name or "prompts.txt", settings)
+    except BatchFileError as e:
+        await message.reply_text(f"Не удалось разобрать файл: {e}")
+        return
+
+    cost = quote_batch(items)
+    balance = await get_balance(update.effective_user.id)
+    context.user_data[BATCH_PENDING_KEY] = items
+
+    by_model: dict = {}
+    for item in items:
+        key = item["settings"]["model"]
+        by_model[key] = by_model.get(key, 0) + 1
+    models = ", ".join(f"{MODEL_INFO[k]['label']} × {n}" for k, n in by_model.items())
+
+    text = (
+        f"📄 Пакет: {len(items)} промтов ({models}).\n"
+        f"Стоимость: {cost} токенов, ваш баланс: {balance}.\n\n"
+        "Токены резервируются сразу за весь пакет, за неудавшиеся промты — возвращаются."
+    )
+    keyboard = [[
+        InlineKeyboardButton(f"▶️ Запустить за {cost}", callback_data="batch|run"),
+        InlineKeyboardButton("✖️ Отмена", callback_data="batch|cancel"),
+    ]]
+    await message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def _run_batch_logged(*args) -> None:
+    try:
+        await run_batch(*args)
+    except Exception:
+        logger.exception("Пакетная генерация завершилась с ошибкой")
+
+
+async def batch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not query:
+        return
+
+    action = (query.data or "").split("|", 1)[-1]
+    items = context.user_data.pop(BATCH_PENDING_KEY, None)
+    if action == "cancel" or not items:
+        await query.answer()
+        await query.edit_message_text(
+            "Пакет отменён." if action == "cancel" else "Пакет устарел — пришлите файл ещё раз."
+        )
+        return
+
+    user_id = update.effective_user.id
+    cost = quote_batch(items)
+    try:
+        reserved = await reserve_batch(user_id, update.effective_chat.id, cost)
+    except BatchInProgress:
+        context.user_data[BATCH_PENDING_KEY] = items
+        await query.answer("Дождитесь окончания текущего пакета.", show_alert=True)
+        return
+    if reserved is None:
+        await query.answer()
+        await query.edit_message_text(
+            f"Недостаточно токенов: нужно {cost}. Пополните баланс через /buy."
+        )
+        return
+    balance, entry_id = reserved
+
+    await query.answer("Запускаю пакет")
+    progress = await query.edit_message_text(
+        f"⏳ Пакет: готово 0 из {len(items)}… Зарезервировано {cost} токенов, баланс: {balance}."
+    )
+    # Пакет дольше бюджета апдейта — работает отдельно от него
+    deadline.spawn_detached(
+        _run_batch_logged(
+            context.bot, update.effective_chat.id, user_id, items, cost, progress, entry_id
+        )
+    )
 
 
 # ---------------------------------------------------------
@@ -499,7 +708,13 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
         return
 
     user_id = update.effective_user.id
-    new_balance = await add_tokens(user_id, tokens_to_add)
+    # charge_id делает зачисление идемпотентным: повтор апдейта не удвоит токены
+    new_balance = await add_tokens(
+        user_id,
+        tokens_to_add,
+        reason="purchase",
+        payment_charge_id=payment.telegram_payment_charge_id,
+    )
 
     await message.reply_text(
         f"Оплата прошла успешно ✅\n"
@@ -513,10 +728,31 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
 # REPLY BUTTONS + CUSTOM INPUT
 # ---------------------------------------------------------
 
+REPLY_BUTTONS = {
+    "🚀 Старт": start,
+    "🎛 Меню": menu_command,
+    "🧠 Модель": model_menu_command,
+    "ℹ Помощь": help_command,
+    "💰 Баланс": balance_command,
+    "📜 История": history_command,
+}
+
+
 async def handle_reply_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await register_user(update.effective_user)
     text = (update.message.text or "").strip()
 
+    # Класс действия определяем без I/O, лимит — до обращения к Supabase
+    if context.user_data.get(CUSTOM_TOKENS_KEY):
+        action = "payment"
+    elif context.user_data.get(FLUX_INPUT_KEY) or text in REPLY_BUTTONS:
+        action = "command"
+    else:
+        action = "generation"
+    if not await throttle.allow(update, action):
+        return
+
+    await register_user(update.effective_user)
+
     # --- кастомный ввод токенов для покупки ---
     if context.user_data.get(CUSTOM_TOKENS_KEY):
         context.user_data[CUSTOM_TOKENS_KEY] = False
@@ -604,29 +840,39 @@ async def handle_reply_buttons(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     # --- обычные reply-кнопки ---
-    if text == "🚀 Старт":
-        await start(update, context)
-        return
-    if text == "🎛 Меню":
-        await menu_command(update, context)
-        return
-    if text == "🧠 Модель":
-        await model_menu_command(update, context)
-        return
-    if text == "ℹ Помощь":
-        await help_command(update, context)
-        return
-    if text == "💰 Баланс":
-        await balance_command(update, context)
-        return
-    if text == "📜 История":
-        await history_command(update, context)
+    # Сам хендлер зарегистрирован с бюджетом генерации; для команд сужаем его
+    command = REPLY_BUTTONS.get(text)
+    if command:
+        await deadline.run_with_deadline(DEADLINE_COMMAND, command(update, context))
         return
 
     # Остальное — текстовый промт
     await handle_text_prompt(update, context)
 
 
+# ---------------------------------------------------------
+# ORIGINAL OUTPUT
+# ---------------------------------------------------------
+
+async def original_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    if not query:
+        return
+
+    await query.answer("Отправляю оригинал…")
+    key = (query.data or "").split("|", 1)[-1]
+    try:
+        sent = await send_original(query.message, key)
+    except DownloadTooLarge:
+        await query.message.reply_text("Оригинал больше 50 МБ — Telegram не даст его отправить.")
+        return
+
+    if not sent:
+        await query.message.reply_text(
+            "Ссылка на оригинал устарела (хранится около часа после генерации)."
+        )
+
+
 # ---------------------------------------------------------
 # SETTINGS CALLBACK
 # ---------------------------------------------------------
@@ -706,23 +952,54 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # REGISTRATION
 # ---------------------------------------------------------
 
+def limited(action: str, seconds: float):
+    """Лимит на пользователя (проверяется первым, до любого I/O) + дедлайн апдейта."""
+
+    def decorator(handler):
+        return rate_limited(action)(with_deadline(seconds)(handler))
+
+    return decorator
+
+
 def register_user_handlers(app: Application) -> None:
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("menu", menu_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("balance", balance_command))
-    app.add_handler(CommandHandler("history", history_command))
-    app.add_handler(CommandHandler("model", model_menu_command))
-    app.add_handler(CommandHandler("buy", buy_menu_command))
-    app.add_handler(CommandHandler("ps_token", ps_token_command))
-
-    app.add_handler(CallbackQueryHandler(buy_callback, pattern=r"^buy_"))
-    app.add_handler(CallbackQueryHandler(settings_callback))
-
-    app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    command = limited("command", DEADLINE_COMMAND)
+    callback = limited("callback", DEADLINE_CALLBACK)
+    generation = limited("generation", DEADLINE_GENERATION)
+    payment = limited("payment", DEADLINE_COMMAND)
+
+    app.add_handler(CommandHandler("start", command(start)))
+    app.add_handler(CommandHandler("menu", command(menu_command)))
+    app.add_handler(CommandHandler("help", command(help_command)))
+    app.add_handler(CommandHandler("balance", command(balance_command)))
+    app.add_handler(CommandHandler("history", command(history_command)))
+    app.add_handler(CommandHandler("export", limited("command", DEADLINE_EXPORT)(export_command)))
+    app.add_handler(CommandHandler("model", command(model_menu_command)))
+    app.add_handler(CommandHandler("buy", command(buy_menu_command)))
+    app.add_handler(CommandHandler("ps_token", command(ps_token_command)))
+    app.add_handler(CommandHandler("ps_revoke", command(ps_revoke_command)))
+
+    app.add_handler(CallbackQueryHandler(payment(buy_callback), pattern=r"^buy_"))
+    app.add_handler(CallbackQueryHandler(callback(history_callback), pattern=r"^hist\|"))
+    app.add_handler(CallbackQueryHandler(generation(batch_callback), pattern=r"^batch\|"))
+    app.add_handler(
+        CallbackQueryHandler(
+            limited("callback", DEADLINE_DELIVERY)(original_callback), pattern=r"^orig\|"
+        )
+    )
+    app.add_handler(CallbackQueryHandler(callback(settings_callback)))
+
+    app.add_handler(
+        PreCheckoutQueryHandler(limited("payment", DEADLINE_PRECHECKOUT)(precheckout_callback))
+    )
+    # Зачисление оплаты не ограничиваем: отменять его на полпути нельзя
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
 
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(filters.PHOTO, generation(handle_photo)))
+    batch_files = filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv")
+    app.add_handler(MessageHandler(batch_files, command(handle_batch_file)))
+    # Класс действия текста (кнопка / ввод / промт) определяется внутри хендлера
     app.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reply_buttons)
+        MessageHandler(
+            filters.TEXT & ~filters.COMMAND, with_deadline(DEADLINE_GENERATION)(handle_reply_buttons)
+        )
     )
@@ -1,10 +1,198 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import sys
+import traceback
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+# ---------------------------------------------------------
+# LOGGING PIPELINE
+# ---------------------------------------------------------
+# Хендлеры логгеров только кладут запись в очередь, в stdout пишет отдельный
+# поток (QueueListener): медленный stdout не останавливает event loop.
+# Очередь ограничена — при переполнении записи отбрасываются и считаются.
+#
+# LOG_LEVEL — уровень корня и, через запятую, отдельных логгеров:
+#   LOG_LEVEL=INFO,core.generators=DEBUG,httpx=WARNING
+# LOG_FORMAT — json (по умолчанию, одна строка на запись) или text.
+# LOG_DEBUG_SAMPLE=N — из DEBUG-записей каждого места в коде пишется одна из N.
+
+LOG_QUEUE_SIZE = 10_000
+DEFAULT_LOGGER_LEVELS = {"httpx": "WARNING", "httpcore": "WARNING"}
+
+_user_id: ContextVar[Optional[int]] = ContextVar("log_user_id", default=None)
+_update_id: ContextVar[Optional[int]] = ContextVar("log_update_id", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional["_DroppingQueueHandler"] = None
+
+
+def bind_log_context(user_id: Optional[int] = None, update_id: Optional[int] = None) -> None:
+    """Привязывает user_id / update_id ко всем записям текущей задачи asyncio."""
+    _user_id.set(user_id)
+    _update_id.set(update_id)
+
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+# ---------------------------------------------------------
+# FILTERS & FORMATTERS
+# ---------------------------------------------------------
+
+class _ContextFilter(logging.Filter):
+    """Снимает контекст в потоке, который пишет запись, — до очереди."""
+
+    def __init__(self, static: Dict) -> None:
+        super().__init__()
+        self.static = static
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.user_id = _user_id.get()
+        record.update_id = _update_id.get()
+        for key, value in self.static.items():
+            setattr(record, key, value)
+        return True
+
+
+class _DebugSampler(logging.Filter):
+    """Пропускает одну DEBUG-запись из every для каждого места в коде."""
+
+    def __init__(self, every: int) -> None:
+        super().__init__()
+        self.every = every
+        self._counts: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        seen = self._counts.get(key, 0)
+        self._counts[key] = seen + 1
+        if seen % self.every:
+            return False
+        record.sample = self.every
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("user_id", "update_id", "worker", "sample")
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if getattr(record, "user_id", None) is not None:
+            line += f" [user={record.user_id} update={record.update_id}]"
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: "queue.Queue") -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы и traceback сворачиваем в строки здесь: в очередь уходит
+        # запись без ссылок на объекты, которые могут измениться
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# ---------------------------------------------------------
+# SETUP
+# ---------------------------------------------------------
+
+def _parse_levels(spec: str) -> Tuple[str, Dict[str, str]]:
+    """"INFO,httpx=WARNING" -> ("INFO", {"httpx": "WARNING"})."""
+    root = "INFO"
+    levels = dict(DEFAULT_LOGGER_LEVELS)
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, level = item.partition("=")
+        if sep:
+            levels[name.strip()] = level.strip().upper()
+        else:
+            root = item.upper()
+    return root, levels
+
+
+def _stop_listener() -> None:
+    """Дописывает очередь в stdout при выходе процесса."""
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup_logging(**static) -> logging.Logger:
+    """
+    Настраивает логирование процесса. static — постоянные поля каждой записи
+    (например, worker=slot в кластере).
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        atexit.register(_stop_listener)
+    else:
+        _listener.stop()
+
+    root_level, levels = _parse_levels(os.getenv("LOG_LEVEL", "INFO"))
+    sample_every = int(os.getenv("LOG_DEBUG_SAMPLE", "1") or 1)
+    fmt = os.getenv("LOG_FORMAT", "json").lower()
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+
+    _queue_handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(_ContextFilter(static))
+    _queue_handler.addFilter(_DebugSampler(sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(root_level)
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output)
+    _listener.start()
 
-def setup_logging():
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.INFO,
-    )
     logger = logging.getLogger(__name__)
     logger.info("Starting nano-bot with Supabase storage + admin panel + history")
     return logger
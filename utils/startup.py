@@ -0,0 +1,70 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------
+# STARTUP PROFILE
+# ---------------------------------------------------------
+# main.py импортирует этот модуль первым, дальше отмечает этапы:
+# imports -> build -> ready (post_init с прогревом). Итог пишется в лог.
+# Подробнее по импортам: python -X importtime main.py
+
+_started = time.perf_counter()
+_marks: List[Tuple[str, float]] = []
+
+# Бюджет «импорт + сборка приложения» без сети (см. python -m utils.startup)
+STARTUP_BUDGET = 1.0
+
+
+def mark(stage: str) -> float:
+    """Отмечает конец этапа stage. Возвращает секунды с начала запуска."""
+    elapsed = time.perf_counter() - _started
+    _marks.append((stage, elapsed))
+    return elapsed
+
+
+def report() -> str:
+    parts = []
+    prev = 0.0
+    for stage, at in _marks:
+        parts.append(f"{stage} {at - prev:.2f}s")
+        prev = at
+    text = ", ".join(parts) + f", total {prev:.2f}s"
+    logger.info("Startup: %s", text)
+    return text
+
+
+def main() -> int:
+    """
+    Замер холодного старта без сети: импорт main + сборка Application.
+    Код возврата 1, если не уложились в бюджет — для CI после деплоя.
+    """
+    parser = argparse.ArgumentParser(description="Cold start budget check")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args()
+
+    # Секреты для замера не нужны: конфиг проверяется только в main.main()
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:startup-check")
+
+    t0 = time.perf_counter()
+    import main as bot_main
+    from utils import startup as profile  # при -m это другой экземпляр модуля, этапы отмечены в нём
+
+    bot_main.build_application()
+    profile.mark("build")
+    print(profile.report())
+    total = time.perf_counter() - t0
+
+    if total > args.budget:
+        print(f"Startup budget exceeded: {total:.2f}s > {args.budget:.2f}s", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,389 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Tuple
+
+if TYPE_CHECKING:
+    # config читает SQLITE_PATH при импорте — в рантайме core.storage импортируется позже
+    from core.storage import Storage
+
+# ---------------------------------------------------------
+# STORAGE CONFORMANCE CHECK
+# ---------------------------------------------------------
+# Один набор проверок для всех реализаций core.storage.Storage:
+#   python -m utils.storage_check                      # sqlite во временном файле
+#   python -m utils.storage_check --backend supabase --yes
+# Для supabase проверки пишут строки под синтетическими user id
+# (900000000000 + случайное число) — на боевой базе запускать не стоит.
+# Код возврата 1, если хоть одна проверка не прошла.
+
+SYNTHETIC_USER_BASE = 900_000_000_000
+
+Check = Callable[["Storage", int], Awaitable[None]]
+CHECKS: List[Tuple[str, Check]] = []
+
+
+class CheckFailed(AssertionError):
+    pass
+
+
+def check(func: Check) -> Check:
+    CHECKS.append((func.__name__, func))
+    return func
+
+
+def expect(condition: bool, message: str) -> None:
+    if not condition:
+        raise CheckFailed(message)
+
+
+async def _new_user(storage, uid: int, username: str) -> dict:
+    return await storage.insert_user({
+        "id": uid,
+        "username": username,
+        "first_name": "Check",
+        "last_name": None,
+        "balance": 0,
+    })
+
+
+# ---------------------------------------------------------
+# CHECKS
+# ---------------------------------------------------------
+
+@check
+async def users_roundtrip(storage, uid: int) -> None:
+    user = await _new_user(storage, uid, f"check{uid}")
+    expect(user is not None and user["id"] == uid, f"insert_user вернул {user!r}")
+    expect("balance" not in user, f"insert_user вернул баланс снимка: {user!r}")
+
+    user = await storage.get_user(uid)
+    expect(user is not None and user["username"] == f"check{uid}", f"get_user вернул {user!r}")
+    expect(user["balance"] == 0, "новый пользователь с ненулевым балансом")
+    expect(await storage.get_user(uid + 999_999) is None, "get_user нашёл несуществующего")
+
+    updated = await storage.update_user(uid, {"first_name": "Renamed", "updated_at": "now()"})
+    expect(updated is not None and updated["first_name"] == "Renamed", f"update_user вернул {updated!r}")
+    expect("balance" not in updated, f"update_user вернул баланс снимка: {updated!r}")
+    expect(
+        await storage.update_user(uid + 999_999, {"first_name": "x", "updated_at": "now()"}) is None,
+        "update_user несуществующего должен вернуть None",
+    )
+
+
+@check
+async def users_search_and_pages(storage, uid: int) -> None:
+    await _new_user(storage, uid, f"findme{uid}")
+
+    found = await storage.search_users(str(uid))
+    expect([u["id"] for u in found] == [uid], f"поиск по id: {found!r}")
+    found = await storage.search_users(f"@FindMe{uid}"[:8])
+    expect(uid in [u["id"] for u in found], "поиск по @префиксу без учёта регистра")
+    found = await storage.search_users(f"dme{uid}")
+    expect(uid in [u["id"] for u in found], "поиск по подстроке")
+
+    recent = await storage.fetch_recent_users(limit=5)
+    expect(len(recent) <= 5 and recent, "fetch_recent_users")
+
+    rows, next_cursor, prev_cursor = await storage.fetch_users_page(limit=1)
+    expect(len(rows) == 1 and prev_cursor is None, "первая страница пользователей")
+    if next_cursor:
+        rows2, _, prev2 = await storage.fetch_users_page(next_cursor, "next", limit=1)
+        expect(rows2 and rows2[0]["id"] != rows[0]["id"], "вторая страница повторяет первую")
+        back, _, _ = await storage.fetch_users_page(prev2, "prev", limit=1)
+        expect([u["id"] for u in back] == [rows[0]["id"]], "prev не вернул первую страницу")
+
+
+@check
+async def ledger_balance(storage, uid: int) -> None:
+    await _new_user(storage, uid, None)
+    charge = f"check-charge-{uid}"
+    results = await storage.ledger_append([
+        {"user_id": uid, "delta": 100, "reason": "payment", "payment_charge_id": charge},
+        {"user_id": uid + 999_999, "delta": 10, "reason": "admin"},
+        {"user_id": uid, "delta": -30, "reason": "generation"},
+    ])
+    expect(
+        [r["status"] for r in results] == ["ok", "no_user", "ok"],
+        f"ledger_append вернул {results!r}",
+    )
+    expect(results[2]["account"]["balance"] == 70, f"баланс после пачки: {results[2]!r}")
+
+    results = await storage.ledger_append([
+        {"user_id": uid, "delta": 100, "reason": "payment", "payment_charge_id": charge},
+    ])
+    expect(
+        results[0]["status"] == "duplicate" and results[0]["account"]["balance"] == 70,
+        "повтор payment_charge_id записался дважды",
+    )
+
+    results = await storage.ledger_append([
+        {"user_id": uid, "delta": -50, "reason": "generation", "mode": "debit"},
+        {"user_id": uid, "delta": -50, "reason": "generation", "mode": "debit"},
+        {"user_id": uid, "delta": -100, "reason": "admin", "mode": "clamp"},
+        {"user_id": uid, "delta": 70, "reason": "admin", "mode": "set"},
+    ])
+    expect(
+        [(r["status"], r["account"]["balance"]) for r in results]
+        == [("ok", 20), ("insufficient", 20), ("ok", 0), ("ok", 70)],
+        f"mode записей: {results!r}",
+    )
+
+    await storage.compact_ledger()
+    user = await storage.get_user(uid)
+    expect(user["balance"] == 70, f"после compact_ledger баланс {user['balance']}")
+
+    granted = await storage.bulk_add_tokens([uid, uid + 999_999], 5)
+    expect(
+        [(r["id"], r["balance"]) for r in granted] == [(uid, 75)],
+        f"bulk_add_tokens вернул {granted!r}",
+    )
+
+
+@check
+async def generations_history(storage, uid: int) -> None:
+    await _new_user(storage, uid, None)
+    since = datetime.now(timezone.utc) - timedelta(seconds=5)
+    settings = {"model": "banana", "aspect_ratio": "1:1", "resolution": "1K", "output_format": "png"}
+    entries = [
+        {
+            "user_id": uid,
+            "prompt": f"prompt {i}",
+            "image_url": f"https://example.com/{i}.png",
+            "settings": settings,
+            "tokens_spent": 10,
+            "route": {"model": "banana", "decision": "primary"},
+        }
+        for i in range(5)
+    ]
+    ids = await storage.log_generations(entries)
+    expect(len(ids) == 5 and len(set(ids)) == 5, f"log_generations вернул {ids!r}")
+    single = await storage.log_generation(uid, "prompt 5", "https://example.com/5.png", settings, 10)
+    expect(single is not None, "log_generation не вернул id")
+
+    model_id = (await storage.fetch_generations_page(uid, limit=1, columns="id,model"))[0][0]["model"]
+    count = await storage.count_generations_since(uid, model_id, since.isoformat())
+    expect(count == 6, f"count_generations_since = {count}")
+    expect(uid in await storage.fetch_active_user_ids(since.isoformat()), "fetch_active_user_ids")
+
+    prompts = []
+    cursor = None
+    while True:
+        rows, cursor, _ = await storage.fetch_generations_page(uid, cursor, "next", limit=4)
+        prompts += [r["prompt"] for r in rows]
+        if cursor is None:
+            break
+    expect(prompts == [f"prompt {i}" for i in range(5, -1, -1)], f"история: {prompts!r}")
+
+    first, next_cursor, _ = await storage.fetch_generations_page(uid, limit=4)
+    second, _, prev_cursor = await storage.fetch_generations_page(uid, next_cursor, "next", limit=4)
+    back, _, _ = await storage.fetch_generations_page(uid, prev_cursor, "prev", limit=4)
+    expect([r["id"] for r in back] == [r["id"] for r in first], "prev не вернул первую страницу")
+
+    recent = await storage.fetch_generations(uid, limit=2)
+    expect([r["prompt"] for r in recent] == ["prompt 5", "prompt 4"], f"fetch_generations: {recent!r}")
+
+
+@check
+async def usage_rollups(storage, uid: int) -> None:
+    await _new_user(storage, uid, None)
+    today = datetime.now(timezone.utc).date().isoformat()
+
+    fields = ("users", "generations", "tokens_spent", "purchases", "tokens_purchased")
+
+    def day_total(rows) -> dict:
+        row = next((r for r in rows if r["model"] == ""), None) or {}
+        return {field: row.get(field, 0) for field in fields}
+
+    before = day_total(await storage.fetch_usage_days(today))
+    settings = {"model": "banana"}
+    await storage.log_generations([
+        {"user_id": uid, "prompt": "a", "image_url": "u", "settings": settings, "tokens_spent": 50},
+        {"user_id": uid, "prompt": "b", "image_url": "u", "settings": settings, "tokens_spent": 50},
+    ])
+    charge = f"check-usage-{uid}"
+    for _ in range(2):  # повтор покупки не должен попасть в сводку
+        await storage.ledger_append([
+            {"user_id": uid, "delta": 500, "reason": "purchase", "payment_charge_id": charge},
+        ])
+
+    after = day_total(await storage.fetch_usage_days(today))
+    delta = {k: after[k] - before[k] for k in fields}
+    expect(
+        delta == {"users": 1, "generations": 2, "tokens_spent": 100, "purchases": 1, "tokens_purchased": 500},
+        f"итог дня изменился на {delta!r}",
+    )
+    top = await storage.fetch_top_users(today, limit=1000)
+    mine = [r for r in top if r["user_id"] == uid]
+    expect(
+        len(mine) == 1 and mine[0]["tokens_spent"] == 100 and mine[0]["tokens_purchased"] == 500,
+        f"fetch_top_users: {mine!r}",
+    )
+
+
+@check
+async def inflight_journal(storage, uid: int) -> None:
+    worker = uid  # синтетический слот — чужие записи не попадутся
+    settings = {"model": "banana", "aspect_ratio": "1:1"}
+    first = await storage.insert_inflight({
+        "worker": worker, "user_id": uid, "chat_id": uid, "prompt": "p", "settings": settings, "cost": 50,
+    })
+    second = await storage.insert_inflight({
+        "worker": worker, "user_id": uid, "chat_id": uid, "prompt": "q", "settings": settings, "cost": 0,
+    })
+    await storage.update_inflight(first, {"model": "banana", "prediction_id": "pred-1"})
+
+    rows = await storage.fetch_inflight(worker)
+    expect([r["id"] for r in rows] == [first, second], f"fetch_inflight: {rows!r}")
+    expect(rows[0]["prediction_id"] == "pred-1" and rows[0]["settings"] == settings, f"запись: {rows[0]!r}")
+    expect(rows[1]["prediction_id"] is None, "prediction_id до создания предсказания")
+
+    await storage.delete_inflight(first)
+    await storage.delete_inflight(second)
+    expect(await storage.fetch_inflight(worker) == [], "записи не удалились")
+
+
+@check
+async def model_telemetry(storage, uid: int) -> None:
+    from core.telemetry import QuantileSketch
+
+    # давний день и синтетический воркер — в /admin_perf строки не попадут
+    day = "2000-01-01"
+    sketch = QuantileSketch()
+    for value in range(1, 101):
+        sketch.add(value)
+    row = {"day": day, "worker": uid, "model": "banana", "combo": "2K · png · refs 0", "status": "succeeded"}
+    await storage.save_telemetry([{**row, "sketches": {"total_s": QuantileSketch().to_dict()}}])
+    await storage.save_telemetry([{**row, "sketches": {"total_s": sketch.to_dict()}}])
+
+    await storage.save_telemetry([{**row, "status": "failed", "sketches": {"total_s": sketch.to_dict()}}])
+
+    rows = [r for r in await storage.fetch_telemetry(day) if r["worker"] == uid and r["day"] == day]
+    expect(
+        sorted(r["status"] for r in rows) == ["failed", "succeeded"],
+        f"save_telemetry не обновил строку или смешал статусы: {rows!r}",
+    )
+    restored = QuantileSketch.from_dict(rows[0]["sketches"]["total_s"])
+    expect(restored.count == 100, f"count после записи: {restored.count}")
+    p95 = restored.quantile(0.95)
+    expect(abs(p95 - 95) <= 95 * 0.02, f"p95 = {p95}")
+
+
+@check
+async def keepwarm_spend(storage, uid: int) -> None:
+    day = "2000-01-02"
+    await storage.save_keepwarm_spend({"day": day, "spent_usd": 0.001, "warmups": 1})
+    await storage.save_keepwarm_spend({"day": day, "spent_usd": 0.0025, "warmups": uid % 1000})
+    row = await storage.fetch_keepwarm_spend(day)
+    expect(
+        row is not None and abs(row["spent_usd"] - 0.0025) < 1e-9 and row["warmups"] == uid % 1000,
+        f"save_keepwarm_spend не обновил строку: {row!r}",
+    )
+    expect(await storage.fetch_keepwarm_spend("2000-01-03") is None, "чужой день не пуст")
+
+    from config import MODEL_INFO
+
+    expect(await storage.last_generation_at("storage-check/none") is None, "last_generation_at без генераций")
+    before = datetime.now(timezone.utc) - timedelta(seconds=5)
+    await storage.log_generation(uid, "warm", "https://example.com/w.png", {"model": "remove_bg"}, 0)
+    last = await storage.last_generation_at(MODEL_INFO["remove_bg"]["replicate"])
+    expect(
+        last is not None and datetime.fromisoformat(str(last).replace("Z", "+00:00")) >= before,
+        f"last_generation_at не видит генерацию: {last!r}",
+    )
+
+
+@check
+async def admin_actions(storage, uid: int) -> None:
+    action_id = await storage.log_admin_action(uid, uid, "storage_check", 1, note="check")
+    expect(isinstance(action_id, int), f"log_admin_action вернул {action_id!r}")
+    await storage.log_admin_actions_bulk([
+        {"admin_id": uid, "target_user_id": uid, "action": "storage_check", "amount": 1, "note": None},
+    ])
+
+
+@check
+async def api_tokens(storage, uid: int) -> None:
+    prefix = f"c{uid % 10_000_000:07d}"
+    await storage.insert_api_token({
+        "user_id": uid,
+        "token_hash": "h" * 64,
+        "token_prefix": prefix,
+        "scope": "photoshop",
+        "expires_at": "2099-01-01T00:00:00Z",
+    })
+    rows = await storage.find_api_tokens(prefix)
+    expect(len(rows) == 1 and rows[0]["token_hash"] == "h" * 64, f"find_api_tokens: {rows!r}")
+    expect(await storage.find_legacy_api_token(f"ps_legacy_{uid}") is None, "find_legacy_api_token")
+
+    await storage.update_api_token(rows[0]["id"], {"scope": "photoshop"})
+    listed = await storage.list_api_tokens(uid)
+    expect([r["token_prefix"] for r in listed] == [prefix], f"list_api_tokens: {listed!r}")
+
+    expect(await storage.revoke_api_tokens(uid, prefix) == 1, "revoke_api_tokens по префиксу")
+    expect(await storage.find_api_tokens(prefix) == [], "отозванный токен находится")
+    expect(await storage.revoke_api_tokens(uid) == 0, "повторный отзыв")
+    expect(await storage.last_api_token_revocation() is not None, "last_api_token_revocation после отзыва")
+
+
+# ---------------------------------------------------------
+# RUNNER
+# ---------------------------------------------------------
+
+async def run_checks(storage) -> int:
+    """Прогоняет CHECKS, печатает результат. Возвращает число упавших."""
+    base = SYNTHETIC_USER_BASE + random.randrange(1_000_000) * 100
+    failed = 0
+    for offset, (name, func) in enumerate(CHECKS):
+        t0 = time.perf_counter()
+        try:
+            await func(storage, base + offset)
+        except Exception as e:
+            failed += 1
+            print(f"FAIL {name}: {e}")
+            if not isinstance(e, CheckFailed):
+                traceback.print_exc()
+            continue
+        print(f"ok   {name} ({(time.perf_counter() - t0) * 1000:.0f} ms)")
+    return failed
+
+
+async def _run(backend: str) -> int:
+    from core.storage import _create, close_storage, set_storage
+
+    storage = _create(backend)
+    set_storage(storage)
+    try:
+        failed = await run_checks(storage)
+    finally:
+        await close_storage()
+    print(f"{storage.name}: {len(CHECKS) - failed}/{len(CHECKS)} checks passed")
+    return 1 if failed else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Storage backend conformance check")
+    parser.add_argument("--backend", choices=("sqlite", "supabase"), default="sqlite")
+    parser.add_argument("--path", help="файл SQLite (по умолчанию — временный)")
+    parser.add_argument("--yes", action="store_true", help="разрешить запись в Supabase")
+    args = parser.parse_args()
+
+    if args.backend == "supabase" and not args.yes:
+        print("Проверка пишет тестовые строки в Supabase; подтвердите флагом --yes", file=sys.stderr)
+        return 2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.backend == "sqlite":
+            # config читает SQLITE_PATH при импорте — задаём до него
+            os.environ["SQLITE_PATH"] = args.path or os.path.join(tmp, "check.sqlite3")
+        return asyncio.run(_run(args.backend))
+
+
+if __name__ == "__main__":
+    sys.exit(main())